@@ -4,6 +4,14 @@ from dotenv import load_dotenv
 import logging # Import logging
 from google.generativeai import types # Added for media parts
 import io # Added for byte stream handling
+import hashlib
+import json
+import threading
+import asyncio
+import time
+from collections import OrderedDict
+import metrics
+from resilience import RetryPolicy, CircuitBreaker, CircuitOpenError
 
 load_dotenv() # Load environment variables from .env file
 logger = logging.getLogger(__name__) # Get a logger for this module
@@ -55,7 +63,10 @@ Follow these steps in your interaction:
 
 **Crucial Rule:** If a user's question or prompt is not related to diagnosing or repairing an appliance, you must respond by stating your purpose. For example, say: "My function is to assist with appliance repair. Please provide the information I requested about the appliance so I can help you." Do not answer off-topic questions.
 
-Your tone should be helpful, clear, and professional. Keep your responses concise and easy to understand. Respond in all lowercase."""):
+Your tone should be helpful, clear, and professional. Keep your responses concise and easy to understand. Respond in all lowercase.""",
+                 history_token_budget=None, keep_recent_messages=6, token_cache_size=4096,
+                 inline_media_max_bytes=8 * 1024 * 1024, file_processing_timeout=120,
+                 media_reference_ttl=None, media_reference_max_entries=2048, media_uploader=None, retry_policy=None):
         """
         Initializes the GeminiFlashAPI client.
 
@@ -68,6 +79,33 @@ Your tone should be helpful, clear, and professional. Keep your responses concis
             system_instruction (str, optional): A system-level instruction to guide the
                                                 model's behavior. Defaults to a specific
                                                 casual/romanticist tone.
+            history_token_budget (int, optional): Maximum tokens of prior conversation to resend
+                                                  per turn. When exceeded, older messages are
+                                                  replaced by a rolling summary. None disables
+                                                  windowing. Defaults to None.
+            keep_recent_messages (int, optional): Number of most recent messages that are always
+                                                  sent verbatim when windowing. Defaults to 6.
+            token_cache_size (int, optional): Capacity of the per-message token count cache
+                                              and of the summary cache. Defaults to 4096.
+            inline_media_max_bytes (int, optional): Media at or below this size is sent inline;
+                                                    larger files given by path are streamed to the
+                                                    Gemini File API instead. Defaults to 8 MiB.
+            file_processing_timeout (float, optional): Seconds to wait for an uploaded file
+                                                       (e.g. a video) to become ACTIVE. Defaults to 120.
+            media_reference_ttl (float, optional): When set, media that is too large to send inline, or
+                                                   that is sent again within this many seconds (same SHA-256),
+                                                   is uploaded through the File API once and its handle is
+                                                   reused for the rest of that time; media seen once and small
+                                                   enough still goes inline. Must stay below the File API's 48
+                                                   hour retention. None disables deduplication. Defaults to None.
+            media_reference_max_entries (int, optional): Capacity of the content hash -> file handle
+                                                         index. Defaults to 2048.
+            media_uploader (callable, optional): Replaces the File API upload, taking (file, mime_type)
+                                                 and returning a handle usable as a prompt part; for
+                                                 tests and local stand-ins. Defaults to None.
+            retry_policy (resilience.RetryPolicy, optional): Deadlines, retries and circuit breaker
+                                                             applied to every generation call. Defaults
+                                                             to RetryPolicy() with a CircuitBreaker().
 
         Raises:
             ValueError: If the API key is not provided (and not found in
@@ -107,6 +145,21 @@ Your tone should be helpful, clear, and professional. Keep your responses concis
         self.model_name = model_name
         self.api_key = effective_api_key # Store the actual key being used for reference
         self.system_instruction = system_instruction # Store for reference if needed
+        self.history_token_budget = history_token_budget
+        self.keep_recent_messages = keep_recent_messages
+        self.token_cache_size = token_cache_size
+        self._token_count_cache = OrderedDict() # message hash -> token count
+        self._summary_cache = OrderedDict() # hash of the summarized prefix -> summary text
+        self._cache_lock = threading.Lock()
+        self._summary_model = None # Created on first use; has no repair-assistant system instruction
+        self.inline_media_max_bytes = inline_media_max_bytes
+        self.file_processing_timeout = file_processing_timeout
+        self.media_reference_ttl = media_reference_ttl
+        self.media_reference_max_entries = media_reference_max_entries
+        self.media_uploader = media_uploader
+        self._media_references = OrderedDict() # content key -> (list of file handles, expires_at)
+        self.retry_policy = retry_policy or RetryPolicy(breaker=CircuitBreaker())
+        self.breaker = self.retry_policy.breaker
         logger.info(f"API_INTERFACE_LOG: GeminiFlashAPI initialized successfully with model: {self.model_name} (API Key: {self.api_key[:5]}...).")
 
     def generate_content(self, prompt, stream=False, generation_config=None, safety_settings=None):
@@ -132,19 +185,13 @@ Your tone should be helpful, clear, and professional. Keep your responses concis
             Exception: If there's an error during API communication or generation.
         """
         try:
-            if stream:
-                response = self.model.generate_content(
-                    prompt,
-                    stream=True,
-                    generation_config=generation_config,
-                    safety_settings=safety_settings
-                )
-            else:
-                response = self.model.generate_content(
-                    prompt,
-                    generation_config=generation_config,
-                    safety_settings=safety_settings
-                )
+            response = self.retry_policy.call('generate_content', lambda timeout: self.model.generate_content(
+                prompt,
+                stream=stream,
+                generation_config=generation_config,
+                safety_settings=safety_settings,
+                request_options={'timeout': timeout}
+            ), whole_call=stream)
             return response
         except Exception as e:
             print(f"Error generating content: {e}")
@@ -168,11 +215,12 @@ Your tone should be helpful, clear, and professional. Keep your responses concis
             Exception: If there's an error during API communication or generation.
         """
         try:
-            response = await self.model.generate_content_async(
+            response = await self.retry_policy.call_async('generate_content', lambda timeout: self.model.generate_content_async(
                 prompt,
                 generation_config=generation_config,
-                safety_settings=safety_settings
-            )
+                safety_settings=safety_settings,
+                request_options={'timeout': timeout}
+            ))
             return response
         except Exception as e:
             print(f"Error generating content asynchronously: {e}")
@@ -218,14 +266,33 @@ Your tone should be helpful, clear, and professional. Keep your responses concis
             print(f"Error counting tokens asynchronously: {e}")
             raise
 
-    def start_chat_session(self, history=None):
+    def warm_up(self):
+        """
+        Makes one cheap API call (fetching the model's metadata) so the first chat turn
+        does not pay for connection setup, and so a bad API key is caught at startup.
+
+        Raises:
+            Exception: If the model cannot be reached.
+        """
+        model_info = genai.get_model(f"models/{self.model_name}")
+        logger.info(f"API_INTERFACE_LOG: Warm-up succeeded for model '{model_info.name}'.")
+
+    def start_chat_session(self, history=None, context=None):
         """
         Starts a new chat session with the configured model.
 
+        If `history_token_budget` is set and the history exceeds it, older messages are
+        replaced by a rolling summary (see `window_history`), so the chat's history may
+        be shorter than the history passed in. `context` is put in front of the history as
+        one user/model exchange, so the chat's history may also be longer; either way,
+        slice new turns by the chat's own history length.
+
         Args:
             history (list of genai.types.Content, optional):
                      An optional list of previous messages to initialize the chat history.
                      Each item should be a dict like {"role": "user"/"model", "parts": ["text"]}.
+            context (str, optional): Reference notes for the model, such as similar solved
+                     repairs (see solution_index.format_references). Not part of the history.
 
         Returns:
             genai.ChatSession: A chat session object.
@@ -238,14 +305,148 @@ Your tone should be helpful, clear, and professional. Keep your responses concis
             # Convert history to google.generativeai.types.Content objects if necessary
             # For simplicity, assuming history is already in the correct format or None
             # For a robust implementation, you might add conversion logic here.
-            chat_session = self.model.start_chat(history=history or [])
+            with metrics.phase('start_chat'):
+                # Stored messages may carry app fields (e.g. 'structured'); the model only takes role and parts.
+                chat_history = self.window_history([{"role": message["role"], "parts": message["parts"]} for message in history or []])
+                if context:
+                    chat_history = [
+                        {"role": "user", "parts": [{"text": context}]},
+                        {"role": "model", "parts": [{"text": "understood. i'll keep those notes in mind."}]},
+                    ] + chat_history
+                chat_session = self.model.start_chat(history=chat_history)
             logger.info(f"API_INTERFACE_LOG: Chat session started. Initial history length: {len(chat_session.history)}")
             return chat_session
         except Exception as e:
             logger.error(f"API_INTERFACE_LOG: Error starting chat session: {e}", exc_info=True)
             raise
 
-    def send_chat_message(self, chat_session, message_text, stream=False, media_bytes=None, media_mime_type=None):
+    def count_message_tokens(self, message):
+        """
+        Counts the tokens in one history message, caching the result by message hash.
+
+        Args:
+            message (dict): A message like {"role": "user", "parts": [{"text": "..."}]}.
+
+        Returns:
+            int: The token count reported by `count_tokens`.
+        """
+        key = self._message_hash(message)
+        with self._cache_lock:
+            if key in self._token_count_cache:
+                self._token_count_cache.move_to_end(key)
+                return self._token_count_cache[key]
+        tokens = self.count_tokens([message]).total_tokens
+        with self._cache_lock:
+            self._token_count_cache[key] = tokens
+            while len(self._token_count_cache) > self.token_cache_size:
+                self._token_count_cache.popitem(last=False)
+        return tokens
+
+    def fits_history_budget(self, history):
+        """
+        Checks whether a serialized history can be resent as-is under `history_token_budget`.
+
+        Args:
+            history (list of dict): Messages like {"role": ..., "parts": [{"text": ...}]}.
+
+        Returns:
+            bool: True if windowing is disabled or the history is within budget.
+        """
+        if not self.history_token_budget:
+            return True
+        # Cheap upper-bound estimate first, so short conversations never call count_tokens.
+        if sum(len(self._message_text(message)) for message in history) // 2 <= self.history_token_budget:
+            return True
+        return sum(self.count_message_tokens(message) for message in history) <= self.history_token_budget
+
+    def window_history(self, history):
+        """
+        Trims a history to `history_token_budget`, summarizing whatever falls outside the window.
+
+        The last `keep_recent_messages` messages are kept verbatim (more if they fit the
+        budget); everything older is folded into a summary, which is cached and extended
+        incrementally as the conversation grows.
+
+        Args:
+            history (list of dict): Messages like {"role": ..., "parts": [{"text": ...}]}.
+
+        Returns:
+            list of dict: The history to start the chat with.
+        """
+        if self.fits_history_budget(history):
+            return history
+
+        # Grow the verbatim window backwards from the newest message while it fits the budget.
+        cut = len(history)
+        used = 0
+        while cut > 0:
+            tokens = self.count_message_tokens(history[cut - 1])
+            if len(history) - cut >= self.keep_recent_messages and used + tokens > self.history_token_budget:
+                break
+            used += tokens
+            cut -= 1
+        # The verbatim window must start on a user turn so roles keep alternating after the summary.
+        while cut < len(history) and history[cut].get("role") != "user":
+            cut += 1
+        if cut == 0:
+            return history
+
+        summary = self._summarize_prefix(history[:cut])
+        logger.info(f"API_INTERFACE_LOG: Windowed history: summarized {cut} older messages, kept {len(history) - cut} verbatim (~{used} tokens).")
+        return [
+            {"role": "user", "parts": [{"text": f"summary of our conversation so far:\n{summary}"}]},
+            {"role": "model", "parts": [{"text": "understood. i'll continue from that summary."}]},
+        ] + history[cut:]
+
+    def _summarize_prefix(self, messages):
+        # Cumulative hashes let us find the longest already-summarized prefix and only fold in the rest.
+        prefix_hashes = []
+        running = hashlib.sha256()
+        for message in messages:
+            running.update(self._message_hash(message).encode("ascii"))
+            prefix_hashes.append(running.hexdigest())
+
+        previous_summary, start = None, 0
+        with self._cache_lock:
+            for i in range(len(messages), 0, -1):
+                if prefix_hashes[i - 1] in self._summary_cache:
+                    previous_summary, start = self._summary_cache[prefix_hashes[i - 1]], i
+                    self._summary_cache.move_to_end(prefix_hashes[i - 1])
+                    break
+        if start == len(messages):
+            return previous_summary
+
+        transcript = "\n".join(f"{message.get('role')}: {self._message_text(message)}" for message in messages[start:])
+        prompt = (
+            "Summarize this appliance repair conversation for the assistant that will continue it. "
+            "Keep the appliance type, brand, model number, error codes, symptoms, steps already tried, "
+            "answers the user gave and any part numbers. Be concise.\n\n"
+        )
+        if previous_summary:
+            prompt += f"Summary of the earlier part of the conversation:\n{previous_summary}\n\n"
+        prompt += f"Conversation:\n{transcript}"
+
+        if self._summary_model is None:
+            self._summary_model = genai.GenerativeModel(model_name=self.model_name)
+        with metrics.phase('history_summary'):
+            summary = self.retry_policy.call('history_summary', lambda timeout: self._summary_model.generate_content(
+                prompt, request_options={'timeout': timeout})).text.strip()
+        with self._cache_lock:
+            self._summary_cache[prefix_hashes[-1]] = summary
+            while len(self._summary_cache) > self.token_cache_size:
+                self._summary_cache.popitem(last=False)
+        return summary
+
+    @staticmethod
+    def _message_text(message):
+        return " ".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in message.get("parts", []))
+
+    @staticmethod
+    def _message_hash(message):
+        return hashlib.sha256(json.dumps(message, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def send_chat_message(self, chat_session, message_text, stream=False, media_bytes=None, media_mime_type=None, media_path=None, media_files=None,
+                          media_references=None, media_key=None):
         """
         Sends a message to an existing chat session and gets the model's response.
 
@@ -255,6 +456,16 @@ Your tone should be helpful, clear, and professional. Keep your responses concis
             stream (bool, optional): If True, streams the response. Defaults to False.
             media_bytes (bytes, optional): The bytes of the image or video file.
             media_mime_type (str, optional): The MIME type of the media_bytes (e.g., "image/jpeg", "video/mp4").
+            media_path (str, optional): Path to a media file on disk, used instead of media_bytes.
+                                        Files larger than `inline_media_max_bytes` are uploaded
+                                        through the File API without being read into memory.
+            media_files (list of tuple, optional): Several (path, mime_type) media files to send
+                                                   in order, e.g. keyframes sampled from a video.
+            media_references (list, optional): File handles from `get_media_references`, sent as-is
+                                               instead of `media_files`.
+            media_key (str, optional): Caller-chosen key (e.g. the original upload's hash) under which
+                                       the handles built from `media_files` are remembered, so a
+                                       repeat upload can skip preprocessing as well as the upload.
 
         Returns:
             genai.types.GenerateContentResponse or iterator:
@@ -265,46 +476,202 @@ Your tone should be helpful, clear, and professional. Keep your responses concis
             Exception: If there's an error sending the message or getting the response.
             ValueError: If chat_session is not valid or media is provided incorrectly.
         """
-        logger.info(f"API_INTERFACE_LOG: Preparing to send message to chat session. Text: '{message_text[:50]}...', Media present: {media_bytes is not None}")
+        logger.info(f"API_INTERFACE_LOG: Preparing to send message to chat session. Text: '{message_text[:50]}...', Media present: {media_bytes is not None or media_path is not None or bool(media_files) or bool(media_references)}")
+        if not chat_session:
+            logger.error("API_INTERFACE_LOG: Chat session is not valid (e.g., None).")
+            raise ValueError("Chat session is not valid.")
+
+        prompt_parts = self._build_prompt_parts(message_text, media_bytes=media_bytes, media_mime_type=media_mime_type,
+                                                media_path=media_path, media_files=media_files,
+                                                media_references=media_references, media_key=media_key)
+
+        try:
+            if not prompt_parts: # Should be caught above, but as a safeguard
+                 logger.error("API_INTERFACE_LOG: No parts to send in the message.")
+                 raise ValueError("Message content is empty.")
+
+            logger.info(f"API_INTERFACE_LOG: Sending {len(prompt_parts)} parts to chat session. First part type: {type(prompt_parts[0]) if prompt_parts else 'N/A'}")
+            # For streams this covers the time until the response starts; app.py times the rest.
+            # A failed send leaves the session's history untouched, so it can simply be retried.
+            with metrics.phase('model_call'):
+                response = self.retry_policy.call('chat', lambda timeout: chat_session.send_message(
+                    prompt_parts, stream=stream, request_options={'timeout': timeout}), whole_call=stream)
+            if not stream:
+                metrics.record_token_usage(response)
+            # The chat_session.history is automatically updated by the send_message call.
+            logger.info(f"API_INTERFACE_LOG: Message sent and response received. Chat history length: {len(chat_session.history)}")
+            return response
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.error(f"API_INTERFACE_LOG: Error sending chat message: {e}", exc_info=True)
+            raise
+
+    async def start_chat_session_async(self, history=None, context=None):
+        """
+        Asynchronously starts a chat session; see `start_chat_session`.
+
+        History windowing may call `count_tokens` and the summary model, so the
+        setup runs in a worker thread instead of blocking the event loop.
+        """
+        return await asyncio.to_thread(self.start_chat_session, history, context)
+
+    async def send_chat_message_async(self, chat_session, message_text, stream=False, media_bytes=None, media_mime_type=None,
+                                      media_path=None, media_files=None, media_references=None, media_key=None):
+        """
+        Asynchronously sends a message to a chat session; see `send_chat_message` for the arguments.
+
+        Returns:
+            genai.types.AsyncGenerateContentResponse: The response; iterate it with `async for` when
+                                                      stream is True.
+
+        Raises:
+            Exception: If there's an error sending the message or getting the response.
+            ValueError: If chat_session is not valid or the message is empty.
+        """
         if not chat_session:
             logger.error("API_INTERFACE_LOG: Chat session is not valid (e.g., None).")
             raise ValueError("Chat session is not valid.")
+        # Hashing and uploading media is blocking file/network I/O, so build the parts off the event loop.
+        prompt_parts = await asyncio.to_thread(self._build_prompt_parts, message_text, media_bytes=media_bytes,
+                                               media_mime_type=media_mime_type, media_path=media_path, media_files=media_files,
+                                               media_references=media_references, media_key=media_key)
+        try:
+            logger.info(f"API_INTERFACE_LOG: Sending {len(prompt_parts)} parts to chat session (async).")
+            with metrics.phase('model_call'):
+                response = await self.retry_policy.call_async('chat', lambda timeout: chat_session.send_message_async(
+                    prompt_parts, stream=stream, request_options={'timeout': timeout}), whole_call=stream)
+            if not stream:
+                metrics.record_token_usage(response)
+            logger.info(f"API_INTERFACE_LOG: Async message sent. Chat history length: {len(chat_session.history)}")
+            return response
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.error(f"API_INTERFACE_LOG: Error sending chat message asynchronously: {e}", exc_info=True)
+            raise
 
+    def _build_prompt_parts(self, message_text, media_bytes=None, media_mime_type=None, media_path=None,
+                            media_files=None, media_references=None, media_key=None):
         prompt_parts = []
-        if media_bytes and media_mime_type:
+        if media_references:
+            prompt_parts.extend(media_references)
+            logger.info(f"API_INTERFACE_LOG: Reusing {len(media_references)} uploaded media reference(s).")
+        elif media_files:
+            media_parts = [self._build_media_part(file_mime_type, media_path=file_path) for file_path, file_mime_type in media_files]
+            # Inline parts carry the bytes themselves; only uploaded handles are worth remembering.
+            if media_key and self.media_reference_ttl and not any(isinstance(part, dict) for part in media_parts):
+                self._remember_media_references(media_key, media_parts)
+            prompt_parts.extend(media_parts)
+        if (media_bytes or media_path) and media_mime_type:
             if media_mime_type.startswith("image/") or media_mime_type.startswith("video/"):
-                # Construct the media part as a dictionary
-                prompt_parts.append({
-                    "inline_data": {
-                        "mime_type": media_mime_type,
-                        "data": media_bytes
-                    }
-                })
+                prompt_parts.append(self._build_media_part(media_mime_type, media_bytes=media_bytes, media_path=media_path))
                 logger.info(f"API_INTERFACE_LOG: Added media part with MIME type: {media_mime_type}")
             else:
                 logger.warning(f"API_INTERFACE_LOG: Unsupported media_mime_type for direct Part creation: {media_mime_type}. Media will not be sent.")
-        
+
         # Always add the text part if message_text is present
         if message_text:
             prompt_parts.append({"text": message_text})
         elif not prompt_parts: # If no media and no text, it's an issue
             logger.error("API_INTERFACE_LOG: Cannot send an empty message (no text and no media).")
             raise ValueError("Cannot send an empty message (no text and no media).")
+        return prompt_parts
 
+    def get_media_references(self, media_key):
+        """
+        Returns the file handles previously uploaded under `media_key`, if still fresh.
 
-        try:
-            if not prompt_parts: # Should be caught above, but as a safeguard
-                 logger.error("API_INTERFACE_LOG: No parts to send in the message.")
-                 raise ValueError("Message content is empty.")
+        Args:
+            media_key (str): A key passed to `send_chat_message`, or "sha256:<hex>" for a single file.
 
-            logger.info(f"API_INTERFACE_LOG: Sending {len(prompt_parts)} parts to chat session. First part type: {type(prompt_parts[0]) if prompt_parts else 'N/A'}")
-            response = chat_session.send_message(prompt_parts, stream=stream)
-            # The chat_session.history is automatically updated by the send_message call.
-            logger.info(f"API_INTERFACE_LOG: Message sent and response received. Chat history length: {len(chat_session.history)}")
-            return response
-        except Exception as e:
-            logger.error(f"API_INTERFACE_LOG: Error sending chat message: {e}", exc_info=True)
-            raise
+        Returns:
+            list or None: The handles, or None if unknown, expired or deduplication is disabled.
+        """
+        if not self.media_reference_ttl:
+            return None
+        with self._cache_lock:
+            entry = self._media_references.get(media_key)
+            if entry is None:
+                return None
+            references, expires_at = entry
+            if time.time() > expires_at:
+                del self._media_references[media_key]
+                return None
+            self._media_references.move_to_end(media_key)
+            # None marks content that was seen once and sent inline; see _build_media_part.
+            return references
+
+    def _seen_media(self, content_key):
+        with self._cache_lock:
+            entry = self._media_references.get(content_key)
+            return entry is not None and time.time() <= entry[1]
+
+    def _remember_media_references(self, media_key, references):
+        with self._cache_lock:
+            self._media_references[media_key] = (references, time.time() + self.media_reference_ttl)
+            self._media_references.move_to_end(media_key)
+            while len(self._media_references) > self.media_reference_max_entries:
+                self._media_references.popitem(last=False)
+
+    def _upload_media(self, media, media_mime_type):
+        with metrics.phase('media_upload'):
+            if self.media_uploader is not None:
+                return self.media_uploader(media, media_mime_type)
+            return self._wait_for_file_active(genai.upload_file(media, mime_type=media_mime_type))
+
+    def _build_media_part(self, media_mime_type, media_bytes=None, media_path=None):
+        """
+        Builds the prompt part for a media file: inline bytes for small media, a File API
+        reference for large files on disk, or a reused reference for already-uploaded content.
+        With deduplication on, small content is uploaded too once it is sent a second time.
+        """
+        size = os.path.getsize(media_path) if media_path is not None else len(media_bytes)
+        if self.media_reference_ttl:
+            digest = hashlib.sha256()
+            if media_path is not None:
+                with open(media_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+            else:
+                digest.update(media_bytes)
+            content_key = f"sha256:{digest.hexdigest()}"
+            references = self.get_media_references(content_key)
+            if references is not None:
+                logger.info(f"API_INTERFACE_LOG: Reusing uploaded file for {content_key[:19]}... instead of resending bytes.")
+                return references[0]
+            if size > self.inline_media_max_bytes or self._seen_media(content_key):
+                logger.info(f"API_INTERFACE_LOG: Uploading {size} byte {media_mime_type} file via the File API for reuse.")
+                uploaded = self._upload_media(media_path if media_path is not None else io.BytesIO(media_bytes), media_mime_type)
+                self._remember_media_references(content_key, [uploaded])
+                return uploaded
+            self._remember_media_references(content_key, None)
+        elif size > self.inline_media_max_bytes and media_path is not None:
+            logger.info(f"API_INTERFACE_LOG: Uploading {size} byte {media_mime_type} file via the File API.")
+            return self._upload_media(media_path, media_mime_type)
+
+        if media_path is not None:
+            with open(media_path, "rb") as f:
+                media_bytes = f.read()
+        # Construct the media part as a dictionary
+        return {
+            "inline_data": {
+                "mime_type": media_mime_type,
+                "data": media_bytes
+            }
+        }
+
+    def _wait_for_file_active(self, uploaded_file):
+        # Videos are processed asynchronously after upload and cannot be referenced until ACTIVE.
+        deadline = time.monotonic() + self.file_processing_timeout
+        while uploaded_file.state.name == "PROCESSING":
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Uploaded file {uploaded_file.name} was not processed within {self.file_processing_timeout}s.")
+            time.sleep(1)
+            uploaded_file = genai.get_file(uploaded_file.name)
+        if uploaded_file.state.name != "ACTIVE":
+            raise ValueError(f"Uploaded file {uploaded_file.name} is in state {uploaded_file.state.name}.")
+        return uploaded_file
 
 # Example Usage (Illustrative - requires GOOGLE_API_KEY to be set)
 if __name__ == "__main__":
@@ -0,0 +1,215 @@
+"""
+Admission control for model calls.
+
+`TokenBucketLimiter` caps how fast each user can send chat messages, and
+`ConcurrencyLimiter` / `AsyncConcurrencyLimiter` bound how many model calls a process
+runs at once, queueing the overflow for a limited time. Both raise `AdmissionRejected`,
+which the endpoints turn into a 429 with a `Retry-After` header. Limits are per
+process, so under gunicorn the effective totals are multiplied by the worker count.
+"""
+import asyncio
+import collections
+import contextlib
+import math
+import threading
+import time
+
+import metrics
+
+class AdmissionRejected(Exception):
+    """Raised when a request is refused; `retry_after` is a whole number of seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Request rejected ({reason}); retry after {retry_after}s.")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _whole_seconds(seconds):
+    return max(1, math.ceil(seconds))
+
+
+class TokenBucketLimiter:
+    """
+    Per-key token buckets: each key may spend `burst` requests at once, refilled at
+    `rate` requests per second.
+
+    Idle keys are dropped once their bucket is full again, so memory stays bounded by
+    the number of recently active keys.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+    def take(self, key):
+        """
+        Spends one token for `key`.
+
+        Raises:
+            AdmissionRejected: If the bucket is empty.
+        """
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                metrics.ADMISSION_REJECTIONS.labels("rate_limited").inc()
+                raise AdmissionRejected("rate_limited", _whole_seconds((1 - tokens) / self.rate))
+            self._buckets[key] = (tokens - 1, now)
+            if now - self._last_prune > self.burst / self.rate:
+                self._prune(now)
+
+    def _prune(self, now):
+        full_after = self.burst / self.rate
+        self._buckets = {key: state for key, state in self._buckets.items() if now - state[1] < full_after}
+        self._last_prune = now
+
+
+class _SlotStats:
+    """Shared bookkeeping for the concurrency limiters."""
+
+    def __init__(self, max_concurrent, max_queue, max_wait):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiting = 0
+        # Moving average of how long a slot is held, used to estimate Retry-After.
+        self._avg_hold = 1.0
+
+    def _reject(self, reason):
+        # Roughly how long until everyone already waiting (and this caller) gets a slot.
+        estimate = self._avg_hold * (self.waiting + 1) / max(1, self.max_concurrent)
+        metrics.ADMISSION_REJECTIONS.labels(reason).inc()
+        return AdmissionRejected(reason, _whole_seconds(estimate))
+
+    def _admit(self):
+        self.in_flight += 1
+        metrics.LLM_IN_FLIGHT.inc()
+
+    def _release(self, held):
+        self.in_flight -= 1
+        metrics.LLM_IN_FLIGHT.dec()
+        self._record_hold(held)
+
+    def _record_hold(self, held):
+        self._avg_hold += 0.2 * (held - self._avg_hold)
+
+    def _enqueue(self):
+        if self.waiting >= self.max_queue:
+            raise self._reject("queue_full")
+        self.waiting += 1
+        metrics.LLM_QUEUE_DEPTH.inc()
+
+    def _dequeue(self):
+        self.waiting -= 1
+        metrics.LLM_QUEUE_DEPTH.dec()
+
+
+class ConcurrencyLimiter(_SlotStats):
+    """
+    Lets at most `max_concurrent` threads hold a slot; up to `max_queue` more wait for
+    at most `max_wait` seconds. Waiters are not served in strict arrival order.
+    """
+
+    def __init__(self, max_concurrent, max_queue, max_wait):
+        super().__init__(max_concurrent, max_queue, max_wait)
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Holds a slot for the enclosed block.
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait times out.
+        """
+        with metrics.phase("llm_queue"):
+            self._acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._release(time.monotonic() - started)
+                self._cond.notify_all()
+
+    def _acquire(self):
+        with self._cond:
+            if self.in_flight < self.max_concurrent and not self.waiting:
+                self._admit()
+                return
+            self._enqueue()
+            try:
+                admitted = self._cond.wait_for(lambda: self.in_flight < self.max_concurrent, timeout=self.max_wait)
+            finally:
+                self._dequeue()
+            if not admitted:
+                raise self._reject("queue_timeout")
+            self._admit()
+
+
+class AsyncConcurrencyLimiter(_SlotStats):
+    """
+    `ConcurrencyLimiter` for coroutines on a single event loop. Waiters are served in
+    arrival order, and `release` does not block, so it is safe in a stream's cleanup.
+    """
+
+    def __init__(self, max_concurrent, max_queue, max_wait):
+        super().__init__(max_concurrent, max_queue, max_wait)
+        self._waiters = collections.deque()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        with metrics.phase("llm_queue"):
+            acquired_at = await self.acquire()
+        try:
+            yield
+        finally:
+            self.release(acquired_at)
+
+    async def acquire(self):
+        """
+        Takes a slot and returns the time it was taken, to pass to `release`.
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait times out.
+        """
+        if self.in_flight < self.max_concurrent and not self._waiters:
+            self._admit()
+            return time.monotonic()
+        self._enqueue()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            raise self._reject("queue_timeout") from None
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed over just as the caller went away; pass it on.
+                self.release(time.monotonic())
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            self._dequeue()
+        return time.monotonic()
+
+    def release(self, acquired_at):
+        held = time.monotonic() - acquired_at
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # Hand the slot straight to the next waiter, so in_flight is unchanged.
+                waiter.set_result(None)
+                self._record_hold(held)
+                return
+        self._release(held)
@@ -1,12 +1,34 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
+# Recorded before the imports below so the startup report covers them.
+import time
+_STARTUP_BEGAN = time.perf_counter()
+
+from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, g, Response, stream_with_context
 from functools import wraps
 import os
 import logging
 import uuid
+import threading
+import contextlib
+import json
+import base64
+import hashlib
+import functools
 from werkzeug.utils import secure_filename
 import mimetypes
-from datetime import datetime
-from supabase import create_client, Client
+from datetime import datetime, timezone
+from token_verifier import TokenVerifier
+from chat_session_cache import ChatSessionCache
+from chat_store import create_chat_store, HistoryConflictError
+from response_cache import create_response_cache, make_cache_key
+from media import spool_upload, MediaTooLargeError, MediaPreprocessor, load_imaging
+from single_flight import SingleFlight
+from session_queue import SessionQueue, SessionBusyError
+from write_behind import HistoryWriteBehind
+from solution_index import create_solution_index, format_references
+from solutions import extract_structured
+from admission import AdmissionRejected, TokenBucketLimiter, ConcurrencyLimiter
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+import metrics
 
 # Configure basic logging
 logging.basicConfig(level=logging.INFO)
@@ -14,71 +36,415 @@ logging.basicConfig(level=logging.INFO)
 # --- Supabase Configuration ---
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_ANON_KEY")
+supabase = None
+
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    logging.critical("SUPABASE_URL and SUPABASE_KEY must be set in environment variables.")
-    supabase: Client = None
-else:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+def _create_supabase_client():
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        logging.critical("SUPABASE_URL and SUPABASE_KEY must be set in environment variables.")
+        return None
+    from supabase import create_client
+    client = create_client(SUPABASE_URL, SUPABASE_KEY)
     logging.info("Supabase client initialized successfully.")
+    return client
+
+
+# --- Chat Storage ---
+# Where sessions and messages are kept: "supabase" (PostgREST, the default), "postgres"
+# (pooled direct connections to DATABASE_URL, with prepared statements for the hot queries)
+# or "sqlite" (a local file, for tests and benchmarks). Auth always goes through Supabase.
+CHAT_STORE_BACKEND = os.environ.get('CHAT_STORE_BACKEND', 'supabase')
+chat_store = None
+
+
+def _create_chat_store():
+    if CHAT_STORE_BACKEND == 'supabase':
+        if supabase is None:
+            return None
+        options = {'client': supabase, 'url': SUPABASE_URL, 'key': SUPABASE_KEY}
+    elif CHAT_STORE_BACKEND == 'postgres':
+        options = {
+            'dsn': os.environ.get('DATABASE_URL'),
+            'min_connections': int(os.environ.get('CHAT_STORE_POOL_MIN', 1)),
+            'max_connections': int(os.environ.get('CHAT_STORE_POOL_MAX', 10)),
+            'pool_timeout': float(os.environ.get('CHAT_STORE_POOL_TIMEOUT_SECONDS', 5)),
+        }
+    else:
+        options = {'path': os.environ.get('CHAT_STORE_PATH', 'chat_store.db')} if CHAT_STORE_BACKEND == 'sqlite' else {}
+    try:
+        return create_chat_store(CHAT_STORE_BACKEND, **options)
+    except Exception as e:
+        logging.critical(f"Could not initialize the {CHAT_STORE_BACKEND} chat store: {e}")
+        return None
+
+
+# With HISTORY_WRITE_BEHIND on, answers are returned before their history is saved: turns are
+# queued on `history_writer` and written in batches by a background thread (see write_behind.py).
+# This worker reads its own queued turns; the session list and usage totals catch up within
+# HISTORY_FLUSH_INTERVAL_SECONDS. drain() saves what is still queued before the worker exits.
+HISTORY_WRITE_BEHIND = os.environ.get('HISTORY_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+history_writer = None
+
+
+def _create_history_writer():
+    if not HISTORY_WRITE_BEHIND or chat_store is None:
+        return None
+    return HistoryWriteBehind(
+        chat_store, _flush_session_summary,
+        flush_interval=float(os.environ.get('HISTORY_FLUSH_INTERVAL_SECONDS', 0.5)),
+        max_batch_rows=int(os.environ.get('HISTORY_FLUSH_MAX_ROWS', 500)),
+        max_pending_rows=int(os.environ.get('HISTORY_WRITE_BEHIND_MAX_PENDING', 10000)),
+        max_retry_delay=float(os.environ.get('HISTORY_RETRY_MAX_DELAY_SECONDS', 30)),
+        # The cached ChatSession still holds the dropped turns; the next turn reloads from the store.
+        on_conflict=chat_session_cache.invalidate,
+    )
+
+
+# --- Token Verification ---
+# Tokens are verified locally when the project's JWT secret (HS256) or JWKS URL is set;
+# otherwise each token costs one supabase.auth.get_user call, cached until it expires.
+SUPABASE_JWT_SECRET = os.environ.get("SUPABASE_JWT_SECRET")
+SUPABASE_JWKS_URL = os.environ.get("SUPABASE_JWKS_URL")
+
+token_verifier = TokenVerifier(
+    jwt_secret=SUPABASE_JWT_SECRET,
+    jwks_url=SUPABASE_JWKS_URL,
+    max_entries=int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", 1024)),
+    max_ttl=int(os.environ.get("AUTH_CACHE_MAX_TTL_SECONDS", 300)),
+)
+if not SUPABASE_JWT_SECRET and not SUPABASE_JWKS_URL:
+    logging.warning("SUPABASE_JWT_SECRET/SUPABASE_JWKS_URL not set; falling back to remote token verification.")
+
 
+class DummyGeminiAPI:
+    def __init__(self, api_key=None, model_name="dummy-model-fallback"):
+        self.api_key = "DUMMY_KEY_IN_USE"
+        self.model_name = model_name
+        logging.warning(f"Using DUMMY GeminiFlashAPI initialized with model: {self.model_name}. THIS IS NOT THE REAL API.")
+    def generate_content(self, prompt, stream=False, generation_config=None, safety_settings=None):
+        logging.info(f"Dummy generate_content called with prompt: '{prompt}' for model '{self.model_name}'")
+        class DummyResponse:
+            def __init__(self, text_content, parts_present=True, feedback=None):
+                self.text = text_content
+                self.parts = ["dummy_part"] if parts_present else []
+                self.prompt_feedback = feedback
+        return DummyResponse(f"Simulated response for: '{prompt}' using {self.model_name}", feedback="No issues.")
+    def count_tokens(self, prompt):
+        return len(prompt.split())
+    def start_chat_session(self, history=None, context=None):
+        logging.info(f"DUMMY_API_LOG: Starting a new dummy chat session.")
+        class DummyChatSession:
+            def __init__(self):
+                self.history = history or []
+            def send_message(self, message_text, stream=False):
+                self.history.append({"role": "user", "parts": [message_text]})
+                response_text = f"Simulated chat response to: '{message_text}'"
+                self.history.append({"role": "model", "parts": [response_text]})
+                class DummyChatResponse:
+                    def __init__(self, text):
+                        self.text = text
+                        self.parts = [text]
+                        self.prompt_feedback = None
+                return DummyChatResponse(response_text)
+        return DummyChatSession()
+    def send_chat_message(self, chat_session, message_text, stream=False):
+        logging.info(f"DUMMY_API_LOG: Sending message to dummy chat session: '{message_text}'")
+        return chat_session.send_message(message_text, stream=stream)
 
-# Attempt to import the GeminiFlashAPI class and initialize it globally
+
+def _create_gemini_client():
+    # Attempt to import the GeminiFlashAPI class and initialize it
+    client = None
+    try:
+        from API_Interface import GeminiFlashAPI
+        logging.info("Successfully imported GeminiFlashAPI from API_Interface.py")
+        history_token_budget = int(os.environ.get('GEMINI_HISTORY_TOKEN_BUDGET', 0)) or None
+        client = GeminiFlashAPI(
+            history_token_budget=history_token_budget,
+            keep_recent_messages=int(os.environ.get('GEMINI_KEEP_RECENT_MESSAGES', 6)),
+            inline_media_max_bytes=int(os.environ.get('GEMINI_INLINE_MEDIA_MAX_BYTES', 8 * 1024 * 1024)),
+            # Uploaded files are kept by the File API for 48 hours; reuse handles for a bit less than that.
+            media_reference_ttl=int(os.environ.get('GEMINI_MEDIA_DEDUP_TTL_SECONDS', 46 * 3600)) or None,
+            retry_policy=RetryPolicy(
+                max_attempts=int(os.environ.get('GEMINI_MAX_ATTEMPTS', 3)),
+                base_delay=float(os.environ.get('GEMINI_RETRY_BASE_DELAY_SECONDS', 0.5)),
+                max_delay=float(os.environ.get('GEMINI_RETRY_MAX_DELAY_SECONDS', 8)),
+                attempt_timeout=float(os.environ.get('GEMINI_ATTEMPT_TIMEOUT_SECONDS', 60)),
+                deadline=float(os.environ.get('GEMINI_CALL_DEADLINE_SECONDS', 90)),
+                breaker=CircuitBreaker(
+                    failure_rate=float(os.environ.get('GEMINI_BREAKER_FAILURE_RATE', 0.5)),
+                    min_calls=int(os.environ.get('GEMINI_BREAKER_MIN_CALLS', 10)),
+                    window=float(os.environ.get('GEMINI_BREAKER_WINDOW_SECONDS', 30)),
+                    cooldown=float(os.environ.get('GEMINI_BREAKER_COOLDOWN_SECONDS', 30)),
+                ),
+            ),
+        )
+        logging.info(f"GeminiFlashAPI client initialized successfully with model: {client.model_name} and API key: {client.api_key[:5]}...")
+    except ImportError as e:
+        logging.error(f"CRITICAL_IMPORT_ERROR: Could not import GeminiFlashAPI from API_Interface.py: {e}. ")
+    except ValueError as ve:
+        logging.error(f"CRITICAL_CONFIG_ERROR: ValueError during GeminiFlashAPI initialization (likely API key issue): {ve}. ")
+    except Exception as ex:
+        logging.error(f"CRITICAL_INIT_ERROR: An unexpected error occurred during GeminiFlashAPI initialization: {ex}")
+
+    # Fallback to a dummy client ONLY if the real one failed to initialize
+    if client is None:
+        logging.warning("FALLBACK_TO_DUMMY_API: GeminiFlashAPI client failed to initialize. Using a DUMMY version.")
+        client = DummyGeminiAPI()
+    return client
+
+
+# While the Gemini circuit breaker is open, chat requests fail fast with a 503 unless this is
+# set, in which case they get a flagged DummyGeminiAPI answer (see _dummy_client).
+GEMINI_FALLBACK_TO_DUMMY = os.environ.get('GEMINI_FALLBACK_TO_DUMMY', '').lower() in ('1', 'true', 'yes')
+_fallback_client = None
+
+
+# --- Client Lifecycle ---
+# Network clients are created once per process, in a background thread so the heavy SDK
+# imports and connection setup stay off the cold-start path; /api/ requests wait for
+# them (see _wait_for_clients). Under a pre-forking server (see gunicorn.conf.py)
+# DEFER_CLIENT_INIT is set so the master imports the app without opening any sockets,
+# and each worker calls init_clients() after it is forked.
 gemini_api_client = None
-try:
-    from API_Interface import GeminiFlashAPI
-    logging.info("Successfully imported GeminiFlashAPI from API_Interface.py")
-    gemini_api_client = GeminiFlashAPI()
-    logging.info(f"Global GeminiFlashAPI client initialized successfully with model: {gemini_api_client.model_name} and API key: {gemini_api_client.api_key[:5]}...")
-except ImportError as e:
-    logging.error(f"CRITICAL_IMPORT_ERROR: Could not import GeminiFlashAPI from API_Interface.py: {e}. ")
-except ValueError as ve:
-    logging.error(f"CRITICAL_CONFIG_ERROR: ValueError during global GeminiFlashAPI initialization (likely API key issue): {ve}. ")
-except Exception as ex:
-    logging.error(f"CRITICAL_INIT_ERROR: An unexpected error occurred during global GeminiFlashAPI initialization: {ex}")
-
-# Fallback to a dummy class ONLY if gemini_api_client is still None after attempts
-if gemini_api_client is None:
-    logging.warning("FALLBACK_TO_DUMMY_API: Global GeminiFlashAPI client failed to initialize. Using a DUMMY version.")
-    class DummyGeminiAPI:
-        def __init__(self, api_key=None, model_name="dummy-model-fallback"):
-            self.api_key = "DUMMY_KEY_IN_USE"
-            self.model_name = model_name
-            logging.warning(f"Using DUMMY GeminiFlashAPI initialized with model: {self.model_name}. THIS IS NOT THE REAL API.")
-        def generate_content(self, prompt, stream=False, generation_config=None, safety_settings=None):
-            logging.info(f"Dummy generate_content called with prompt: '{prompt}' for model '{self.model_name}'")
-            class DummyResponse:
-                def __init__(self, text_content, parts_present=True, feedback=None):
-                    self.text = text_content
-                    self.parts = ["dummy_part"] if parts_present else []
-                    self.prompt_feedback = feedback
-            return DummyResponse(f"Simulated response for: '{prompt}' using {self.model_name}", feedback="No issues.")
-        def count_tokens(self, prompt):
-            return len(prompt.split())
-        def start_chat_session(self, history=None):
-            logging.info(f"DUMMY_API_LOG: Starting a new dummy chat session.")
-            class DummyChatSession:
-                def __init__(self):
-                    self.history = history or []
-                def send_message(self, message_text, stream=False):
-                    self.history.append({"role": "user", "parts": [message_text]})
-                    response_text = f"Simulated chat response to: '{message_text}'"
-                    self.history.append({"role": "model", "parts": [response_text]})
-                    class DummyChatResponse:
-                        def __init__(self, text):
-                            self.text = text
-                            self.parts = [text]
-                            self.prompt_feedback = None
-                    return DummyChatResponse(response_text)
-            return DummyChatSession()
-        def send_chat_message(self, chat_session, message_text, stream=False):
-            logging.info(f"DUMMY_API_LOG: Sending message to dummy chat session: '{message_text}'")
-            return chat_session.send_message(message_text, stream=stream)
-    gemini_api_client = DummyGeminiAPI()
+CLIENT_INIT_TIMEOUT_SECONDS = float(os.environ.get('CLIENT_INIT_TIMEOUT_SECONDS', 30))
+CLIENT_WARMUP_RETRY_SECONDS = float(os.environ.get('CLIENT_WARMUP_RETRY_SECONDS', 5))
+clients_initialized = threading.Event()
+clients_ready = threading.Event()
+draining = threading.Event()
+_clients_pid = None
+_llm_calls = threading.Condition()
+_llm_calls_in_flight = 0
+# Milliseconds per startup phase, reported by /readyz and logged once the worker is ready.
+startup_timings = {}
+
+
+@contextlib.contextmanager
+def _startup_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def init_clients():
+    """
+    Starts creating and warming this process's Supabase and Gemini clients in the background.
+
+    Does nothing if this process has already started them, so it is safe to call from both
+    the server's post-fork hook and the ASGI lifespan.
+    """
+    global _clients_pid
+    if _clients_pid == os.getpid():
+        return
+    _clients_pid = os.getpid()
+    clients_initialized.clear()
+    clients_ready.clear()
+    threading.Thread(target=_init_and_warm_clients, name='client-init', daemon=True).start()
+
+
+def _init_and_warm_clients():
+    global supabase, chat_store, history_writer, gemini_api_client
+    try:
+        with _startup_phase('supabase_init_ms'):
+            supabase = _create_supabase_client()
+        token_verifier.remote_verifier = (lambda token: supabase.auth.get_user(token).user) if supabase else None
+        with _startup_phase('chat_store_init_ms'):
+            chat_store = _create_chat_store()
+            history_writer = _create_history_writer()
+        with _startup_phase('gemini_init_ms'):
+            gemini_api_client = _create_gemini_client()
+    finally:
+        clients_initialized.set()
+    # Imaging libraries are only needed for uploads; load them now rather than on the first one.
+    with _startup_phase('imaging_import_ms'):
+        load_imaging()
+    with _startup_phase('warmup_ms'):
+        _warm_clients()
+    startup_timings['ready_ms'] = round((time.perf_counter() - _STARTUP_BEGAN) * 1000, 1)
+    logging.info(f"STARTUP_LOG: pid {os.getpid()} ready: {json.dumps(startup_timings)}")
+
+
+def _warm_clients():
+    # Opens the first connection to each backend so the first user request does not pay for
+    # DNS, TLS and auth; /readyz stays red until this succeeds.
+    while not draining.is_set():
+        try:
+            if chat_store is not None:
+                chat_store.ping()
+            if hasattr(gemini_api_client, 'warm_up'):
+                gemini_api_client.warm_up()
+            clients_ready.set()
+            logging.info(f"Clients warmed up (pid {os.getpid()}).")
+            return
+        except Exception as e:
+            logging.warning(f"Client warm-up failed, retrying in {CLIENT_WARMUP_RETRY_SECONDS}s: {e}")
+            draining.wait(CLIENT_WARMUP_RETRY_SECONDS)
+
+
+@contextlib.contextmanager
+def llm_call_in_flight():
+    """Counts a model call as in flight so shutdown can wait for it to finish."""
+    global _llm_calls_in_flight
+    with _llm_calls:
+        _llm_calls_in_flight += 1
+    try:
+        yield
+    finally:
+        with _llm_calls:
+            _llm_calls_in_flight -= 1
+            _llm_calls.notify_all()
+
+
+def drain(timeout):
+    """
+    Marks the process as draining (so /readyz goes red), waits for in-flight model calls, then
+    saves any chat history still queued on `history_writer`.
+
+    Args:
+        timeout (float): Maximum seconds to wait, in total.
+
+    Returns:
+        int: The number of model calls still in flight when the wait ended.
+    """
+    deadline = time.monotonic() + timeout
+    draining.set()
+    with _llm_calls:
+        if _llm_calls_in_flight:
+            logging.info(f"Draining: waiting up to {timeout}s for {_llm_calls_in_flight} in-flight model call(s).")
+        _llm_calls.wait_for(lambda: _llm_calls_in_flight == 0, timeout=timeout)
+        remaining = _llm_calls_in_flight
+    if history_writer is not None:
+        history_writer.close(max(0.0, deadline - time.monotonic()))
+    return remaining
+
+
+if not os.environ.get('DEFER_CLIENT_INIT'):
+    init_clients()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'a_very_secret_key_that_should_be_changed')
 
+PAST_SESSIONS_DEFAULT_PAGE_SIZE = int(os.environ.get('PAST_SESSIONS_DEFAULT_PAGE_SIZE', 20))
+PAST_SESSIONS_MAX_PAGE_SIZE = int(os.environ.get('PAST_SESSIONS_MAX_PAGE_SIZE', 100))
+SEARCH_QUERY_MAX_CHARS = int(os.environ.get('SEARCH_QUERY_MAX_CHARS', 200))
+PREVIEW_MAX_CHARS = 500
+
+# --- Token Usage ---
+# Per-million-token prices used to estimate cost; defaults are gemini-2.0-flash list prices.
+PROMPT_USD_PER_MTOK = float(os.environ.get('GEMINI_PROMPT_USD_PER_MTOK', 0.10))
+OUTPUT_USD_PER_MTOK = float(os.environ.get('GEMINI_OUTPUT_USD_PER_MTOK', 0.40))
+# A session whose total tokens cross this is logged as a possible runaway conversation.
+RUNAWAY_SESSION_TOKENS = int(os.environ.get('RUNAWAY_SESSION_TOKENS', 500000))
+USAGE_ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get('USAGE_ADMIN_EMAILS', '').split(',') if email.strip()}
+USAGE_MAX_SESSIONS = 100
+
+# Uploads are spooled to disk in chunks; each MIME family has its own cap, and Flask
+# rejects whole requests above MAX_CONTENT_LENGTH before any of it is read.
+MEDIA_SIZE_LIMITS = {
+    'image': int(os.environ.get('MAX_IMAGE_UPLOAD_BYTES', 20 * 1024 * 1024)),
+    'video': int(os.environ.get('MAX_VIDEO_UPLOAD_BYTES', 200 * 1024 * 1024)),
+    'default': int(os.environ.get('MAX_OTHER_UPLOAD_BYTES', 10 * 1024 * 1024)),
+}
+MEDIA_SPOOL_DIR = os.environ.get('MEDIA_SPOOL_DIR') or None
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', max(MEDIA_SIZE_LIMITS.values()) + 1024 * 1024))
+media_preprocessor = MediaPreprocessor(
+    max_edge=int(os.environ.get('MEDIA_MAX_EDGE_PX', 1536)),
+    image_format=os.environ.get('MEDIA_IMAGE_FORMAT', 'JPEG'),
+    quality=int(os.environ.get('MEDIA_IMAGE_QUALITY', 85)),
+    video_keyframes=int(os.environ.get('MEDIA_VIDEO_KEYFRAMES', 6)),
+    spool_dir=MEDIA_SPOOL_DIR,
+)
+
+# Per-worker cache of live ChatSession objects, so consecutive turns skip the history read and rebuild.
+chat_session_cache = ChatSessionCache(
+    max_entries=int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', 256)),
+    idle_ttl=int(os.environ.get('CHAT_CACHE_IDLE_TTL_SECONDS', 900)),
+    max_bytes=int(os.environ.get('CHAT_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+)
+
+# First-turn response cache for common opening prompts; RESPONSE_CACHE_BACKEND=off disables it.
+RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')
+response_cache = None
+if RESPONSE_CACHE_BACKEND != 'off':
+    response_cache_options = {
+        'max_entries': int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+        'ttl': int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 24 * 3600)),
+    }
+    if RESPONSE_CACHE_BACKEND == 'sqlite':
+        response_cache_options['path'] = os.environ.get('RESPONSE_CACHE_PATH', 'response_cache.db')
+    response_cache = create_response_cache(RESPONSE_CACHE_BACKEND, **response_cache_options)
+
+# Final answers (Summary plus a walk-through or part recommendation) are indexed by appliance
+# type, brand, model number, error codes and part numbers; a conversation without a solution
+# yet starts its chat with the closest solved ones as reference notes (see solution_index.py).
+# The notes hold only the solutions' sections, never another user's messages.
+# SOLUTION_INDEX_BACKEND=off disables it; "sqlite" shares one index file between workers.
+SOLUTION_INDEX_BACKEND = os.environ.get('SOLUTION_INDEX_BACKEND', 'memory')
+SOLUTION_CONTEXT_MATCHES = int(os.environ.get('SOLUTION_CONTEXT_MATCHES', 2))
+SOLUTION_CONTEXT_MAX_CHARS = int(os.environ.get('SOLUTION_CONTEXT_MAX_CHARS', 2000))
+solution_index = None
+if SOLUTION_INDEX_BACKEND != 'off':
+    solution_index_options = {
+        'max_entries': int(os.environ.get('SOLUTION_INDEX_MAX_ENTRIES', 5000)),
+        'min_score': float(os.environ.get('SOLUTION_MIN_SCORE', 3.0)),
+    }
+    if SOLUTION_INDEX_BACKEND == 'sqlite':
+        solution_index_options['path'] = os.environ.get('SOLUTION_INDEX_PATH', 'solution_index.db')
+    solution_index = create_solution_index(SOLUTION_INDEX_BACKEND, **solution_index_options)
+
+# --- Admission Control ---
+# A per-user chat message rate and a per-worker cap on concurrent model calls (with a
+# bounded wait queue); requests over either limit get a 429 with Retry-After.
+chat_rate_limiter = TokenBucketLimiter(
+    rate=float(os.environ.get('CHAT_RATE_LIMIT_PER_MINUTE', 20)) / 60,
+    burst=int(os.environ.get('CHAT_RATE_LIMIT_BURST', 5)),
+)
+LLM_MAX_QUEUE_WAIT_SECONDS = float(os.environ.get('LLM_MAX_QUEUE_WAIT_SECONDS', 10))
+llm_admission = ConcurrencyLimiter(
+    max_concurrent=int(os.environ.get('LLM_MAX_CONCURRENT_CALLS', 6)),
+    max_queue=int(os.environ.get('LLM_MAX_QUEUED_CALLS', 16)),
+    max_wait=LLM_MAX_QUEUE_WAIT_SECONDS,
+)
+
+
+# --- Duplicate Turns ---
+# Identical chat turns (same Idempotency-Key header, or else same session, prompt and
+# media) share one model call while in progress, and a finished turn is replayed to
+# repeats: for IDEMPOTENCY_KEY_TTL_SECONDS with a key, and without one only within
+# DUPLICATE_TURN_WINDOW_SECONDS and while it is still the session's latest turn.
+IDEMPOTENCY_KEY_TTL_SECONDS = float(os.environ.get('IDEMPOTENCY_KEY_TTL_SECONDS', 3600))
+DUPLICATE_TURN_WINDOW_SECONDS = float(os.environ.get('DUPLICATE_TURN_WINDOW_SECONDS', 10))
+DUPLICATE_TURN_WAIT_SECONDS = float(os.environ.get('DUPLICATE_TURN_WAIT_SECONDS', 120))
+turn_flights = SingleFlight(max_entries=int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 4096)))
+
+# --- Turn Ordering ---
+# Turns in one chat session run one at a time, in arrival order, within each worker, while
+# other sessions proceed in parallel. A turn that waits longer than SESSION_TURN_WAIT_SECONDS
+# for earlier ones gets a 409. Across workers, racing writes are caught when the history is
+# saved; see _append_session_history.
+SESSION_TURN_WAIT_SECONDS = float(os.environ.get('SESSION_TURN_WAIT_SECONDS', 120))
+SUMMARY_UPDATE_ATTEMPTS = int(os.environ.get('SUMMARY_UPDATE_ATTEMPTS', 5))
+session_turns = SessionQueue()
+
+
+def _unavailable_error(error):
+    """Returns (body, status, headers) for an AdmissionRejected (429) or CircuitOpenError (503)."""
+    headers = {'Retry-After': str(error.retry_after)}
+    if isinstance(error, CircuitOpenError):
+        return {"error": "The AI service is temporarily unavailable. Please try again shortly.", "reason": "circuit_open"}, 503, headers
+    if error.reason == 'rate_limited':
+        message = "You are sending messages too quickly. Please wait a moment and try again."
+    else:
+        message = "The assistant is busy right now. Please try again shortly."
+    return {"error": message, "reason": error.reason}, 429, headers
+
+
+def _unavailable_response(error):
+    body, status, headers = _unavailable_error(error)
+    return jsonify(body), status, headers
+
 # --- DECORATOR FOR AUTHENTICATION ---
 def supabase_login_required(f):
     @wraps(f)
@@ -90,13 +456,15 @@ def supabase_login_required(f):
         jwt = auth_header.split(' ')[1]
         
         try:
-            user_response = supabase.auth.get_user(jwt)
-            if not user_response.user:
-                 return jsonify({"error": "Invalid or expired token."}), 401
+            with metrics.phase('auth'):
+                user = token_verifier.verify(jwt)
         except Exception as e:
             logging.error(f"Token validation error: {e}")
             return jsonify({"error": "Token validation failed.", "details": str(e)}), 401
-            
+
+        # Views read the resolved user from flask.g instead of calling get_user again.
+        g.jwt = jwt
+        g.user = user
         return f(*args, **kwargs)
     return decorated_function
 
@@ -115,6 +483,54 @@ def register_page():
     return render_template('register.html')
 
 
+@app.route('/healthz')
+def healthz():
+    # Liveness: the process is up and serving requests.
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz')
+def readyz():
+    # Readiness: green only once this worker's clients are warm, and red again while it drains.
+    ready = clients_ready.is_set() and not draining.is_set()
+    status = {"ready": ready, "draining": draining.is_set(), "llm_calls_in_flight": _llm_calls_in_flight,
+              "llm_queue_depth": llm_admission.waiting,
+              "history_write_backlog": history_writer.backlog if history_writer else 0,
+              "circuit": breaker.state if (breaker := getattr(gemini_api_client, 'breaker', None)) else None,
+              "startup_ms": startup_timings}
+    return jsonify(status), 200 if ready else 503
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    body, content_type = metrics.render_latest()
+    return Response(body, mimetype=content_type)
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_timer = metrics.start_request(request.url_rule.rule if request.url_rule else 'unmatched')
+
+
+@app.after_request
+def _record_request_metrics(response):
+    timer = g.get('request_timer')
+    if timer is None:
+        return response
+    # Streamed bodies are still being generated; their phases only reach the histograms.
+    response.headers['Server-Timing'] = timer.server_timing()
+    metrics.record_request(timer.endpoint, request.method, response.status_code, time.perf_counter() - timer.started,
+                           request_bytes=request.content_length,
+                           response_bytes=None if response.is_streamed else response.content_length)
+    return response
+
+
+@app.before_request
+def _wait_for_clients():
+    # Clients are created in the background; API calls that arrive first wait for them.
+    if request.path.startswith('/api/') and not clients_initialized.wait(CLIENT_INIT_TIMEOUT_SECONDS):
+        return jsonify({"error": "The server is still starting up. Please retry shortly."}), 503, {'Retry-After': '1'}
+
+
 @app.route('/api/register', methods=['POST'])
 def api_register():
     data = request.get_json()
@@ -161,7 +577,8 @@ def api_login():
 @app.route("/api/logout", methods=['POST'])
 @supabase_login_required
 def api_logout():
-    jwt = request.headers.get('Authorization').split(' ')[1]
+    jwt = g.jwt
+    token_verifier.invalidate(jwt)
     try:
         supabase.auth.sign_out(jwt)
         return jsonify({"message": "Logout successful."}), 200
@@ -169,47 +586,129 @@ def api_logout():
         return jsonify({"error": "Logout failed", "details": str(e)}), 500
 
 
+def _encode_sessions_cursor(session):
+    raw = json.dumps([session.get("start_time"), session.get("session_uuid")]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def _decode_sessions_cursor(cursor):
+    """Raises ValueError (or a decoding error) unless the cursor holds a timestamp and a session UUID."""
+    start_time, session_uuid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    datetime.fromisoformat(start_time)
+    return start_time, str(uuid.UUID(session_uuid))
+
+
 @app.route('/api/past_sessions', methods=['GET'])
 @supabase_login_required
 def get_past_sessions():
-    jwt = request.headers.get('Authorization').split(' ')[1]
-    user = supabase.auth.get_user(jwt).user
-    
+    """
+    Lists the user's sessions newest first, one page at a time.
+
+    Query params: `limit` (page size, capped at PAST_SESSIONS_MAX_PAGE_SIZE) and `cursor`
+    (opaque; taken from the previous page's `X-Next-Cursor` response header).
+    """
+    user = g.user
+
+    limit = request.args.get('limit', PAST_SESSIONS_DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, PAST_SESSIONS_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+
     try:
-        sessions_res = supabase.table('chat_session').select('*').eq('user_id', str(user.id)).order('start_time', desc=True).execute()
-        
-        past_sessions_data = []
-        for session in sessions_res.data:
-            preview = "No preview available."
-            if session.get("history"):
-                for item in session["history"]:
-                    if item.get('role') == 'model' and item.get('parts') and item['parts'][0].get('text'):
-                        preview = item['parts'][0]['text']
-                        break
-            past_sessions_data.append({
-                "session_id": session.get("session_uuid"),
-                "start_time": session.get("start_time"),
-                "appliance_type": session.get("appliance_type"),
-                "history_preview": preview
-            })
-        return jsonify(past_sessions_data), 200
+        before = None
+        if cursor:
+            try:
+                before = _decode_sessions_cursor(cursor)
+            except Exception:
+                return jsonify({"error": "Invalid cursor."}), 400
+        # Fetch one extra row to learn whether another page exists.
+        rows = chat_store.list_sessions(str(user.id), limit + 1, before=before)
+        sessions = rows[:limit]
+
+        past_sessions_data = [_session_listing(session) for session in sessions]
+        headers = {}
+        if len(rows) > limit:
+            headers['X-Next-Cursor'] = _encode_sessions_cursor(sessions[-1])
+        return jsonify(past_sessions_data), 200, headers
     except Exception as e:
         logging.error(f"Error fetching past sessions for user {user.id}: {e}", exc_info=True)
         return jsonify({"error": "Could not retrieve past sessions."}), 500
 
 
+def _session_listing(session):
+    return {
+        "session_id": session.get("session_uuid"),
+        "start_time": session.get("start_time"),
+        "appliance_type": session.get("appliance_type"),
+        "history_preview": session.get("preview_text") or "No preview available.",
+        "message_count": session.get("message_count") or 0,
+        "last_activity": session.get("last_activity")
+    }
+
+
+@app.route('/api/search', methods=['GET'])
+@supabase_login_required
+def search_sessions():
+    """
+    Full-text search over the user's sessions (messages, appliance type and part numbers),
+    best match first, one page at a time.
+
+    Query params: `q` (the search words; every one must match), `limit` (page size, capped
+    at PAST_SESSIONS_MAX_PAGE_SIZE) and `cursor` (opaque; taken from the previous page's
+    `X-Next-Cursor` response header).
+    """
+    user = g.user
+
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "Query parameter 'q' is required."}), 400
+    if len(query) > SEARCH_QUERY_MAX_CHARS:
+        return jsonify({"error": f"Search queries are limited to {SEARCH_QUERY_MAX_CHARS} characters."}), 400
+    limit = request.args.get('limit', PAST_SESSIONS_DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, PAST_SESSIONS_MAX_PAGE_SIZE))
+    offset = 0
+    if request.args.get('cursor'):
+        try:
+            offset = _decode_search_cursor(request.args['cursor'])
+        except Exception:
+            return jsonify({"error": "Invalid cursor."}), 400
+
+    try:
+        with metrics.phase('search'):
+            # Fetch one extra row to learn whether another page exists.
+            rows = chat_store.search_sessions(str(user.id), query, limit + 1, offset)
+        results = [{**_session_listing(session), "rank": session.get("rank")} for session in rows[:limit]]
+        headers = {}
+        if len(rows) > limit:
+            headers['X-Next-Cursor'] = _encode_search_cursor(offset + limit)
+        return jsonify(results), 200, headers
+    except Exception as e:
+        logging.error(f"Error searching sessions for user {user.id}: {e}", exc_info=True)
+        return jsonify({"error": "Could not search sessions."}), 500
+
+
+def _encode_search_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode('utf-8')).decode('ascii')
+
+
+def _decode_search_cursor(cursor):
+    offset = int(json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))["offset"])
+    if offset < 0:
+        raise ValueError("Negative offset.")
+    return offset
+
+
 @app.route('/api/chat_history/<session_uuid>', methods=['GET'])
 @supabase_login_required
 def get_chat_history(session_uuid):
-    jwt = request.headers.get('Authorization').split(' ')[1]
-    user = supabase.auth.get_user(jwt).user
+    user = g.user
     
     try:
-        session_res = supabase.table('chat_session').select('*').eq('session_uuid', session_uuid).eq('user_id', str(user.id)).single().execute()
-        session = session_res.data
+        session = chat_store.get_session(session_uuid, str(user.id))
+        if session is None:
+            return jsonify({"error": "Chat session not found or permission denied."}), 404
         return jsonify({
             "session_id": session.get("session_uuid"),
-            "history": session.get("history", []),
+            "history": _load_session_messages(session_uuid),
             "appliance_type": session.get("appliance_type")
         }), 200
     except Exception as e:
@@ -220,12 +719,13 @@ def get_chat_history(session_uuid):
 @app.route('/api/delete_session/<session_uuid>', methods=['DELETE'])
 @supabase_login_required
 def api_delete_session(session_uuid):
-    jwt = request.headers.get('Authorization').split(' ')[1]
-    user = supabase.auth.get_user(jwt).user
+    user = g.user
     try:
-        delete_res = supabase.table('chat_session').delete().eq('session_uuid', session_uuid).eq('user_id', str(user.id)).execute()
-        if not delete_res.data:
+        if not chat_store.delete_session(session_uuid, str(user.id)):
             return jsonify({"error": "Session not found or permission denied."}), 404
+        chat_session_cache.invalidate(session_uuid)
+        if history_writer is not None:
+            history_writer.discard(session_uuid)
         logging.info(f"User {user.email} deleted session {session_uuid}.")
         return jsonify({"message": "Session deleted successfully."}), 200
     except Exception as e:
@@ -233,11 +733,97 @@ def api_delete_session(session_uuid):
         return jsonify({"error": "Could not delete session."}), 500
 
 
+def _usage_totals(row):
+    prompt_tokens = row.get('prompt_tokens') or 0
+    output_tokens = row.get('output_tokens') or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": prompt_tokens + output_tokens,
+        "estimated_cost_usd": _estimate_cost_usd(prompt_tokens, output_tokens),
+    }
+
+
+@app.route('/api/usage', methods=['GET'])
+@supabase_login_required
+def api_usage():
+    """
+    Token usage and estimated cost for the caller, with their heaviest sessions.
+
+    Query params: `limit` (number of sessions, capped at USAGE_MAX_SESSIONS) and `scope=all`
+    (per-user totals for every user; only for emails listed in USAGE_ADMIN_EMAILS).
+    """
+    user = g.user
+    limit = request.args.get('limit', 10, type=int)
+    limit = max(1, min(limit, USAGE_MAX_SESSIONS))
+
+    try:
+        if request.args.get('scope') == 'all':
+            if (user.email or '').lower() not in USAGE_ADMIN_EMAILS:
+                return jsonify({"error": "Permission denied."}), 403
+            users = chat_store.top_users_by_usage(limit)
+            return jsonify([{
+                "user_id": row.get("user_id"),
+                "session_count": row.get("session_count") or 0,
+                "message_count": row.get("message_count") or 0,
+                "max_prompt_tokens": row.get("max_prompt_tokens") or 0,
+                "last_activity": row.get("last_activity"),
+                **_usage_totals(row),
+            } for row in users]), 200
+
+        totals = chat_store.user_usage(str(user.id)) or {}
+        sessions = chat_store.top_sessions_by_usage(str(user.id), limit)
+        return jsonify({
+            "session_count": totals.get("session_count") or 0,
+            "message_count": totals.get("message_count") or 0,
+            "max_prompt_tokens": totals.get("max_prompt_tokens") or 0,
+            **_usage_totals(totals),
+            "top_sessions": [{
+                "session_id": session.get("session_uuid"),
+                "appliance_type": session.get("appliance_type"),
+                "message_count": session.get("message_count") or 0,
+                "max_prompt_tokens": session.get("max_prompt_tokens") or 0,
+                "last_activity": session.get("last_activity"),
+                **_usage_totals(session),
+            } for session in sessions],
+        }), 200
+    except Exception as e:
+        logging.error(f"Error fetching usage for user {user.id}: {e}", exc_info=True)
+        return jsonify({"error": "Could not retrieve usage."}), 500
+
+
+@app.route('/api/usage/session/<session_uuid>', methods=['GET'])
+@supabase_login_required
+def api_session_usage(session_uuid):
+    """Per-turn token usage for one of the caller's sessions."""
+    user = g.user
+    try:
+        session = _get_owned_session(session_uuid, str(user.id))
+    except Exception:
+        return jsonify({"error": "Chat session not found or permission denied."}), 404
+
+    try:
+        turns = chat_store.turn_usage(session_uuid)
+        return jsonify({
+            "session_id": session_uuid,
+            "message_count": session.get("message_count") or 0,
+            "max_prompt_tokens": session.get("max_prompt_tokens") or 0,
+            **_usage_totals(session),
+            "turns": [{
+                "seq": row["seq"],
+                "model_name": row.get("model_name"),
+                **_usage_totals(row),
+            } for row in turns],
+        }), 200
+    except Exception as e:
+        logging.error(f"Error fetching usage for session {session_uuid}: {e}", exc_info=True)
+        return jsonify({"error": "Could not retrieve usage."}), 500
+
+
 @app.route('/api/new_chat', methods=['POST'])
 @supabase_login_required
 def api_new_chat():
-    jwt = request.headers.get('Authorization').split(' ')[1]
-    user = supabase.auth.get_user(jwt).user
+    user = g.user
     
     if not gemini_api_client or (hasattr(gemini_api_client, 'api_key') and gemini_api_client.api_key == "DUMMY_KEY_IN_USE"):
         return jsonify({"error": "Cannot start chat, API client is DUMMY or uninitialized."}), 500
@@ -246,80 +832,683 @@ def api_new_chat():
         data = request.get_json()
         if not data: return jsonify({"error": "Invalid request: payload must be valid JSON."}), 400
         appliance_type = data.get('appliance_type', 'Unknown')
-        insert_data = {'user_id': str(user.id), 'appliance_type': appliance_type, 'history': [] }
-        new_session_res = supabase.table('chat_session').insert(insert_data).execute()
-        new_session = new_session_res.data[0]
+        new_session = chat_store.create_session(str(user.id), appliance_type)
         logging.info(f"New DB chat session created with UUID: {new_session['session_uuid']} for user {user.email}")
         return jsonify({
             "message": "New chat session started in DB.", 
             "session_id": new_session['session_uuid'],
-            "history": new_session['history']
+            "history": new_session.get('history') or []
         }), 200
     except Exception as e:
         logging.error(f"Error starting new chat session: {e}", exc_info=True)
         return jsonify({"error": f"Could not start new chat session: {str(e)}"}), 500
 
-@app.route('/api/chat_message', methods=['POST'])
-@supabase_login_required
-def api_chat_message():
-    jwt = request.headers.get('Authorization').split(' ')[1]
-    user = supabase.auth.get_user(jwt).user
-    
-    media_bytes, media_mime_type = None, None
+def _parse_chat_request():
+    """
+    Returns ((session_id, prompt, media), None) or (None, error_response).
+
+    `media` is a SpooledMedia on disk (removed at request teardown) or None.
+    """
+    media = None
     if request.content_type.startswith('multipart/form-data'):
         session_id = request.form.get('session_id')
         prompt = request.form.get('prompt')
         media_file = request.files.get('media_file')
         if media_file and media_file.filename:
             filename = secure_filename(media_file.filename)
-            media_bytes = media_file.read()
             media_mime_type = media_file.content_type or mimetypes.guess_type(filename)[0]
-            logging.info(f"Received file: {filename}, MIME type: {media_mime_type}, Size: {len(media_bytes)} bytes")
+            try:
+                media = spool_upload(media_file.stream, media_mime_type, MEDIA_SIZE_LIMITS, filename=filename, spool_dir=MEDIA_SPOOL_DIR)
+            except MediaTooLargeError as e:
+                return None, (jsonify({"error": str(e)}), 413)
+            g.spooled_media = [media]
+            logging.info(f"Received file: {filename}, MIME type: {media_mime_type}, Size: {media.size} bytes")
     elif request.content_type.startswith('application/json'):
         data = request.get_json()
-        if not data: return jsonify({"error": "Invalid JSON input"}), 400
+        if not data: return None, (jsonify({"error": "Invalid JSON input"}), 400)
         session_id = data.get('session_id')
         prompt = data.get('prompt')
     else:
-        return jsonify({"error": "Unsupported Content-Type"}), 415
+        return None, (jsonify({"error": "Unsupported Content-Type"}), 415)
 
-    if not session_id or (prompt is None and not media_bytes):
-        return jsonify({"error": "session_id and either prompt or a media file are required"}), 400
-    prompt = prompt or ""
+    if not session_id or (prompt is None and not media):
+        return None, (jsonify({"error": "session_id and either prompt or a media file are required"}), 400)
+    return (session_id, prompt or "", media), None
+
+
+def _prepare_media(media, prompt):
+    """
+    Returns the media keyword arguments for send_chat_message and the prompt to send.
+
+    Media already uploaded for identical content is reused by reference without being
+    reprocessed; otherwise it is downsampled first. Videos reduced to keyframes get a
+    note in the prompt so the model knows the images are frames.
+    """
+    if media is None:
+        return {}, prompt
+    media_key = f"{media.sha256}:{media_preprocessor.signature}"
+    media_references = gemini_api_client.get_media_references(media_key)
+    if media_references is not None:
+        frame_count = len(media_references) if media.family == 'video' and str(getattr(media_references[0], 'mime_type', '')).startswith('image/') else 0
+        media_kwargs = {'media_references': media_references}
+    else:
+        with metrics.phase('media_preprocess'):
+            processed = media_preprocessor.process(media)
+        g.spooled_media.extend(item for item in processed if item is not media)
+        frame_count = len(processed) if media.family == 'video' and processed[0] is not media else 0
+        media_kwargs = {'media_files': [(item.path, item.mime_type) for item in processed], 'media_key': media_key}
+    if frame_count:
+        prompt = f"[the attached images are {frame_count} frames sampled from the user's video.]\n{prompt}".strip()
+    return media_kwargs, prompt
+
+
+@app.teardown_request
+def _cleanup_spooled_media(exc):
+    # For streamed responses this runs once the stream has finished.
+    for media in g.pop('spooled_media', []):
+        media.close()
+
+
+@app.errorhandler(413)
+def _request_too_large(e):
+    return jsonify({"error": f"Request is too large; uploads are limited to {app.config['MAX_CONTENT_LENGTH']} bytes."}), 413
+
+
+def _serialize_history_entries(entries):
+    return [{'role': entry.role, 'parts': [{'text': part.text} for part in entry.parts if hasattr(part, 'text')]} for entry in entries if entry.parts]
+
+
+def _get_owned_session(session_uuid, user_id):
+    """
+    Raises if the session does not belong to the user; otherwise returns its row, with
+    message_count and history_version (see _update_session_summary) defaulted to 0.
+    """
+    with metrics.phase('session_lookup'):
+        session = _session_defaults(chat_store.get_session(session_uuid, user_id), session_uuid)
+    if history_writer is not None:
+        # Count turns still queued for saving, so the cached chat (and seq numbers) line up.
+        session['message_count'] = history_writer.message_count(session_uuid, session['message_count'])
+    return session
+
+
+def _session_defaults(session, session_uuid):
+    if session is None:
+        raise LookupError(f"Chat session {session_uuid} not found.")
+    session['message_count'] = session.get('message_count') or 0
+    session['history_version'] = session.get('history_version') or 0
+    return session
+
+
+def _first_turn_cache_key(session, prompt, media):
+    """Returns the response cache key when this turn may be served from cache, otherwise None."""
+    if response_cache is None or session['message_count'] != 0 or media or not prompt.strip():
+        return None
+    if _cache_bypass_requested():
+        return None
+    return make_cache_key(session.get('appliance_type') or '', prompt)
+
+
+def _cache_bypass_requested():
+    flag = request.args.get('bypass_cache') or request.form.get('bypass_cache')
+    if flag is None and request.is_json:
+        flag = (request.get_json(silent=True) or {}).get('bypass_cache')
+    return str(flag).lower() in ('1', 'true', 'yes')
+
+
+def _first_turn_entries(prompt, response_text):
+    return [{'role': 'user', 'parts': [{'text': prompt}]},
+            {'role': 'model', 'parts': [{'text': response_text}], 'structured': extract_structured(response_text)}]
+
+
+def _new_turn_entries(history):
+    """
+    Serializes a turn's new chat history. Model replies are parsed once, here, into the
+    structured fields (see solutions.extract_structured) saved and returned with them.
+    """
+    entries = _serialize_history_entries(history)
+    for entry in entries:
+        if entry['role'] == 'model':
+            entry['structured'] = extract_structured(''.join(part['text'] for part in entry['parts']))
+    return entries
+
+
+def _reply_structured(new_entries):
+    """The structured fields of a turn's reply, for the top level of the API response."""
+    return new_entries[-1].get('structured') if new_entries else None
+
+
+def _load_session_messages(session_uuid):
+    with metrics.phase('history_read'):
+        messages = chat_store.load_messages(session_uuid)
+    return history_writer.messages(session_uuid, messages) if history_writer is not None else messages
+
+
+def _resume_chat(session_uuid, history_version, session=None, prompt=None):
+    """
+    Returns (gemini_chat, db_history), reusing a cached ChatSession when it is at `history_version`.
+
+    A new ChatSession for `session` starts with notes on similar solved sessions, matched
+    against its history and `prompt` (see _solution_context).
+    """
+    cached = chat_session_cache.checkout(session_uuid, history_version)
+    if cached is not None:
+        return cached
+    db_history = _load_session_messages(session_uuid)
+    context = _solution_context(session_uuid, session, db_history, prompt)
+    return gemini_api_client.start_chat_session(history=db_history, context=context), db_history
+
+
+def _user_texts(entries):
+    return [part['text'] for entry in entries if entry.get('role') == 'user'
+            for part in entry.get('parts') or [] if isinstance(part, dict) and part.get('text')]
+
+
+def _solution_context(session_uuid, session, db_history, prompt):
+    """Returns reference notes from solved sessions like this one, or None (also once it is solved itself)."""
+    if solution_index is None or session is None:
+        return None
+    try:
+        if session_uuid in solution_index:
+            return None
+        with metrics.phase('solution_lookup'):
+            matches = solution_index.search(session.get('appliance_type'), _user_texts(db_history) + [prompt or ''],
+                                            limit=SOLUTION_CONTEXT_MATCHES)
+    except Exception as e:
+        logging.warning(f"SOLUTION_LOG: Lookup failed for session {session_uuid}: {e}")
+        return None
+    if matches:
+        logging.info(f"SOLUTION_LOG: Session {session_uuid} starts with {len(matches)} solved session(s) as context "
+                     f"(best score {matches[0]['score']}).")
+    return format_references(matches, SOLUTION_CONTEXT_MAX_CHARS)
+
+
+def _remember_solution(session_uuid, session, history):
+    """Indexes the session if the last answer in `history` is a final solution."""
+    structured = history[-1].get('structured') if solution_index is not None and history else None
+    if not structured or not structured['is_solution']:
+        return
+    try:
+        solution_index.add(session_uuid, session.get('appliance_type'), _user_texts(history), structured['sections'])
+    except Exception as e:
+        logging.warning(f"SOLUTION_LOG: Could not index the solution of session {session_uuid}: {e}")
+
+
+def _is_media_part(part):
+    """True for inline media and File API references (as dicts, protos or uploaded file handles)."""
+    if isinstance(part, dict):
+        return 'inline_data' in part or 'file_data' in part
+    return bool(getattr(part, 'inline_data', None) or getattr(part, 'file_data', None)) or not hasattr(part, 'text')
+
+
+def _release_chat(session_uuid, gemini_chat, history):
+    # A chat rebuilt from the store has only the text of earlier turns. Drop this turn's media
+    # the same way, so a cache hit does not resend it every turn and hits and misses send the
+    # model the same history.
+    if any(_is_media_part(part) for entry in gemini_chat.history for part in entry.parts):
+        gemini_chat.history = _serialize_history_entries(gemini_chat.history)
+    # Once a cached chat outgrows the token budget, drop it so the next turn rebuilds a windowed history.
+    if gemini_api_client.fits_history_budget(_serialize_history_entries(gemini_chat.history)):
+        chat_session_cache.put(session_uuid, len(history), gemini_chat, history)
+
+
+def _append_session_history(session_uuid, db_history, new_entries, session, usage=None):
+    """
+    Inserts only the new turns and refreshes the session's summary columns.
+
+    The unique (session_uuid, seq) key lets only one request save a turn after `db_history`;
+    any other gets HistoryConflictError. `usage` (see _turn_usage) is stored on the turn's
+    model message and added to the session's token totals. With HISTORY_WRITE_BEHIND on,
+    the rows are queued on `history_writer` instead and saved in the background. A turn
+    that ends in a final solution is added to `solution_index`.
+    """
+    if not new_entries:
+        return
+    rows = _history_rows(session_uuid, db_history, new_entries, usage)
+    if history_writer is None or not history_writer.enqueue(session_uuid, rows):
+        with metrics.phase('history_write'):
+            chat_store.append_messages(rows)
+            _update_session_summary(session_uuid, rows, session, usage)
+    _remember_solution(session_uuid, session, db_history + new_entries)
+
+
+def _update_session_summary(session_uuid, rows, session, usage):
+    """
+    Folds saved rows into the session's summary columns.
+
+    Each update is a compare-and-swap on history_version: it only applies if the version
+    `session` was read at is still current, and bumps it. When another writer got there
+    first, the session is re-read and the turn folded into the fresh totals instead, so
+    concurrent turns never overwrite each other's counts. `session` may be None to read it
+    first.
+
+    Returns:
+        bool: False if every attempt lost to another writer.
+    """
+    if session is None:
+        session = _session_defaults(chat_store.get_session(session_uuid), session_uuid)
+    for _ in range(SUMMARY_UPDATE_ATTEMPTS):
+        summary = _session_summary(session_uuid, rows, session, usage)
+        if chat_store.update_session_summary(session_uuid, session['history_version'], summary):
+            return True
+        session = _session_defaults(chat_store.get_session(session_uuid), session_uuid)
+    # The messages are saved; the next turn's summary update picks up message_count again.
+    logging.warning(f"HISTORY_LOG: Gave up updating the summary of session {session_uuid} after {SUMMARY_UPDATE_ATTEMPTS} conflicting writes.")
+    return False
+
+
+def _flush_session_summary(session_uuid, rows):
+    # history_writer's summary callback: `rows` may hold several queued turns.
+    return _update_session_summary(session_uuid, rows, None, _rows_usage(rows))
+
+
+def _rows_usage(rows):
+    """Sums the token usage stored on chat_message rows, in _session_summary's `usage` shape."""
+    prompts = [row['prompt_tokens'] for row in rows if row.get('prompt_tokens') is not None]
+    if not prompts:
+        return None
+    return {
+        'prompt_tokens': sum(prompts),
+        'output_tokens': sum(row.get('output_tokens') or 0 for row in rows),
+        'max_prompt_tokens': max(prompts),
+    }
+
+
+def _history_rows(session_uuid, db_history, new_entries, usage):
+    """Builds the chat_message rows for a new turn; `usage` goes on its model message, with its structured fields."""
+    start_seq = len(db_history)
+    rows = [{'session_uuid': session_uuid, 'seq': start_seq + i, 'role': entry['role'], 'parts': entry['parts']} for i, entry in enumerate(new_entries)]
+    for row, entry in zip(rows, new_entries):
+        if entry.get('structured') is not None:
+            row['structured'] = entry['structured']
+    if usage:
+        model_rows = [row for row in rows if row['role'] == 'model']
+        if model_rows:
+            model_rows[-1].update(usage)
+    return rows
+
+
+def _session_summary(session_uuid, rows, session, usage):
+    """Builds the chat_session update that folds the saved `rows` into `session`'s summary."""
+    summary = {
+        'history_version': session['history_version'] + 1,
+        # A racing writer may already have counted later turns.
+        'message_count': max(session['message_count'], rows[-1]['seq'] + 1),
+        'last_activity': datetime.now(timezone.utc).isoformat(),
+    }
+    if not session.get('preview_text'):
+        preview = _first_model_text(rows)
+        if preview:
+            summary['preview_text'] = preview[:PREVIEW_MAX_CHARS]
+    if usage:
+        summary['prompt_tokens'] = (session.get('prompt_tokens') or 0) + usage['prompt_tokens']
+        summary['output_tokens'] = (session.get('output_tokens') or 0) + usage['output_tokens']
+        summary['max_prompt_tokens'] = max(session.get('max_prompt_tokens') or 0,
+                                           usage.get('max_prompt_tokens', usage['prompt_tokens']))
+        total = summary['prompt_tokens'] + summary['output_tokens']
+        if total >= RUNAWAY_SESSION_TOKENS > total - usage['prompt_tokens'] - usage['output_tokens']:
+            logging.warning(f"USAGE_LOG: Session {session_uuid} crossed {RUNAWAY_SESSION_TOKENS} tokens "
+                            f"({summary['message_count']} messages, largest prompt {summary['max_prompt_tokens']} tokens).")
+    return summary
+
+
+def _turn_usage(response):
+    """Returns the token usage of a model response (or a stream's final chunk) for storage, or None."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return None
+    return {
+        'prompt_tokens': getattr(usage, 'prompt_token_count', 0) or 0,
+        'output_tokens': getattr(usage, 'candidates_token_count', 0) or 0,
+        'model_name': getattr(gemini_api_client, 'model_name', None),
+    }
+
+
+def _estimate_cost_usd(prompt_tokens, output_tokens):
+    return round(((prompt_tokens or 0) * PROMPT_USD_PER_MTOK + (output_tokens or 0) * OUTPUT_USD_PER_MTOK) / 1_000_000, 6)
+
+
+def _first_model_text(entries):
+    for entry in entries:
+        if entry['role'] == 'model' and entry['parts'] and entry['parts'][0].get('text'):
+            return entry['parts'][0]['text']
+    return None
+
+
+def _using_dummy_api():
+    return not gemini_api_client or (hasattr(gemini_api_client, 'api_key') and gemini_api_client.api_key == "DUMMY_KEY_IN_USE")
+
+
+def _dummy_client():
+    """
+    Returns the client to answer with instead of Gemini, or None: the dummy itself when
+    Gemini failed to initialize or, with GEMINI_FALLBACK_TO_DUMMY set, a dummy while the
+    circuit breaker is open.
+    """
+    global _fallback_client
+    if _using_dummy_api():
+        return gemini_api_client
+    breaker = getattr(gemini_api_client, 'breaker', None)
+    if GEMINI_FALLBACK_TO_DUMMY and breaker is not None and breaker.retry_after():
+        if _fallback_client is None:
+            _fallback_client = DummyGeminiAPI(model_name="dummy-model-circuit-open")
+        return _fallback_client
+    return None
+
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+def _turn_key(user_id, session_id, prompt, media, idempotency_key):
+    """Returns (key, ttl) identifying a chat turn for deduplication; see turn_flights."""
+    if idempotency_key:
+        material, ttl = f"key\x00{idempotency_key}", IDEMPOTENCY_KEY_TTL_SECONDS
+    else:
+        material, ttl = f"turn\x00{prompt}\x00{media.sha256 if media else ''}", DUPLICATE_TURN_WINDOW_SECONDS
+    digest = hashlib.sha256(f"{user_id}\x00{session_id}\x00{material}".encode('utf-8')).hexdigest()
+    return digest, ttl
+
+
+def _replay_filter(idempotency_key, session):
+    # Without a key, an identical prompt after other turns is a new question, not a retry.
+    if idempotency_key:
+        return None
+    return lambda payload: len(payload['history']) == session['message_count']
+
+
+def _claim_turn(key, idempotency_key, session):
+    """
+    Returns ('done', payload) to replay a finished turn, ('lead', flight) when the caller
+    should run the turn (and then pass its payload, or None, to turn_flights.finish), or
+    ('busy', None) when an identical turn is still running after DUPLICATE_TURN_WAIT_SECONDS.
+    """
+    accept = _replay_filter(idempotency_key, session)
+    while True:
+        state, value = turn_flights.claim(key, accept)
+        if state != 'wait':
+            return state, value
+        with metrics.phase('duplicate_wait'):
+            finished, payload = value.wait(DUPLICATE_TURN_WAIT_SECONDS)
+        if not finished:
+            return 'busy', None
+        if payload is not None:
+            return 'done', payload
+        # The other request failed; claim again, so one of the waiters runs the turn itself.
+
+
+DUPLICATE_TURN_BUSY = {"error": "An identical message is still being processed. Please wait for it to finish."}
+SESSION_TURN_BUSY = {"error": "Earlier messages in this conversation are still being processed. Please try again shortly.", "reason": "session_busy"}
+HISTORY_CONFLICT = {"error": "This conversation was changed by another request. Please reload it and send your message again.", "reason": "history_conflict"}
+REPLAYED_HEADERS = {'Idempotent-Replayed': 'true'}
+
+
+@app.route('/api/chat_message', methods=['POST'])
+@supabase_login_required
+def api_chat_message():
+    user = g.user
+    try:
+        chat_rate_limiter.take(str(user.id))
+    except AdmissionRejected as e:
+        return _unavailable_response(e)
+
+    parsed, error_response = _parse_chat_request()
+    if error_response: return error_response
+    session_id, prompt, media = parsed
 
     try:
-        session_res = supabase.table('chat_session').select('history').eq('session_uuid', session_id).eq('user_id', str(user.id)).single().execute()
-        db_history = session_res.data.get('history', [])
+        with session_turns.turn(session_id, SESSION_TURN_WAIT_SECONDS):
+            return _chat_message_in_turn(user, session_id, prompt, media)
+    except SessionBusyError:
+        return jsonify(SESSION_TURN_BUSY), 409
+
+
+def _chat_message_in_turn(user, session_id, prompt, media):
+    """The rest of /api/chat_message, run while holding the session's turn (see session_turns)."""
+    # Read only now, so the history version reflects the turns that ran before this one.
+    try:
+        session = _get_owned_session(session_id, str(user.id))
     except Exception:
         return jsonify({"error": "Chat session not found or permission denied."}), 404
 
-    if not gemini_api_client or (hasattr(gemini_api_client, 'api_key') and gemini_api_client.api_key == "DUMMY_KEY_IN_USE"):
-        dummy_chat = gemini_api_client.start_chat_session()
-        response = gemini_api_client.send_chat_message(dummy_chat, prompt)
+    dummy_client = _dummy_client()
+    if dummy_client:
+        dummy_chat = dummy_client.start_chat_session()
+        response = dummy_client.send_chat_message(dummy_chat, prompt)
         return jsonify({"generatedText": response.text, "history": [], "error": "Using DUMMY API."})
 
+    idempotency_key = request.headers.get('Idempotency-Key')
+    turn_key, turn_ttl = _turn_key(str(user.id), session_id, prompt, media, idempotency_key)
+    state, value = _claim_turn(turn_key, idempotency_key, session)
+    if state == 'done':
+        return jsonify(value), 200, REPLAYED_HEADERS
+    if state == 'busy':
+        return jsonify(DUPLICATE_TURN_BUSY), 409
+
+    payload = None
     try:
-        gemini_chat = gemini_api_client.start_chat_session(history=db_history)
-        response = gemini_api_client.send_chat_message(gemini_chat, prompt, media_bytes=media_bytes, media_mime_type=media_mime_type)
+        response = app.make_response(_chat_turn(session_id, session, prompt, media))
+        if response.status_code == 200:
+            payload = response.get_json()
+        return response
+    finally:
+        turn_flights.finish(turn_key, value, payload, turn_ttl)
+
 
-        history_list = [{'role': entry.role, 'parts': [{'text': part.text} for part in entry.parts if hasattr(part, 'text')]} for entry in gemini_chat.history if entry.parts]
-        update_res = supabase.table('chat_session').update({'history': history_list}).eq('session_uuid', session_id).execute()
+def _chat_turn(session_id, session, prompt, media):
+    """Runs one turn of /api/chat_message and returns the response."""
+    cache_key = _first_turn_cache_key(session, prompt, media)
+    if cache_key:
+        with metrics.phase('response_cache'):
+            cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            try:
+                new_entries = _first_turn_entries(prompt, cached_text)
+                _append_session_history(session_id, [], new_entries, session)
+                return jsonify({"generatedText": cached_text, "history": new_entries, "structured": _reply_structured(new_entries), "cached": True})
+            except HistoryConflictError:
+                return jsonify(HISTORY_CONFLICT), 409
+            except Exception as e:
+                logging.error(f"Error saving cached first turn for session {session_id}: {e}", exc_info=True)
+                return jsonify({"error": f"An error occurred with the AI: {str(e)}"}), 500
+
+    try:
+        with llm_admission.slot():
+            gemini_chat, db_history = _resume_chat(session_id, session['message_count'], session, prompt)
+            # The chat may hold a windowed (summarized) history, so slice by its own length.
+            chat_start = len(gemini_chat.history)
+            media_kwargs, model_prompt = _prepare_media(media, prompt)
+            with llm_call_in_flight():
+                response = gemini_api_client.send_chat_message(gemini_chat, model_prompt, **media_kwargs)
 
-        if not update_res.data: raise Exception("Failed to update session history.")
-        return jsonify({"generatedText": response.text, "history": update_res.data[0]['history']})
+        new_entries = _new_turn_entries(gemini_chat.history[chat_start:])
+        _append_session_history(session_id, db_history, new_entries, session, usage=_turn_usage(response))
+        _release_chat(session_id, gemini_chat, db_history + new_entries)
+        if cache_key and response.text:
+            response_cache.set(cache_key, response.text)
+        return jsonify({"generatedText": response.text, "history": db_history + new_entries,
+                        "structured": _reply_structured(new_entries)})
+    except (AdmissionRejected, CircuitOpenError) as e:
+        return _unavailable_response(e)
+    except HistoryConflictError as e:
+        logging.warning(f"HISTORY_LOG: {e}")
+        return jsonify(HISTORY_CONFLICT), 409
     except Exception as e:
         logging.error(f"Error in chat message for session {session_id}: {e}", exc_info=True)
         return jsonify({"error": f"An error occurred with the AI: {str(e)}"}), 500
 
+
+@app.route('/api/chat_message/stream', methods=['POST'])
+@supabase_login_required
+def api_chat_message_stream():
+    """
+    Server-Sent Events variant of /api/chat_message.
+
+    Emits `chunk` events ({"text": ...}) as the model generates, then a single `done`
+    event with the same payload as the blocking endpoint once the history is saved,
+    or an `error` event if generation or persistence fails mid-stream.
+    """
+    user = g.user
+    try:
+        chat_rate_limiter.take(str(user.id))
+    except AdmissionRejected as e:
+        return _unavailable_response(e)
+
+    parsed, error_response = _parse_chat_request()
+    if error_response: return error_response
+    session_id, prompt, media = parsed
+
+    try:
+        turn = session_turns.acquire(session_id, SESSION_TURN_WAIT_SECONDS)
+    except SessionBusyError:
+        return jsonify(SESSION_TURN_BUSY), 409
+    end_turn = functools.partial(session_turns.release, session_id, turn)
+    try:
+        streamed = app.make_response(_chat_message_stream_in_turn(user, session_id, prompt, media))
+    except BaseException:
+        end_turn()
+        raise
+    # The turn lasts until the stream has saved its history, or the client went away.
+    if streamed.is_streamed:
+        streamed.call_on_close(end_turn)
+    else:
+        end_turn()
+    return streamed
+
+
+def _chat_message_stream_in_turn(user, session_id, prompt, media):
+    """The rest of /api/chat_message/stream, run while holding the session's turn."""
+    try:
+        session = _get_owned_session(session_id, str(user.id))
+    except Exception:
+        return jsonify({"error": "Chat session not found or permission denied."}), 404
+
+    sse_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    dummy_client = _dummy_client()
+    if dummy_client:
+        dummy_chat = dummy_client.start_chat_session()
+        response = dummy_client.send_chat_message(dummy_chat, prompt)
+        def generate_dummy():
+            yield _sse_event('chunk', {"text": response.text})
+            yield _sse_event('done', {"generatedText": response.text, "history": [], "error": "Using DUMMY API."})
+        return Response(generate_dummy(), mimetype='text/event-stream', headers=sse_headers)
+
+    idempotency_key = request.headers.get('Idempotency-Key')
+    turn_key, turn_ttl = _turn_key(str(user.id), session_id, prompt, media, idempotency_key)
+    state, value = _claim_turn(turn_key, idempotency_key, session)
+    if state == 'done':
+        def generate_replay():
+            yield _sse_event('chunk', {"text": value['generatedText']})
+            yield _sse_event('done', value)
+        return Response(generate_replay(), mimetype='text/event-stream', headers={**sse_headers, **REPLAYED_HEADERS})
+    if state == 'busy':
+        return jsonify(DUPLICATE_TURN_BUSY), 409
+
+    publish = functools.partial(turn_flights.finish, turn_key, value, ttl=turn_ttl)
+    try:
+        streamed = app.make_response(_chat_turn_stream(session_id, session, prompt, media, sse_headers, publish))
+    except BaseException:
+        publish(None)
+        raise
+    if streamed.is_streamed:
+        # A no-op if the stream already published its payload.
+        streamed.call_on_close(lambda: publish(None))
+    else:
+        publish(None)
+    return streamed
+
+
+def _chat_turn_stream(session_id, session, prompt, media, sse_headers, publish):
+    """Runs one turn of /api/chat_message/stream; the `done` payload is passed to `publish`."""
+    cache_key = _first_turn_cache_key(session, prompt, media)
+    if cache_key:
+        with metrics.phase('response_cache'):
+            cached_text = response_cache.get(cache_key)
+        if cached_text is not None:
+            def generate_cached():
+                try:
+                    new_entries = _first_turn_entries(prompt, cached_text)
+                    _append_session_history(session_id, [], new_entries, session)
+                    payload = {"generatedText": cached_text, "history": new_entries, "structured": _reply_structured(new_entries), "cached": True}
+                    publish(payload)
+                    yield _sse_event('chunk', {"text": cached_text})
+                    yield _sse_event('done', payload)
+                except HistoryConflictError:
+                    yield _sse_event('error', HISTORY_CONFLICT)
+                except Exception as e:
+                    logging.error(f"Error saving cached first turn for session {session_id}: {e}", exc_info=True)
+                    yield _sse_event('error', {"error": f"An error occurred with the AI: {str(e)}"})
+            return Response(stream_with_context(generate_cached()), mimetype='text/event-stream', headers=sse_headers)
+
+    # The slot is held, and the call counts as in flight, until the stream is consumed or the
+    # client goes away; ExitStack.close() is idempotent, so every exit path can simply close it.
+    llm_call = contextlib.ExitStack()
+    try:
+        llm_call.enter_context(llm_admission.slot())
+    except AdmissionRejected as e:
+        return _unavailable_response(e)
+    llm_call.enter_context(llm_call_in_flight())
+    try:
+        gemini_chat, db_history = _resume_chat(session_id, session['message_count'], session, prompt)
+        chat_start = len(gemini_chat.history)
+        media_kwargs, model_prompt = _prepare_media(media, prompt)
+        response = gemini_api_client.send_chat_message(gemini_chat, model_prompt, stream=True, **media_kwargs)
+    except CircuitOpenError as e:
+        llm_call.close()
+        return _unavailable_response(e)
+    except Exception as e:
+        llm_call.close()
+        logging.error(f"Error starting streamed chat message for session {session_id}: {e}", exc_info=True)
+        return jsonify({"error": f"An error occurred with the AI: {str(e)}"}), 500
+
+    timer = g.request_timer
+
+    def generate():
+        text_chunks = []
+        last_chunk = None
+        stream_started = time.perf_counter()
+        try:
+            for chunk in response:
+                last_chunk = chunk
+                if not chunk.parts:
+                    continue
+                if not text_chunks:
+                    metrics.record_phase('model_first_chunk', time.perf_counter() - stream_started, timer)
+                text_chunks.append(chunk.text)
+                yield _sse_event('chunk', {"text": chunk.text})
+            llm_call.close()
+            metrics.record_phase('model_stream', time.perf_counter() - stream_started, timer)
+            # Usage metadata is complete on the final chunk.
+            metrics.record_token_usage(last_chunk)
+
+            # gemini_chat.history only includes the new turn once the stream is fully consumed.
+            new_entries = _new_turn_entries(gemini_chat.history[chat_start:])
+            _append_session_history(session_id, db_history, new_entries, session, usage=_turn_usage(last_chunk))
+            _release_chat(session_id, gemini_chat, db_history + new_entries)
+            generated_text = "".join(text_chunks)
+            if cache_key and generated_text:
+                response_cache.set(cache_key, generated_text)
+            payload = {"generatedText": generated_text, "history": db_history + new_entries,
+                       "structured": _reply_structured(new_entries)}
+            publish(payload)
+            yield _sse_event('done', payload)
+        except HistoryConflictError as e:
+            logging.warning(f"HISTORY_LOG: {e}")
+            yield _sse_event('error', HISTORY_CONFLICT)
+        except Exception as e:
+            logging.error(f"Error streaming chat message for session {session_id}: {e}", exc_info=True)
+            metrics.record_error('stream', timer)
+            yield _sse_event('error', {"error": f"An error occurred with the AI: {str(e)}"})
+        finally:
+            llm_call.close()
+
+    streamed = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=sse_headers)
+    streamed.call_on_close(llm_call.close)
+    return streamed
+
+startup_timings['import_ms'] = round((time.perf_counter() - _STARTUP_BEGAN) * 1000, 1)
+
 if __name__ == '__main__':
-    if not os.path.exists('templates'):
-        os.makedirs('templates')
-    source_html_path = 'API Interface.html'
-    dest_html_path = os.path.join('templates', 'API Interface.html')
-    if os.path.exists(source_html_path) and not os.path.exists(dest_html_path):
-        import shutil
-        shutil.move(source_html_path, dest_html_path)
-    
     logging.info("Starting Flask app...")
     port = int(os.environ.get('PORT', 5000))
-    app.run(debug=False, host='0.0.0.0', port=port) 
\ No newline at end of file
+    app.run(debug=False, host='0.0.0.0', port=port)
@@ -0,0 +1,515 @@
+"""
+ASGI entry point: `uvicorn asgi:app`.
+
+The chat endpoints are served natively async (the chat store's async methods, async
+Gemini calls, bounded by a concurrency semaphore), so a waiting diagnosis holds a
+coroutine instead of an OS thread. Every other route is delegated to the Flask app.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import mimetypes
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.utils import secure_filename
+
+import app as flask_app
+import metrics
+from admission import AdmissionRejected, AsyncConcurrencyLimiter
+from resilience import CircuitOpenError
+from session_queue import AsyncSessionQueue, SessionBusyError
+from media import spool_upload, MediaTooLargeError
+from response_cache import make_cache_key
+from wsgi_bridge import PooledWsgiToAsgi
+
+ASYNC_MAX_CONCURRENT_LLM_CALLS = int(os.environ.get('ASYNC_MAX_CONCURRENT_LLM_CALLS', 256))
+ASYNC_MAX_QUEUED_LLM_CALLS = int(os.environ.get('ASYNC_MAX_QUEUED_LLM_CALLS', 1024))
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get('SHUTDOWN_DRAIN_SECONDS', 120))
+# Threads for the routes still served by the Flask app (login, session list, history, search,
+# /readyz, /metrics); as many as a threaded worker has (GUNICORN_THREADS) unless set.
+WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', os.environ.get('GUNICORN_THREADS', 8)))
+
+llm_admission = AsyncConcurrencyLimiter(ASYNC_MAX_CONCURRENT_LLM_CALLS, ASYNC_MAX_QUEUED_LLM_CALLS,
+                                       flask_app.LLM_MAX_QUEUE_WAIT_SECONDS)
+session_turns = AsyncSessionQueue()
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+
+async def _authenticate(request):
+    """Returns (user, None) or (None, error_response)."""
+    if not flask_app.clients_initialized.is_set():
+        # Clients are still being created in the background; see app.init_clients.
+        if not await asyncio.to_thread(flask_app.clients_initialized.wait, flask_app.CLIENT_INIT_TIMEOUT_SECONDS):
+            return None, JSONResponse({"error": "The server is still starting up. Please retry shortly."},
+                                      status_code=503, headers={'Retry-After': '1'})
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None, JSONResponse({"error": "Authorization token is missing or invalid."}, status_code=401)
+    try:
+        # Cache hits are instant; a miss may fetch JWKS or call Supabase, so keep it off the loop.
+        with metrics.phase('auth'):
+            user = await asyncio.to_thread(flask_app.token_verifier.verify, auth_header.split(' ')[1])
+    except Exception as e:
+        logging.error(f"Token validation error: {e}")
+        return None, JSONResponse({"error": "Token validation failed.", "details": str(e)}, status_code=401)
+    return user, None
+
+
+def _unavailable_response(error):
+    body, status, headers = flask_app._unavailable_error(error)
+    return JSONResponse(body, status_code=status, headers=headers)
+
+
+async def _parse_chat_request(request, spooled_media):
+    """Returns ((session_id, prompt, media), None) or (None, error_response); see app._parse_chat_request."""
+    content_type = request.headers.get('content-type', '')
+    media = None
+    if content_type.startswith('multipart/form-data'):
+        if int(request.headers.get('content-length') or 0) > flask_app.app.config['MAX_CONTENT_LENGTH']:
+            return None, JSONResponse({"error": f"Request is too large; uploads are limited to {flask_app.app.config['MAX_CONTENT_LENGTH']} bytes."}, status_code=413)
+        form = await request.form()
+        session_id = form.get('session_id')
+        prompt = form.get('prompt')
+        request.state.bypass_cache = form.get('bypass_cache')
+        media_file = form.get('media_file')
+        if media_file is not None and getattr(media_file, 'filename', None):
+            filename = secure_filename(media_file.filename)
+            media_mime_type = media_file.content_type or mimetypes.guess_type(filename)[0]
+            try:
+                media = await asyncio.to_thread(spool_upload, media_file.file, media_mime_type, flask_app.MEDIA_SIZE_LIMITS,
+                                                filename=filename, spool_dir=flask_app.MEDIA_SPOOL_DIR)
+            except MediaTooLargeError as e:
+                return None, JSONResponse({"error": str(e)}, status_code=413)
+            spooled_media.append(media)
+    elif content_type.startswith('application/json'):
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data: return None, JSONResponse({"error": "Invalid JSON input"}, status_code=400)
+        session_id = data.get('session_id')
+        prompt = data.get('prompt')
+        request.state.bypass_cache = data.get('bypass_cache')
+    else:
+        return None, JSONResponse({"error": "Unsupported Content-Type"}, status_code=415)
+
+    if not session_id or (prompt is None and not media):
+        return None, JSONResponse({"error": "session_id and either prompt or a media file are required"}, status_code=400)
+    return (session_id, prompt or "", media), None
+
+
+async def _get_owned_session(session_uuid, user_id):
+    with metrics.phase('session_lookup'):
+        session = flask_app._session_defaults(await flask_app.chat_store.get_session_async(session_uuid, user_id), session_uuid)
+    if flask_app.history_writer is not None:
+        session['message_count'] = flask_app.history_writer.message_count(session_uuid, session['message_count'])
+    return session
+
+
+async def _resume_chat(session_uuid, history_version, session=None, prompt=None):
+    cached = flask_app.chat_session_cache.checkout(session_uuid, history_version)
+    if cached is not None:
+        return cached
+    with metrics.phase('history_read'):
+        db_history = await flask_app.chat_store.load_messages_async(session_uuid)
+    if flask_app.history_writer is not None:
+        db_history = flask_app.history_writer.messages(session_uuid, db_history)
+    context = await asyncio.to_thread(flask_app._solution_context, session_uuid, session, db_history, prompt)
+    return await flask_app.gemini_api_client.start_chat_session_async(history=db_history, context=context), db_history
+
+
+async def _append_session_history(session_uuid, db_history, new_entries, session, usage=None):
+    """Async counterpart of app._append_session_history."""
+    if not new_entries:
+        return
+    rows = flask_app._history_rows(session_uuid, db_history, new_entries, usage)
+    if flask_app.history_writer is None or not flask_app.history_writer.enqueue(session_uuid, rows):
+        with metrics.phase('history_write'):
+            await flask_app.chat_store.append_messages_async(rows)
+            await _update_session_summary(session_uuid, rows, session, usage)
+    if flask_app.solution_index is not None:
+        await asyncio.to_thread(flask_app._remember_solution, session_uuid, session, db_history + new_entries)
+
+
+async def _update_session_summary(session_uuid, rows, session, usage):
+    """Async counterpart of app._update_session_summary (for a `session` already read)."""
+    for _ in range(flask_app.SUMMARY_UPDATE_ATTEMPTS):
+        summary = flask_app._session_summary(session_uuid, rows, session, usage)
+        if await flask_app.chat_store.update_session_summary_async(session_uuid, session['history_version'], summary):
+            return
+        session = flask_app._session_defaults(await flask_app.chat_store.get_session_async(session_uuid), session_uuid)
+    logging.warning(f"HISTORY_LOG: Gave up updating the summary of session {session_uuid} after {flask_app.SUMMARY_UPDATE_ATTEMPTS} conflicting writes.")
+
+
+async def _prepare_media(media, prompt, spooled_media):
+    """Async counterpart of app._prepare_media; preprocessing runs in a worker thread."""
+    if media is None:
+        return {}, prompt
+    media_key = f"{media.sha256}:{flask_app.media_preprocessor.signature}"
+    media_references = flask_app.gemini_api_client.get_media_references(media_key)
+    if media_references is not None:
+        frame_count = len(media_references) if media.family == 'video' and str(getattr(media_references[0], 'mime_type', '')).startswith('image/') else 0
+        media_kwargs = {'media_references': media_references}
+    else:
+        with metrics.phase('media_preprocess'):
+            processed = await asyncio.to_thread(flask_app.media_preprocessor.process, media)
+        spooled_media.extend(item for item in processed if item is not media)
+        frame_count = len(processed) if media.family == 'video' and processed[0] is not media else 0
+        media_kwargs = {'media_files': [(item.path, item.mime_type) for item in processed], 'media_key': media_key}
+    if frame_count:
+        prompt = f"[the attached images are {frame_count} frames sampled from the user's video.]\n{prompt}".strip()
+    return media_kwargs, prompt
+
+
+def _first_turn_cache_key(request, session, prompt, media):
+    if flask_app.response_cache is None or session['message_count'] != 0 or media or not prompt.strip():
+        return None
+    flag = request.query_params.get('bypass_cache') or getattr(request.state, 'bypass_cache', None)
+    if str(flag).lower() in ('1', 'true', 'yes'):
+        return None
+    return make_cache_key(session.get('appliance_type') or '', prompt)
+
+
+async def _claim_turn(key, idempotency_key, session):
+    """Async counterpart of app._claim_turn."""
+    accept = flask_app._replay_filter(idempotency_key, session)
+    while True:
+        state, value = flask_app.turn_flights.claim(key, accept)
+        if state != 'wait':
+            return state, value
+        with metrics.phase('duplicate_wait'):
+            finished, payload = await value.wait_async(flask_app.DUPLICATE_TURN_WAIT_SECONDS)
+        if not finished:
+            return 'busy', None
+        if payload is not None:
+            return 'done', payload
+
+
+def _close_media(spooled_media):
+    for media in spooled_media:
+        media.close()
+
+
+def _finish_request(request, timer, response):
+    # Mirrors app._record_request_metrics for the natively served routes.
+    response.headers['Server-Timing'] = timer.server_timing()
+    streamed = isinstance(response, StreamingResponse)
+    metrics.record_request(timer.endpoint, request.method, response.status_code, time.perf_counter() - timer.started,
+                           request_bytes=int(request.headers.get('content-length') or 0) or None,
+                           response_bytes=None if streamed else len(response.body))
+    return response
+
+
+async def api_chat_message(request):
+    timer = metrics.start_request(request.url.path)
+    spooled_media = []
+    try:
+        return _finish_request(request, timer, await _chat_message(request, spooled_media))
+    finally:
+        _close_media(spooled_media)
+
+
+async def _chat_message(request, spooled_media):
+    user, error_response = await _authenticate(request)
+    if error_response: return error_response
+    try:
+        flask_app.chat_rate_limiter.take(str(user.id))
+    except AdmissionRejected as e:
+        return _unavailable_response(e)
+    parsed, error_response = await _parse_chat_request(request, spooled_media)
+    if error_response: return error_response
+    session_id, prompt, media = parsed
+
+    try:
+        turn = await session_turns.acquire(session_id, flask_app.SESSION_TURN_WAIT_SECONDS)
+    except SessionBusyError:
+        return JSONResponse(flask_app.SESSION_TURN_BUSY, status_code=409)
+    try:
+        return await _chat_message_in_turn(request, spooled_media, user, session_id, prompt, media)
+    finally:
+        session_turns.release(session_id, turn)
+
+
+async def _chat_message_in_turn(request, spooled_media, user, session_id, prompt, media):
+    try:
+        session = await _get_owned_session(session_id, str(user.id))
+    except Exception:
+        return JSONResponse({"error": "Chat session not found or permission denied."}, status_code=404)
+
+    dummy_client = flask_app._dummy_client()
+    if dummy_client:
+        dummy_chat = dummy_client.start_chat_session()
+        response = dummy_client.send_chat_message(dummy_chat, prompt)
+        return JSONResponse({"generatedText": response.text, "history": [], "error": "Using DUMMY API."})
+
+    idempotency_key = request.headers.get('Idempotency-Key')
+    turn_key, turn_ttl = flask_app._turn_key(str(user.id), session_id, prompt, media, idempotency_key)
+    state, value = await _claim_turn(turn_key, idempotency_key, session)
+    if state == 'done':
+        return JSONResponse(value, headers=flask_app.REPLAYED_HEADERS)
+    if state == 'busy':
+        return JSONResponse(flask_app.DUPLICATE_TURN_BUSY, status_code=409)
+
+    payload = None
+    try:
+        response = await _chat_turn(request, spooled_media, session_id, session, prompt, media)
+        if response.status_code == 200:
+            payload = json.loads(response.body)
+        return response
+    finally:
+        flask_app.turn_flights.finish(turn_key, value, payload, turn_ttl)
+
+
+async def _chat_turn(request, spooled_media, session_id, session, prompt, media):
+    gemini_api_client = flask_app.gemini_api_client
+    cache_key = _first_turn_cache_key(request, session, prompt, media)
+    if cache_key:
+        with metrics.phase('response_cache'):
+            cached_text = flask_app.response_cache.get(cache_key)
+        if cached_text is not None:
+            try:
+                new_entries = flask_app._first_turn_entries(prompt, cached_text)
+                await _append_session_history(session_id, [], new_entries, session)
+                return JSONResponse({"generatedText": cached_text, "history": new_entries, "structured": flask_app._reply_structured(new_entries), "cached": True})
+            except flask_app.HistoryConflictError:
+                return JSONResponse(flask_app.HISTORY_CONFLICT, status_code=409)
+            except Exception as e:
+                logging.error(f"Error saving cached first turn for session {session_id}: {e}", exc_info=True)
+                return JSONResponse({"error": f"An error occurred with the AI: {str(e)}"}, status_code=500)
+
+    try:
+        async with llm_admission.slot():
+            gemini_chat, db_history = await _resume_chat(session_id, session['message_count'], session, prompt)
+            chat_start = len(gemini_chat.history)
+            media_kwargs, model_prompt = await _prepare_media(media, prompt, spooled_media)
+            with flask_app.llm_call_in_flight():
+                response = await gemini_api_client.send_chat_message_async(gemini_chat, model_prompt, **media_kwargs)
+
+        new_entries = flask_app._new_turn_entries(gemini_chat.history[chat_start:])
+        await _append_session_history(session_id, db_history, new_entries, session, usage=flask_app._turn_usage(response))
+        await asyncio.to_thread(flask_app._release_chat, session_id, gemini_chat, db_history + new_entries)
+        if cache_key and response.text:
+            flask_app.response_cache.set(cache_key, response.text)
+        return JSONResponse({"generatedText": response.text, "history": db_history + new_entries,
+                             "structured": flask_app._reply_structured(new_entries)})
+    except (AdmissionRejected, CircuitOpenError) as e:
+        return _unavailable_response(e)
+    except flask_app.HistoryConflictError as e:
+        logging.warning(f"HISTORY_LOG: {e}")
+        return JSONResponse(flask_app.HISTORY_CONFLICT, status_code=409)
+    except Exception as e:
+        logging.error(f"Error in chat message for session {session_id}: {e}", exc_info=True)
+        return JSONResponse({"error": f"An error occurred with the AI: {str(e)}"}, status_code=500)
+
+
+async def api_chat_message_stream(request):
+    timer = metrics.start_request(request.url.path)
+    spooled_media = []
+    handed_off = False
+    try:
+        response = await _chat_message_stream(request, spooled_media, timer)
+        handed_off = isinstance(response, StreamingResponse)
+        return _finish_request(request, timer, response)
+    finally:
+        # A streaming response closes the media itself once the stream ends.
+        if not handed_off:
+            _close_media(spooled_media)
+
+
+async def _chat_message_stream(request, spooled_media, timer):
+    user, error_response = await _authenticate(request)
+    if error_response: return error_response
+    try:
+        flask_app.chat_rate_limiter.take(str(user.id))
+    except AdmissionRejected as e:
+        return _unavailable_response(e)
+    parsed, error_response = await _parse_chat_request(request, spooled_media)
+    if error_response: return error_response
+    session_id, prompt, media = parsed
+
+    try:
+        turn = await session_turns.acquire(session_id, flask_app.SESSION_TURN_WAIT_SECONDS)
+    except SessionBusyError:
+        return JSONResponse(flask_app.SESSION_TURN_BUSY, status_code=409)
+    try:
+        response = await _chat_message_stream_in_turn(request, spooled_media, timer, user, session_id, prompt, media)
+    except BaseException:
+        session_turns.release(session_id, turn)
+        raise
+    if not isinstance(response, StreamingResponse):
+        session_turns.release(session_id, turn)
+        return response
+    # The turn lasts until the stream has saved its history, or the client went away.
+    response.body_iterator = _ending_turn(response.body_iterator, session_id, turn)
+    return response
+
+
+async def _ending_turn(body_iterator, session_id, turn):
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        session_turns.release(session_id, turn)
+
+
+async def _chat_message_stream_in_turn(request, spooled_media, timer, user, session_id, prompt, media):
+    try:
+        session = await _get_owned_session(session_id, str(user.id))
+    except Exception:
+        return JSONResponse({"error": "Chat session not found or permission denied."}, status_code=404)
+
+    dummy_client = flask_app._dummy_client()
+    if dummy_client:
+        dummy_chat = dummy_client.start_chat_session()
+        response = dummy_client.send_chat_message(dummy_chat, prompt)
+        async def generate_dummy():
+            try:
+                yield flask_app._sse_event('chunk', {"text": response.text})
+                yield flask_app._sse_event('done', {"generatedText": response.text, "history": [], "error": "Using DUMMY API."})
+            finally:
+                _close_media(spooled_media)
+        return StreamingResponse(generate_dummy(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+    idempotency_key = request.headers.get('Idempotency-Key')
+    turn_key, turn_ttl = flask_app._turn_key(str(user.id), session_id, prompt, media, idempotency_key)
+    state, value = await _claim_turn(turn_key, idempotency_key, session)
+    if state == 'done':
+        async def generate_replay():
+            try:
+                yield flask_app._sse_event('chunk', {"text": value['generatedText']})
+                yield flask_app._sse_event('done', value)
+            finally:
+                _close_media(spooled_media)
+        return StreamingResponse(generate_replay(), media_type='text/event-stream',
+                                 headers={**SSE_HEADERS, **flask_app.REPLAYED_HEADERS})
+    if state == 'busy':
+        return JSONResponse(flask_app.DUPLICATE_TURN_BUSY, status_code=409)
+
+    publish = functools.partial(flask_app.turn_flights.finish, turn_key, value, ttl=turn_ttl)
+    try:
+        response = await _chat_turn_stream(request, spooled_media, timer, session_id, session, prompt, media, publish)
+    except BaseException:
+        publish(None)
+        raise
+    # A stream publishes its payload (or None) itself when it ends.
+    if not isinstance(response, StreamingResponse):
+        publish(None)
+    return response
+
+
+async def _chat_turn_stream(request, spooled_media, timer, session_id, session, prompt, media, publish):
+    """Runs one turn of the streaming endpoint; the `done` payload is passed to `publish`."""
+    gemini_api_client = flask_app.gemini_api_client
+    cache_key = _first_turn_cache_key(request, session, prompt, media)
+    if cache_key:
+        with metrics.phase('response_cache'):
+            cached_text = flask_app.response_cache.get(cache_key)
+        if cached_text is not None:
+            async def generate_cached():
+                try:
+                    new_entries = flask_app._first_turn_entries(prompt, cached_text)
+                    await _append_session_history(session_id, [], new_entries, session)
+                    payload = {"generatedText": cached_text, "history": new_entries, "structured": flask_app._reply_structured(new_entries), "cached": True}
+                    publish(payload)
+                    yield flask_app._sse_event('chunk', {"text": cached_text})
+                    yield flask_app._sse_event('done', payload)
+                except flask_app.HistoryConflictError:
+                    yield flask_app._sse_event('error', flask_app.HISTORY_CONFLICT)
+                except Exception as e:
+                    logging.error(f"Error saving cached first turn for session {session_id}: {e}", exc_info=True)
+                    yield flask_app._sse_event('error', {"error": f"An error occurred with the AI: {str(e)}"})
+                finally:
+                    publish(None)
+                    _close_media(spooled_media)
+            return StreamingResponse(generate_cached(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+    # The slot is held until the stream is fully consumed, not just until the first chunk.
+    try:
+        with metrics.phase('llm_queue'):
+            slot_acquired_at = await llm_admission.acquire()
+    except AdmissionRejected as e:
+        return _unavailable_response(e)
+    llm_call = contextlib.ExitStack()
+    llm_call.callback(llm_admission.release, slot_acquired_at)
+    llm_call.enter_context(flask_app.llm_call_in_flight())
+    try:
+        gemini_chat, db_history = await _resume_chat(session_id, session['message_count'], session, prompt)
+        chat_start = len(gemini_chat.history)
+        media_kwargs, model_prompt = await _prepare_media(media, prompt, spooled_media)
+        response = await gemini_api_client.send_chat_message_async(gemini_chat, model_prompt, stream=True, **media_kwargs)
+    except CircuitOpenError as e:
+        llm_call.close()
+        return _unavailable_response(e)
+    except Exception as e:
+        llm_call.close()
+        logging.error(f"Error starting streamed chat message for session {session_id}: {e}", exc_info=True)
+        return JSONResponse({"error": f"An error occurred with the AI: {str(e)}"}, status_code=500)
+
+    async def generate():
+        text_chunks = []
+        last_chunk = None
+        stream_started = time.perf_counter()
+        try:
+            async for chunk in response:
+                last_chunk = chunk
+                if not chunk.parts:
+                    continue
+                if not text_chunks:
+                    metrics.record_phase('model_first_chunk', time.perf_counter() - stream_started, timer)
+                text_chunks.append(chunk.text)
+                yield flask_app._sse_event('chunk', {"text": chunk.text})
+            llm_call.close()
+            metrics.record_phase('model_stream', time.perf_counter() - stream_started, timer)
+            metrics.record_token_usage(last_chunk)
+
+            new_entries = flask_app._new_turn_entries(gemini_chat.history[chat_start:])
+            await _append_session_history(session_id, db_history, new_entries, session, usage=flask_app._turn_usage(last_chunk))
+            await asyncio.to_thread(flask_app._release_chat, session_id, gemini_chat, db_history + new_entries)
+            generated_text = "".join(text_chunks)
+            if cache_key and generated_text:
+                flask_app.response_cache.set(cache_key, generated_text)
+            payload = {"generatedText": generated_text, "history": db_history + new_entries,
+                       "structured": flask_app._reply_structured(new_entries)}
+            publish(payload)
+            yield flask_app._sse_event('done', payload)
+        except flask_app.HistoryConflictError as e:
+            logging.warning(f"HISTORY_LOG: {e}")
+            yield flask_app._sse_event('error', flask_app.HISTORY_CONFLICT)
+        except Exception as e:
+            logging.error(f"Error streaming chat message for session {session_id}: {e}", exc_info=True)
+            metrics.record_error('stream', timer)
+            yield flask_app._sse_event('error', {"error": f"An error occurred with the AI: {str(e)}"})
+        finally:
+            llm_call.close()
+            publish(None)
+            _close_media(spooled_media)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # A no-op if the server's post-fork hook or the app import already started them. The chat
+    # store opens its async connection (if it has one) on first use.
+    flask_app.init_clients()
+    yield
+    remaining = await asyncio.to_thread(flask_app.drain, SHUTDOWN_DRAIN_SECONDS)
+    if remaining:
+        logging.warning(f"Shutting down with {remaining} model call(s) still in flight.")
+
+
+app = Starlette(
+    routes=[
+        Route('/api/chat_message', api_chat_message, methods=['POST']),
+        Route('/api/chat_message/stream', api_chat_message_stream, methods=['POST']),
+        Mount('/', app=PooledWsgiToAsgi(flask_app.app, WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
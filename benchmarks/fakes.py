@@ -0,0 +1,621 @@
+"""
+In-process stand-ins for Supabase and Gemini, used by the benchmark driver.
+
+`FakeSupabase` implements the slice of the supabase-py client the app uses: PostgREST-style
+query builders over the `chat_session` and `chat_message` tables (including `or_` filter
+trees, ordering, `single()`, the chat_message (session_uuid, seq) unique key and the
+cascade on session delete), the user_token_usage view, the search_chat_sessions function
+(ranked by the same in-process index as the SQLite chat store) and `auth`
+sign-up/sign-in/sign-out that mint real HS256 tokens. `FakeGenerativeModel` stands in for `genai.GenerativeModel` underneath a real
+`GeminiFlashAPI`, so history windowing and media handling still run; it simulates
+first-token latency, a token rate and streamed chunks.
+
+Both fakes sleep for their configured latencies, so results reflect the app's own
+overhead plus a realistic network and model wait.
+"""
+import asyncio
+import copy
+import itertools
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+
+import jwt
+
+from chat_store import SESSION_COLUMNS
+from search_index import SessionSearchIndex
+
+
+class FakeAPIError(Exception):
+    """Raised where PostgREST would return an error (e.g. `single()` on zero rows)."""
+
+
+class _Result:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+# --- PostgREST filter parsing -------------------------------------------------------
+
+_OPERATORS = {
+    "eq": lambda a, b: a == b,
+    "neq": lambda a, b: a != b,
+    "lt": lambda a, b: a is not None and a < b,
+    "lte": lambda a, b: a is not None and a <= b,
+    "gt": lambda a, b: a is not None and a > b,
+    "gte": lambda a, b: a is not None and a >= b,
+}
+
+
+def _split_top_level(expr):
+    """Splits a PostgREST logic expression on commas outside parentheses and quotes."""
+    parts, depth, quoted, current = [], 0, False, []
+    for char in expr:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and char == ",":
+            parts.append("".join(current))
+            current = []
+            continue
+        current.append(char)
+    parts.append("".join(current))
+    return parts
+
+
+def _parse_condition(expr):
+    """Parses `col.op.value`, `and(...)` or `or(...)` into a row predicate."""
+    match = re.fullmatch(r"(and|or)\((.*)\)", expr, re.S)
+    if match:
+        combine = all if match.group(1) == "and" else any
+        predicates = [_parse_condition(part) for part in _split_top_level(match.group(2))]
+        return lambda row: combine(p(row) for p in predicates)
+    column, op, value = expr.split(".", 2)
+    if value.startswith('"') and value.endswith('"'):
+        value = value[1:-1]
+    compare = _OPERATORS[op]
+    return lambda row: compare(_comparable(row.get(column)), value)
+
+
+def _comparable(value):
+    # PostgREST compares against the literal text of the filter.
+    return None if value is None else str(value)
+
+
+# --- Tables ---------------------------------------------------------------------------
+
+class _Database:
+    def __init__(self):
+        self.tables = {"chat_session": [], "chat_message": []}
+        self.lock = threading.Lock()
+        self._clock = itertools.count()
+
+    def now(self):
+        # Strictly increasing timestamps, so keyset pagination has a stable order.
+        return (datetime.now(timezone.utc) + timedelta(microseconds=next(self._clock))).isoformat()
+
+    def insert(self, table, rows):
+        stored = []
+        existing = self.tables.setdefault(table, [])
+        for row in rows:
+            row = copy.deepcopy(row)
+            if table == "chat_session":
+                row.setdefault("session_uuid", str(uuid.uuid4()))
+                row.setdefault("start_time", self.now())
+                row.setdefault("message_count", 0)
+                row.setdefault("history_version", 0)
+            elif table == "chat_message":
+                key = (row["session_uuid"], row["seq"])
+                if any((r["session_uuid"], r["seq"]) == key for r in existing):
+                    raise FakeAPIError('duplicate key value violates unique constraint "chat_message_session_uuid_seq_key"')
+                row.setdefault("id", len(existing) + 1)
+                row.setdefault("created_at", self.now())
+            stored.append(row)
+        existing.extend(stored)
+        return stored
+
+    def rows(self, table):
+        """The rows of a table, or of a view computed from the tables as they are now."""
+        view = _VIEWS.get(table)
+        return view(self) if view is not None else self.tables.setdefault(table, [])
+
+    def delete(self, table, rows):
+        doomed = {id(row) for row in rows}
+        self.tables[table] = [row for row in self.tables[table] if id(row) not in doomed]
+        if table == "chat_session":
+            uuids = {row["session_uuid"] for row in rows}
+            self.tables["chat_message"] = [row for row in self.tables["chat_message"] if row["session_uuid"] not in uuids]
+
+
+def _user_token_usage(db):
+    # The user_token_usage view of the token_usage migration.
+    usage = {}
+    for session in db.tables["chat_session"]:
+        row = usage.setdefault(session["user_id"], {
+            "user_id": session["user_id"], "session_count": 0, "message_count": 0, "prompt_tokens": 0,
+            "output_tokens": 0, "max_prompt_tokens": 0, "last_activity": None})
+        row["session_count"] += 1
+        for column in ("message_count", "prompt_tokens", "output_tokens"):
+            row[column] += session.get(column) or 0
+        row["max_prompt_tokens"] = max(row["max_prompt_tokens"], session.get("max_prompt_tokens") or 0)
+        if session.get("last_activity") and (row["last_activity"] is None or session["last_activity"] > row["last_activity"]):
+            row["last_activity"] = session["last_activity"]
+    return list(usage.values())
+
+
+_VIEWS = {"user_token_usage": _user_token_usage}
+
+
+def _search_chat_sessions(db, p_user_id, p_query, p_limit, p_offset=0):
+    # The search_chat_sessions function of the session_search migration, ranked by the
+    # index the SQLite store uses, built over the caller's sessions on every call.
+    sessions = {row["session_uuid"]: row for row in db.tables["chat_session"] if str(row["user_id"]) == str(p_user_id)}
+    index = SessionSearchIndex()
+    for session_uuid, session in sessions.items():
+        index.add_session(session_uuid, session["user_id"], session.get("appliance_type"))
+    index.add_messages(sorted((row for row in db.tables["chat_message"] if row["session_uuid"] in sessions),
+                              key=lambda row: row["id"]))
+    return [{**{column: sessions[session_uuid].get(column) for column in SESSION_COLUMNS}, "rank": rank}
+            for session_uuid, rank in index.search(p_user_id, p_query, p_limit, p_offset)]
+
+
+_FUNCTIONS = {"search_chat_sessions": _search_chat_sessions}
+
+
+class FakeQuery:
+    """A PostgREST query builder over one table; `execute()` sleeps for the configured latency."""
+
+    def __init__(self, client, table):
+        self._client = client
+        self._table = table
+        self._op = "select"
+        self._columns = "*"
+        self._payload = None
+        self._filters = []
+        self._order = []
+        self._limit = None
+        self._single = False
+        self._maybe_single = False
+
+    def select(self, columns="*", count=None):
+        self._op, self._columns = "select", columns
+        return self
+
+    def insert(self, payload, **kwargs):
+        self._op, self._payload = "insert", payload
+        return self
+
+    def update(self, payload, **kwargs):
+        self._op, self._payload = "update", payload
+        return self
+
+    def delete(self, **kwargs):
+        self._op = "delete"
+        return self
+
+    def _filter(self, column, op, value):
+        self._filters.append(_parse_condition(f"{column}.{op}.{value}"))
+        return self
+
+    def eq(self, column, value): return self._filter(column, "eq", value)
+    def neq(self, column, value): return self._filter(column, "neq", value)
+    def lt(self, column, value): return self._filter(column, "lt", value)
+    def lte(self, column, value): return self._filter(column, "lte", value)
+    def gt(self, column, value): return self._filter(column, "gt", value)
+    def gte(self, column, value): return self._filter(column, "gte", value)
+
+    def in_(self, column, values):
+        allowed = {str(v) for v in values}
+        self._filters.append(lambda row: _comparable(row.get(column)) in allowed)
+        return self
+
+    def or_(self, filters):
+        self._filters.append(_parse_condition(f"or({filters})"))
+        return self
+
+    def order(self, column, desc=False):
+        self._order.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def single(self):
+        self._single = True
+        return self
+
+    def maybe_single(self):
+        self._maybe_single = True
+        return self
+
+    def execute(self):
+        self._client.simulate_latency()
+        return self._run()
+
+    def _run(self):
+        db = self._client.db
+        with db.lock:
+            self._client.calls += 1
+            if self._op == "insert":
+                rows = self._payload if isinstance(self._payload, list) else [self._payload]
+                return _Result(copy.deepcopy(db.insert(self._table, rows)))
+            matched = [row for row in db.rows(self._table) if all(f(row) for f in self._filters)]
+            if self._op == "update":
+                for row in matched:
+                    row.update(copy.deepcopy(self._payload))
+                return _Result(copy.deepcopy(matched))
+            if self._op == "delete":
+                db.delete(self._table, matched)
+                return _Result(copy.deepcopy(matched))
+            for column, desc in reversed(self._order):
+                matched.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+            if self._limit is not None:
+                matched = matched[:self._limit]
+            if self._columns != "*":
+                columns = [c.strip() for c in self._columns.split(",")]
+                matched = [{c: row.get(c) for c in columns} for row in matched]
+            matched = copy.deepcopy(matched)
+        if self._single:
+            if len(matched) != 1:
+                raise FakeAPIError(f"JSON object requested, multiple (or no) rows returned ({len(matched)})")
+            return _Result(matched[0])
+        if self._maybe_single:
+            return _Result(matched[0] if matched else None)
+        return _Result(matched)
+
+
+class FakeRpc:
+    """A PostgREST function call (`client.rpc(name, params)`); `execute()` sleeps for the configured latency."""
+
+    def __init__(self, client, name, params):
+        self._client = client
+        self._name = name
+        self._params = params or {}
+
+    def execute(self):
+        self._client.simulate_latency()
+        return self._run()
+
+    def _run(self):
+        function = _FUNCTIONS.get(self._name)
+        if function is None:
+            raise FakeAPIError(f"Could not find the function public.{self._name}")
+        db = self._client.db
+        with db.lock:
+            self._client.calls += 1
+            return _Result(copy.deepcopy(function(db, **self._params)))
+
+
+class _AuthSession:
+    def __init__(self, access_token):
+        self.access_token = access_token
+
+
+class _AuthUser:
+    def __init__(self, user_id, email, user_metadata):
+        self.id = user_id
+        self.email = email
+        self.user_metadata = user_metadata
+
+
+class _AuthResponse:
+    def __init__(self, user, session=None):
+        self.user = user
+        self.session = session
+
+
+class FakeAuth:
+    """The `supabase.auth` surface the app uses; tokens are HS256 JWTs signed with `jwt_secret`."""
+
+    def __init__(self, client, jwt_secret, token_ttl=3600):
+        self._client = client
+        self.jwt_secret = jwt_secret
+        self.token_ttl = token_ttl
+        self._users = {}  # email -> (user, password)
+
+    def sign_up(self, credentials):
+        self._client.simulate_latency()
+        email = credentials["email"]
+        metadata = credentials.get("options", {}).get("data", {})
+        with self._client.db.lock:
+            if email in self._users:
+                raise FakeAPIError("User already registered")
+            user = _AuthUser(str(uuid.uuid4()), email, metadata)
+            self._users[email] = (user, credentials["password"])
+        return _AuthResponse(user)
+
+    def sign_in_with_password(self, credentials):
+        self._client.simulate_latency()
+        user, password = self._users.get(credentials["email"], (None, None))
+        if user is None or password != credentials["password"]:
+            raise FakeAPIError("Invalid login credentials")
+        return _AuthResponse(user, _AuthSession(self.issue_token(user)))
+
+    def issue_token(self, user):
+        claims = {"sub": user.id, "email": user.email, "aud": "authenticated", "role": "authenticated",
+                  "user_metadata": user.user_metadata, "exp": int(time.time()) + self.token_ttl}
+        return jwt.encode(claims, self.jwt_secret, algorithm="HS256")
+
+    def get_user(self, token):
+        self._client.simulate_latency()
+        claims = jwt.decode(token, self.jwt_secret, algorithms=["HS256"], audience="authenticated")
+        for user, _ in self._users.values():
+            if user.id == claims["sub"]:
+                return _AuthResponse(user)
+        raise FakeAPIError("User not found")
+
+    def sign_out(self, token=None):
+        self._client.simulate_latency()
+
+
+class FakeSupabase:
+    """
+    A thread-safe, in-memory stand-in for the supabase-py sync client.
+
+    Attributes:
+        latency (float): Seconds each request sleeps, standing in for the network round trip.
+        calls (int): Number of table queries and function calls executed.
+    """
+
+    def __init__(self, jwt_secret, latency=0.005):
+        self.db = _Database()
+        self.latency = latency
+        self.calls = 0
+        self.auth = FakeAuth(self, jwt_secret)
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params=None):
+        return FakeRpc(self, name, params)
+
+    def simulate_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class _AsyncQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def __getattr__(self, name):
+        method = getattr(self._query, name)
+
+        def chain(*args, **kwargs):
+            method(*args, **kwargs)
+            return self
+        return chain
+
+    async def execute(self):
+        if self._query._client.latency:
+            await asyncio.sleep(self._query._client.latency)
+        return self._query._run()
+
+
+class AsyncFakeSupabase:
+    """The `acreate_client` counterpart of `FakeSupabase`, sharing its data."""
+
+    def __init__(self, sync_client):
+        self._sync = sync_client
+
+    def table(self, name):
+        return _AsyncQuery(FakeQuery(self._sync, name))
+
+    def rpc(self, name, params=None):
+        return _AsyncQuery(FakeRpc(self._sync, name, params))
+
+
+# --- Gemini ---------------------------------------------------------------------------
+
+class _Part:
+    def __init__(self, text):
+        self.text = text
+
+
+class _Content:
+    def __init__(self, role, parts):
+        self.role = role
+        self.parts = parts
+
+
+class _UsageMetadata:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class _Response:
+    def __init__(self, text, usage_metadata=None):
+        self.text = text
+        self.parts = [_Part(text)] if text else []
+        self.usage_metadata = usage_metadata
+        self.prompt_feedback = None
+
+
+class _CountTokensResponse:
+    def __init__(self, total_tokens):
+        self.total_tokens = total_tokens
+
+
+class _FileState:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeFile:
+    """A File API handle, as returned by `genai.upload_file`."""
+
+    def __init__(self, mime_type, size):
+        self.name = f"files/{uuid.uuid4().hex[:12]}"
+        self.uri = f"https://generativelanguage.googleapis.com/v1beta/{self.name}"
+        self.mime_type = mime_type
+        self.size_bytes = size
+        self.state = _FileState("ACTIVE")
+
+
+def _estimate_tokens(text):
+    # Roughly 4 characters per token, the usual rule of thumb for English.
+    return max(1, len(text) // 4)
+
+
+def _part_text(part):
+    if isinstance(part, dict):
+        return part.get("text") or ""
+    if isinstance(part, str):
+        return part
+    return getattr(part, "text", "") or ""
+
+
+def make_repair_answer(prompt, target_tokens):
+    """Builds a repair-assistant style answer of roughly `target_tokens` tokens."""
+    header = (
+        f"**summary:** the symptoms you describe (\"{prompt[:60]}\") usually point to a clogged drain pump filter.\n\n"
+        "**troubleshooting walk-through:**\n"
+    )
+    steps = []
+    step = 1
+    while _estimate_tokens(header + "".join(steps)) < max(target_tokens - 120, 0):
+        steps.append(f"{step}. check the component in step {step} for debris, damage or loose wiring and test it with a multimeter.\n")
+        step += 1
+    footer = (
+        "\n**troubleshooting flowchart:**\n```mermaid\ngraph TD;\n"
+        "    N1[\"start: drain error\"] --> Q1{\"is the filter clogged?\"};\n"
+        "    Q1 -->|Yes| N2[\"clean the filter\"];\n"
+        "    Q1 -->|No| N3[\"Part #: WPW10730972<br/>replace drain pump\"];\n```\n"
+        "**part recommendation:** <span class=\"part-number\">WPW10730972</span>\n"
+        "<span class=\"warning-text\">caution: disconnect power before proceeding.</span>"
+    )
+    return header + "".join(steps) + footer
+
+
+class FakeChatSession:
+    """Stands in for `genai.ChatSession`: records history and simulates generation time."""
+
+    def __init__(self, model, history):
+        self.model = model
+        self.history = history
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        # Like genai.ChatSession, accepts serialized {"role", "parts"} dicts as well as Contents.
+        self._history = [self._to_content(entry) for entry in history]
+
+    @staticmethod
+    def _to_content(entry):
+        if isinstance(entry, dict):
+            parts = [_Part(_part_text(part)) if isinstance(part, (dict, str)) and _part_text(part) else part
+                     for part in entry.get("parts", [])]
+            return _Content(entry["role"], parts)
+        return entry
+
+    def _prepare(self, parts):
+        parts = parts if isinstance(parts, list) else [parts]
+        prompt = " ".join(_part_text(p) for p in parts)
+        prompt_tokens = sum(_estimate_tokens(_part_text(p)) for entry in self.history for p in entry.parts)
+        prompt_tokens += _estimate_tokens(prompt) + self.model.media_tokens * sum(1 for p in parts if not _part_text(p))
+        answer = make_repair_answer(prompt, self.model.response_tokens)
+        user_parts = [_Part(_part_text(p)) if _part_text(p) else p for p in parts]
+        return user_parts, answer, _UsageMetadata(prompt_tokens, _estimate_tokens(answer))
+
+    def _chunks(self, answer):
+        chunk_chars = self.model.chunk_tokens * 4
+        return [answer[i:i + chunk_chars] for i in range(0, len(answer), chunk_chars)]
+
+    def _chunk_delay(self, chunk):
+        return _estimate_tokens(chunk) / self.model.tokens_per_second if self.model.tokens_per_second else 0
+
+    def send_message(self, parts, stream=False, request_options=None):
+        user_parts, answer, usage = self._prepare(parts)
+        self.history.append(_Content("user", user_parts))
+        time.sleep(self.model.first_token_latency)
+        if not stream:
+            time.sleep(_estimate_tokens(answer) / self.model.tokens_per_second if self.model.tokens_per_second else 0)
+            self.history.append(_Content("model", [_Part(answer)]))
+            return _Response(answer, usage)
+
+        def generate():
+            for chunk in self._chunks(answer):
+                time.sleep(self._chunk_delay(chunk))
+                yield _Response(chunk, usage)
+            # Like the SDK, the model turn is only added once the stream is fully consumed.
+            self.history.append(_Content("model", [_Part(answer)]))
+        return generate()
+
+    async def send_message_async(self, parts, stream=False, request_options=None):
+        user_parts, answer, usage = self._prepare(parts)
+        self.history.append(_Content("user", user_parts))
+        await asyncio.sleep(self.model.first_token_latency)
+        if not stream:
+            await asyncio.sleep(_estimate_tokens(answer) / self.model.tokens_per_second if self.model.tokens_per_second else 0)
+            self.history.append(_Content("model", [_Part(answer)]))
+            return _Response(answer, usage)
+
+        async def generate():
+            for chunk in self._chunks(answer):
+                await asyncio.sleep(self._chunk_delay(chunk))
+                yield _Response(chunk, usage)
+            self.history.append(_Content("model", [_Part(answer)]))
+        return generate()
+
+
+class FakeGenerativeModel:
+    """
+    Stands in for `genai.GenerativeModel`.
+
+    Attributes:
+        first_token_latency (float): Seconds before the first token.
+        tokens_per_second (float): Output token rate; 0 returns the whole answer at once.
+        response_tokens (int): Approximate length of each answer.
+        chunk_tokens (int): Tokens per streamed chunk.
+        media_tokens (int): Prompt tokens charged per media part.
+        upload_latency (float): Seconds a File API upload takes.
+    """
+
+    def __init__(self, first_token_latency=0.4, tokens_per_second=150, response_tokens=600, chunk_tokens=20,
+                 media_tokens=258, upload_latency=0.2):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.chunk_tokens = chunk_tokens
+        self.media_tokens = media_tokens
+        self.upload_latency = upload_latency
+        self.uploads = 0
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history or [])
+
+    def count_tokens(self, contents):
+        if not isinstance(contents, list):
+            contents = [contents]
+        parts = []
+        for item in contents:
+            parts.extend(item.get("parts", []) if isinstance(item, dict) and "parts" in item else [item])
+        return _CountTokensResponse(sum(_estimate_tokens(_part_text(p)) for p in parts))
+
+    def generate_content(self, contents, **kwargs):
+        time.sleep(self.first_token_latency)
+        text = " ".join(_part_text(p) for p in (contents if isinstance(contents, list) else [contents]))
+        return _Response(f"summary of the earlier conversation: {text[:200]}")
+
+    def upload(self, media, mime_type):
+        """A `GeminiFlashAPI.media_uploader` that simulates a File API upload."""
+        if isinstance(media, str):
+            with open(media, "rb") as f:
+                size = len(f.read())
+        else:
+            size = len(media.getvalue())
+        time.sleep(self.upload_latency)
+        self.uploads += 1
+        return FakeFile(mime_type, size)
@@ -0,0 +1,466 @@
+"""
+Load test and benchmark driver: `python -m benchmarks.run [options]`.
+
+Runs the app in-process against the stand-ins in benchmarks/fakes.py, with simulated
+Supabase round trips and Gemini latency, token rate and streaming. Each simulated user
+logs in, starts a chat and works through a multi-turn repair conversation. Turns are
+a mix of plain, photo-attached and streamed messages. The user then lists past
+sessions, searches them for the appliance, reopens the history, checks their token
+usage overall and for the session, sometimes deletes the session, and logs out. Every
+/api/* route is exercised.
+
+Reports count, errors, p50/p95/p99 latency and throughput per endpoint, plus per-request
+allocation peaks from a separate single-conversation pass traced with tracemalloc, and
+the process's peak RSS. With --target asgi, requests go through httpx's ASGITransport,
+which buffers response bodies, so `:first_chunk` times equal full stream times there.
+With --store sqlite, chats are kept in an in-memory SQLite chat store (chat_store.py)
+instead of going through the fake Supabase. --write-behind queues history writes on
+app.history_writer (write_behind.py) and flushes them before the report.
+--output saves the results as JSON. --baseline compares them with
+a saved run and exits with status 1 when p95 latency or throughput regresses by more
+than --max-regression percent.
+
+Examples:
+    python -m benchmarks.run --conversations 200 --concurrency 32
+    python -m benchmarks.run --target asgi --concurrency 256 --llm-latency 1.5
+    python -m benchmarks.run --store sqlite
+    python -m benchmarks.run --write-behind --db-latency 0.05
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --baseline before.json --max-regression 15
+"""
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import AsyncFakeSupabase, FakeGenerativeModel, FakeSupabase
+from chat_store import SQLiteChatStore, SupabaseChatStore
+from write_behind import HistoryWriteBehind
+
+OPENING_PROMPTS = [
+    "my washer won't drain and shows an OE error",
+    "dryer runs but does not heat",
+    "refrigerator is not cooling but the freezer is fine",
+    "dishwasher leaves dishes dirty and gritty",
+    "oven takes forever to preheat",
+    "ice maker stopped making ice",
+]
+FOLLOW_UPS = [
+    "it's a whirlpool model {model}, about five years old",
+    "yes there is power and the display lights up",
+    "i checked the filter and it was full of lint",
+    "the error code comes back after a restart",
+    "what part number do i need for model {model}?",
+    "here is a photo of the back panel",
+]
+APPLIANCES = ["Washer", "Dryer", "Refrigerator", "Dishwasher", "Oven"]
+
+
+class Call:
+    """One HTTP request yielded by a scenario; `endpoint` is the name results are grouped under."""
+
+    def __init__(self, method, path, endpoint, token=None, json=None, form=None, media=None, stream=False):
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint
+        self.token = token
+        self.json = json
+        self.form = form
+        self.media = media
+        self.stream = stream
+
+
+class Reply:
+    def __init__(self, status, body, first_chunk_seconds=None):
+        self.status = status
+        self.body = body
+        self.first_chunk_seconds = first_chunk_seconds
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+def conversation(user, args, rng, media_bytes):
+    """A scenario: yields Calls and receives Replies. Shared by the WSGI and ASGI drivers."""
+    reply = yield Call('POST', '/api/login', 'login', json={'email': user['email'], 'password': user['password']})
+    token = reply.json()['access_token']
+    appliance = rng.choice(APPLIANCES)
+    reply = yield Call('POST', '/api/new_chat', 'new_chat', token, json={'appliance_type': appliance})
+    session_id = reply.json()['session_id']
+
+    model = f"WRT{rng.randint(100, 999)}"
+    for turn in range(args.turns):
+        prompt = rng.choice(OPENING_PROMPTS) if turn == 0 else rng.choice(FOLLOW_UPS).format(model=model)
+        if turn and args.media_every and turn % args.media_every == 0:
+            yield Call('POST', '/api/chat_message', 'chat_message[media]', token,
+                       form={'session_id': session_id, 'prompt': prompt}, media=media_bytes)
+        elif rng.random() < args.stream_ratio:
+            yield Call('POST', '/api/chat_message/stream', 'chat_message/stream', token,
+                       json={'session_id': session_id, 'prompt': prompt}, stream=True)
+        else:
+            yield Call('POST', '/api/chat_message', 'chat_message', token, json={'session_id': session_id, 'prompt': prompt})
+
+    yield Call('GET', f'/api/past_sessions?limit={args.page_size}', 'past_sessions', token)
+    yield Call('GET', f'/api/search?q={appliance.lower()}&limit={args.page_size}', 'search', token)
+    yield Call('GET', f'/api/chat_history/{session_id}', 'chat_history', token)
+    yield Call('GET', '/api/usage', 'usage', token)
+    yield Call('GET', f'/api/usage/session/{session_id}', 'usage/session', token)
+    if rng.random() < args.delete_ratio:
+        yield Call('DELETE', f'/api/delete_session/{session_id}', 'delete_session', token)
+    yield Call('POST', '/api/logout', 'logout', token)
+
+
+class Recorder:
+    """Collects per-endpoint latencies and errors from many threads or tasks."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+def _record_reply(recorder, call, started, reply):
+    # A stream reports errors in-band, after a 200.
+    ok = reply.status < 400 and not (call.stream and b'event: error' in reply.body)
+    recorder.record(call.endpoint, time.perf_counter() - started, ok)
+    if reply.first_chunk_seconds is not None:
+        recorder.record(f"{call.endpoint}:first_chunk", reply.first_chunk_seconds, ok)
+
+
+def _drive(scenario, execute, recorder):
+    reply = None
+    while True:
+        try:
+            call = scenario.send(reply)
+        except StopIteration:
+            return
+        started = time.perf_counter()
+        reply = execute(call)
+        _record_reply(recorder, call, started, reply)
+        if reply.status >= 400:
+            scenario.close()
+            return
+
+
+async def _drive_async(scenario, execute, recorder):
+    reply = None
+    while True:
+        try:
+            call = scenario.send(reply)
+        except StopIteration:
+            return
+        started = time.perf_counter()
+        reply = await execute(call)
+        _record_reply(recorder, call, started, reply)
+        if reply.status >= 400:
+            scenario.close()
+            return
+
+
+# --- Drivers --------------------------------------------------------------------------
+
+def _headers(call):
+    return {'Authorization': f'Bearer {call.token}'} if call.token else {}
+
+
+def wsgi_executor(flask_app):
+    client = flask_app.app.test_client()
+
+    def execute(call):
+        kwargs = {'method': call.method, 'headers': _headers(call)}
+        if call.form is not None:
+            kwargs['data'] = dict(call.form, media_file=(io.BytesIO(call.media), 'photo.jpg', 'image/jpeg'))
+            kwargs['content_type'] = 'multipart/form-data'
+        elif call.json is not None:
+            kwargs['json'] = call.json
+        if not call.stream:
+            response = client.open(call.path, **kwargs)
+            return Reply(response.status_code, response.get_data())
+        started = time.perf_counter()
+        response = client.open(call.path, buffered=False, **kwargs)
+        first_chunk, chunks = None, []
+        try:
+            for chunk in response.iter_encoded():
+                if first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+                chunks.append(chunk)
+        finally:
+            response.close()
+        return Reply(response.status_code, b''.join(chunks), first_chunk)
+    return execute
+
+
+def asgi_executor(http_client):
+    async def execute(call):
+        kwargs = {'headers': _headers(call)}
+        if call.form is not None:
+            kwargs['data'] = call.form
+            kwargs['files'] = {'media_file': ('photo.jpg', call.media, 'image/jpeg')}
+        elif call.json is not None:
+            kwargs['json'] = call.json
+        started = time.perf_counter()
+        first_chunk, chunks = None, []
+        async with http_client.stream(call.method, call.path, **kwargs) as response:
+            async for chunk in response.aiter_bytes():
+                if call.stream and first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+                chunks.append(chunk)
+        return Reply(response.status_code, b''.join(chunks), first_chunk)
+    return execute
+
+
+def run_wsgi(flask_app, users, args, recorder, media_bytes):
+    def one(index):
+        rng = random.Random(args.seed + index)
+        _drive(conversation(users[index % len(users)], args, rng, media_bytes), wsgi_executor(flask_app), recorder)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.conversations)))
+
+
+def run_asgi(users, args, recorder, media_bytes):
+    import httpx
+    import asgi
+
+    async def main():
+        slots = asyncio.Semaphore(args.concurrency)
+        transport = httpx.ASGITransport(app=asgi.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as http_client:
+            execute = asgi_executor(http_client)
+
+            async def one(index):
+                async with slots:
+                    rng = random.Random(args.seed + index)
+                    await _drive_async(conversation(users[index % len(users)], args, rng, media_bytes), execute, recorder)
+            await asyncio.gather(*(one(i) for i in range(args.conversations)))
+    asyncio.run(main())
+
+
+# --- Setup ----------------------------------------------------------------------------
+
+def install_fakes(args):
+    """Imports the app with the stand-ins in place of the real clients."""
+    os.environ['DEFER_CLIENT_INIT'] = '1'
+    os.environ['SUPABASE_JWT_SECRET'] = 'benchmark-secret-benchmark-secret-benchmark'
+    os.environ.pop('SUPABASE_JWKS_URL', None)
+    os.environ.setdefault('SUPABASE_URL', 'http://supabase.invalid')
+    os.environ.setdefault('SUPABASE_ANON_KEY', 'benchmark')
+    os.environ.setdefault('GOOGLE_API_KEY', 'benchmark')
+    # A few simulated users send far faster than real ones; only the LLM concurrency limit applies.
+    os.environ.setdefault('CHAT_RATE_LIMIT_PER_MINUTE', '0')
+    import app as flask_app
+
+    fake_supabase = FakeSupabase(flask_app.SUPABASE_JWT_SECRET, latency=args.db_latency)
+    fake_model = FakeGenerativeModel(first_token_latency=args.llm_latency, tokens_per_second=args.tokens_per_second,
+                                     response_tokens=args.response_tokens, chunk_tokens=args.chunk_tokens,
+                                     upload_latency=args.upload_latency)
+    gemini_api_client = flask_app._create_gemini_client()
+    gemini_api_client.model = fake_model
+    gemini_api_client._summary_model = fake_model
+    gemini_api_client.media_uploader = fake_model.upload
+
+    flask_app.supabase = fake_supabase
+    if args.store == 'sqlite':
+        flask_app.chat_store = SQLiteChatStore(':memory:')
+    else:
+        flask_app.chat_store = SupabaseChatStore(fake_supabase, async_client=AsyncFakeSupabase(fake_supabase))
+    if args.write_behind:
+        flask_app.history_writer = HistoryWriteBehind(flask_app.chat_store, flask_app._flush_session_summary)
+    flask_app.gemini_api_client = gemini_api_client
+    flask_app.token_verifier.remote_verifier = lambda token: fake_supabase.auth.get_user(token).user
+    flask_app._clients_pid = os.getpid()
+    flask_app.clients_initialized.set()
+    flask_app.clients_ready.set()
+    logging.getLogger().setLevel(args.log_level)
+    return flask_app, fake_supabase, fake_model
+
+
+def make_sample_photo(edge):
+    """A noisy JPEG that compresses like a real photo; random bytes if Pillow is missing."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return os.urandom(edge * edge // 4)
+    image = Image.merge('RGB', [Image.effect_noise((edge, edge * 3 // 4), 40 + 10 * i) for i in range(3)])
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def register_users(flask_app, args, recorder):
+    users = [{'email': f'bench{i}@example.com', 'password': 'benchmark-password', 'username': f'bench{i}'}
+             for i in range(args.users)]
+    execute = wsgi_executor(flask_app)
+    for user in users:
+        call = Call('POST', '/api/register', 'register', json=user)
+        started = time.perf_counter()
+        _record_reply(recorder, call, started, execute(call))
+    return users
+
+
+def measure_memory(flask_app, users, args, media_bytes):
+    """Runs one conversation under tracemalloc; returns the peak KiB allocated per endpoint."""
+    peaks = {}
+    execute = wsgi_executor(flask_app)
+    tracemalloc.start()
+    try:
+        def traced(call):
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            reply = execute(call)
+            peak_kib = (tracemalloc.get_traced_memory()[1] - baseline) / 1024
+            peaks[call.endpoint] = max(peaks.get(call.endpoint, 0), peak_kib)
+            return reply
+        _drive(conversation(users[0], args, random.Random(args.seed), media_bytes), traced, Recorder())
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+# --- Reporting ------------------------------------------------------------------------
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(recorder, wall_seconds, memory_peaks):
+    results = {}
+    for endpoint, latencies in sorted(recorder.latencies.items()):
+        results[endpoint] = {
+            'count': len(latencies),
+            'errors': recorder.errors.get(endpoint, 0),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+            'rps': round(len(latencies) / wall_seconds, 2) if wall_seconds else 0.0,
+            'peak_alloc_kib': round(memory_peaks.get(endpoint, 0), 1),
+        }
+    return results
+
+
+def print_report(report):
+    print(f"target={report['target']} store={report['store']} write_behind={report.get('write_behind', False)} conversations={report['conversations']} concurrency={report['concurrency']} "
+          f"wall={report['wall_seconds']:.2f}s peak_rss={report['peak_rss_mib']:.1f}MiB")
+    print(f"{'endpoint':<34}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>9}{'alloc KiB':>11}")
+    for endpoint, row in report['endpoints'].items():
+        print(f"{endpoint:<34}{row['count']:>7}{row['errors']:>8}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['rps']:>9.1f}{row['peak_alloc_kib']:>11.1f}")
+
+
+def compare(report, baseline, max_regression):
+    """Returns human-readable regressions of p95 latency or throughput beyond `max_regression` percent."""
+    regressions = []
+    limit = 1 + max_regression / 100
+    for endpoint, row in report['endpoints'].items():
+        before = baseline.get('endpoints', {}).get(endpoint)
+        if not before:
+            continue
+        if before['p95_ms'] and row['p95_ms'] > before['p95_ms'] * limit:
+            regressions.append(f"{endpoint}: p95 {before['p95_ms']:.1f} -> {row['p95_ms']:.1f} ms")
+        if row['rps'] and row['rps'] * limit < before['rps']:
+            regressions.append(f"{endpoint}: throughput {before['rps']:.1f} -> {row['rps']:.1f} rps")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the API against local Supabase and Gemini stand-ins.")
+    parser.add_argument('--target', choices=['wsgi', 'asgi'], default='wsgi', help="Serve app.py (Flask) or asgi.py.")
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--turns', type=int, default=4, help="Chat turns per conversation.")
+    parser.add_argument('--media-every', type=int, default=3, help="Attach a photo every Nth turn; 0 disables media.")
+    parser.add_argument('--stream-ratio', type=float, default=0.5, help="Share of text turns sent to the streaming endpoint.")
+    parser.add_argument('--delete-ratio', type=float, default=0.2)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--photo-edge', type=int, default=2400, help="Width in pixels of the attached photo.")
+    parser.add_argument('--store', choices=['supabase', 'sqlite'], default='supabase',
+                        help="Keep chats in the fake Supabase, or in an in-memory SQLite chat store.")
+    parser.add_argument('--write-behind', action='store_true', help="Save chat history in the background (HISTORY_WRITE_BEHIND).")
+    parser.add_argument('--db-latency', type=float, default=0.005, help="Seconds per Supabase round trip.")
+    parser.add_argument('--llm-latency', type=float, default=0.4, help="Seconds to the model's first token.")
+    parser.add_argument('--tokens-per-second', type=float, default=150)
+    parser.add_argument('--response-tokens', type=int, default=600)
+    parser.add_argument('--chunk-tokens', type=int, default=20)
+    parser.add_argument('--upload-latency', type=float, default=0.2, help="Seconds per File API upload.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-memory', action='store_true', help="Skip the tracemalloc pass.")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help="Write the results as JSON to this file.")
+    parser.add_argument('--baseline', help="Compare against results saved with --output.")
+    parser.add_argument('--max-regression', type=float, default=15.0, help="Allowed p95/throughput regression, in percent.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    flask_app, fake_supabase, fake_model = install_fakes(args)
+    media_bytes = make_sample_photo(args.photo_edge) if args.media_every else b''
+    recorder = Recorder()
+    users = register_users(flask_app, args, recorder)
+
+    memory_peaks = {} if args.skip_memory else measure_memory(flask_app, users, args, media_bytes)
+
+    started = time.perf_counter()
+    if args.target == 'asgi':
+        run_asgi(users, args, recorder, media_bytes)
+    else:
+        run_wsgi(flask_app, users, args, recorder, media_bytes)
+    wall_seconds = time.perf_counter() - started
+    if flask_app.history_writer is not None:
+        unsaved = flask_app.history_writer.close(30)
+        if unsaved:
+            print(f"{unsaved} chat message(s) were still queued after 30s.", file=sys.stderr)
+
+    report = {
+        'target': args.target,
+        'store': args.store,
+        'write_behind': args.write_behind,
+        'conversations': args.conversations,
+        'concurrency': args.concurrency,
+        'wall_seconds': round(wall_seconds, 3),
+        # ru_maxrss is in KiB on Linux.
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'supabase_queries': fake_supabase.calls,
+        'file_uploads': fake_model.uploads,
+        'endpoints': summarize(recorder, wall_seconds, memory_peaks),
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        if regressions:
+            print("REGRESSIONS:\n  " + "\n  ".join(regressions), file=sys.stderr)
+            return 1
+        print(f"No regressions beyond {args.max_regression:.0f}% against {args.baseline}.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_history_bytes(history):
+    """
+    Roughly estimates the memory held by a chat history (text plus any inline media).
+
+    Args:
+        history (list): `ChatSession.history` entries (objects with `.parts`) or
+                        serialized dicts like {"role": ..., "parts": [{"text": ...}]}.
+
+    Returns:
+        int: The approximate size in bytes.
+    """
+    total = 0
+    for entry in history:
+        parts = entry.get("parts", []) if isinstance(entry, dict) else getattr(entry, "parts", [])
+        for part in parts:
+            if isinstance(part, dict):
+                total += len(part.get("text") or "")
+                total += len((part.get("inline_data") or {}).get("data") or b"")
+                continue
+            total += len(getattr(part, "text", "") or "")
+            inline_data = getattr(part, "inline_data", None)
+            if inline_data is not None:
+                total += len(getattr(inline_data, "data", b"") or b"")
+    return total
+
+
+class ChatSessionCache:
+    """
+    A bounded, per-process LRU of live Gemini `ChatSession` objects keyed by session UUID.
+
+    Entries are checked out (removed) while a turn is in flight, so two requests never
+    mutate the same `ChatSession`, and put back with the new history version once the
+    turn is persisted. A lookup only hits when the caller's version matches the cached
+    one, so turns written by other workers force a rebuild from the database.
+
+    Attributes:
+        max_entries (int): Maximum number of cached sessions.
+        idle_ttl (float): Seconds an entry may sit unused before it is evicted.
+        max_bytes (int): Approximate memory cap across all cached histories.
+    """
+
+    def __init__(self, max_entries=256, idle_ttl=900, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # session_uuid -> (chat_session, history, version, size, last_used)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def checkout(self, session_uuid, version):
+        """
+        Removes and returns the cached chat for a session if it is at `version`.
+
+        Args:
+            session_uuid (str): The session key.
+            version (int): The history version currently stored in the database.
+
+        Returns:
+            tuple or None: (chat_session, history) on a hit, otherwise None.
+        """
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            entry = self._entries.pop(session_uuid, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            chat_session, history, cached_version, size, _ = entry
+            self._total_bytes -= size
+            if cached_version != version:
+                logger.info(f"CHAT_CACHE_LOG: Stale entry for session {session_uuid} (cached v{cached_version}, db v{version}).")
+                self.misses += 1
+                return None
+            self.hits += 1
+            return chat_session, history
+
+    def put(self, session_uuid, version, chat_session, history):
+        """
+        Caches a chat session at the given history version, evicting as needed.
+
+        Args:
+            session_uuid (str): The session key.
+            version (int): The history version the chat now reflects.
+            chat_session (genai.ChatSession): The live chat object.
+            history (list): The serialized history matching `chat_session`.
+        """
+        size = estimate_history_bytes(chat_session.history)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            old = self._entries.pop(session_uuid, None)
+            if old is not None:
+                self._total_bytes -= old[3]
+            self._entries[session_uuid] = (chat_session, history, version, size, now)
+            self._total_bytes += size
+            self._evict_idle(now)
+            while self._entries and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted[3]
+
+    def invalidate(self, session_uuid):
+        """Drops a session from the cache (e.g. after it is deleted)."""
+        with self._lock:
+            entry = self._entries.pop(session_uuid, None)
+            if entry is not None:
+                self._total_bytes -= entry[3]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total_bytes, "hits": self.hits, "misses": self.misses}
+
+    def _evict_idle(self, now):
+        # Entries are in LRU order, so the idle ones are at the front.
+        while self._entries:
+            session_uuid, entry = next(iter(self._entries.items()))
+            if now - entry[4] <= self.idle_ttl:
+                break
+            del self._entries[session_uuid]
+            self._total_bytes -= entry[3]
@@ -0,0 +1,706 @@
+"""
+Storage for chat sessions and their messages.
+
+`ChatStore` is what the app reads and writes conversations through; `create_chat_store`
+picks a backend:
+
+* "supabase": PostgREST over HTTP with the supabase-py client (the default).
+* "postgres": a bounded pool of direct connections to the same database. The hot queries
+  (session lookup, history read and append, the session list) run as prepared statements,
+  prepared once per connection.
+* "sqlite": a local file with the same tables, for tests and benchmarks.
+
+Session search runs in the database on the Postgres backends (the search_chat_sessions
+function; see the session_search migration) and in an in-process `SessionSearchIndex`
+on SQLite.
+
+Rows are plain dicts keyed by the column names in migrations/versions; timestamps are
+ISO 8601 strings whatever the backend.
+"""
+import abc
+import asyncio
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+from datetime import date, datetime, timezone
+
+from search_index import SessionSearchIndex
+
+logger = logging.getLogger(__name__)
+
+SESSION_COLUMNS = ('session_uuid', 'user_id', 'start_time', 'appliance_type', 'preview_text', 'message_count',
+                   'last_activity', 'history_version', 'prompt_tokens', 'output_tokens', 'max_prompt_tokens')
+MESSAGE_COLUMNS = ('session_uuid', 'seq', 'role', 'parts', 'prompt_tokens', 'output_tokens', 'model_name', 'structured')
+# Columns a summary update may set; see ChatStore.update_session_summary.
+SUMMARY_COLUMNS = ('history_version', 'message_count', 'last_activity', 'preview_text',
+                   'prompt_tokens', 'output_tokens', 'max_prompt_tokens')
+USAGE_COLUMNS = ('user_id', 'session_count', 'message_count', 'prompt_tokens', 'output_tokens',
+                 'max_prompt_tokens', 'last_activity')
+TURN_USAGE_COLUMNS = ('seq', 'prompt_tokens', 'output_tokens', 'model_name')
+
+
+def _message(role, parts, structured=None):
+    message = {'role': role, 'parts': parts}
+    if structured is not None:
+        message['structured'] = structured
+    return message
+
+
+class HistoryConflictError(Exception):
+    """Raised when another request already saved a turn at the same point in a session's history."""
+
+
+def _conflict(rows):
+    return HistoryConflictError(f"Session {rows[0]['session_uuid']} already has a message at seq {rows[0]['seq']}.")
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _keyset(before):
+    """
+    Checks a list_sessions `before` position, so it can go into a PostgREST filter verbatim.
+
+    Raises:
+        ValueError: If the start time is not an ISO 8601 timestamp or the id is not a UUID.
+    """
+    start_time, session_uuid = before
+    datetime.fromisoformat(start_time)
+    return start_time, str(uuid.UUID(session_uuid))
+
+
+class ChatStore(abc.ABC):
+    """
+    Interface for the chat tables. Lookups return None rather than raising when nothing
+    matches. The `*_async` methods are for the ASGI app; by default they run the sync
+    method in a worker thread.
+    """
+
+    @abc.abstractmethod
+    def ping(self):
+        """Makes a trivial query, opening a connection if needed."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def list_sessions(self, user_id, limit, before=None):
+        """
+        Returns up to `limit` of the user's sessions, newest first.
+
+        Args:
+            before (tuple, optional): (start_time, session_uuid) of the last session on the
+                                      previous page; only sessions after it are returned.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_session(self, user_id, appliance_type):
+        """Inserts an empty session and returns its row."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_session(self, session_uuid, user_id=None):
+        """Returns the session row, or None if there is none (or it belongs to someone else)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_session(self, session_uuid, user_id):
+        """Deletes the user's session and its messages; returns False if there was none."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def load_messages(self, session_uuid):
+        """
+        Returns the session's messages in order, as {'role', 'parts'} dicts; model messages
+        saved with structured fields (see solutions.extract_structured) also have 'structured'.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def append_messages(self, rows):
+        """
+        Inserts message rows (MESSAGE_COLUMNS; usage and structured columns may be missing) atomically.
+
+        Raises:
+            HistoryConflictError: If any (session_uuid, seq) is already taken.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_session_summary(self, session_uuid, expected_version, summary):
+        """
+        Applies `summary` (a subset of SUMMARY_COLUMNS) only if the session's history_version
+        is still `expected_version`.
+
+        Returns:
+            bool: False if the version had moved on and nothing was updated.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def turn_usage(self, session_uuid):
+        """Returns TURN_USAGE_COLUMNS for each model message of the session, in order."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def user_usage(self, user_id):
+        """Returns the user's row of the user_token_usage view, or None."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def top_users_by_usage(self, limit):
+        """Returns user_token_usage rows for the users with the most output tokens."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def top_sessions_by_usage(self, user_id, limit):
+        """Returns the user's sessions with the largest prompt token totals."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search_sessions(self, user_id, query, limit, offset=0):
+        """
+        Full-text search over the user's sessions: their messages, appliance type and part
+        numbers. A session matches if it contains every word of `query`.
+
+        Returns:
+            list: Up to `limit` session rows (SESSION_COLUMNS plus `rank`), best match first,
+            after skipping `offset` matches.
+        """
+        raise NotImplementedError
+
+    async def get_session_async(self, session_uuid, user_id=None):
+        return await asyncio.to_thread(self.get_session, session_uuid, user_id)
+
+    async def load_messages_async(self, session_uuid):
+        return await asyncio.to_thread(self.load_messages, session_uuid)
+
+    async def append_messages_async(self, rows):
+        return await asyncio.to_thread(self.append_messages, rows)
+
+    async def update_session_summary_async(self, session_uuid, expected_version, summary):
+        return await asyncio.to_thread(self.update_session_summary, session_uuid, expected_version, summary)
+
+
+class SupabaseChatStore(ChatStore):
+    """
+    The chat tables through PostgREST.
+
+    The query builders are shared by the sync client and, for the `*_async` methods, an
+    async client made on first use from `url` and `key` (or passed in as `async_client`).
+    """
+
+    def __init__(self, client, url=None, key=None, async_client=None):
+        self.client = client
+        self.url = url
+        self.key = key
+        self.async_client = async_client
+
+    async def _async(self):
+        if self.async_client is None and self.url and self.key:
+            from supabase import acreate_client
+            self.async_client = await acreate_client(self.url, self.key)
+            logger.info("Async Supabase client initialized successfully.")
+        return self.async_client
+
+    def ping(self):
+        self.client.table('chat_session').select('session_uuid').limit(1).execute()
+
+    def list_sessions(self, user_id, limit, before=None):
+        query = self.client.table('chat_session').select(', '.join(SESSION_COLUMNS)).eq('user_id', user_id)
+        if before:
+            start_time, session_uuid = _keyset(before)
+            # Keyset pagination on (start_time, session_uuid), both descending.
+            query = query.or_(f'start_time.lt."{start_time}",and(start_time.eq."{start_time}",session_uuid.lt.{session_uuid})')
+        return query.order('start_time', desc=True).order('session_uuid', desc=True).limit(limit).execute().data
+
+    def create_session(self, user_id, appliance_type):
+        res = self.client.table('chat_session').insert({'user_id': user_id, 'appliance_type': appliance_type, 'history': []}).execute()
+        return res.data[0]
+
+    def _session_query(self, client, session_uuid, user_id):
+        query = client.table('chat_session').select(', '.join(SESSION_COLUMNS)).eq('session_uuid', session_uuid)
+        if user_id is not None:
+            query = query.eq('user_id', user_id)
+        return query.limit(1)
+
+    def get_session(self, session_uuid, user_id=None):
+        rows = self._session_query(self.client, session_uuid, user_id).execute().data
+        return rows[0] if rows else None
+
+    async def get_session_async(self, session_uuid, user_id=None):
+        client = await self._async()
+        if client is None:
+            return await super().get_session_async(session_uuid, user_id)
+        rows = (await self._session_query(client, session_uuid, user_id).execute()).data
+        return rows[0] if rows else None
+
+    def delete_session(self, session_uuid, user_id):
+        res = self.client.table('chat_session').delete().eq('session_uuid', session_uuid).eq('user_id', user_id).execute()
+        return bool(res.data)
+
+    def _messages_query(self, client, session_uuid):
+        return client.table('chat_message').select('role, parts, structured').eq('session_uuid', session_uuid).order('seq')
+
+    def load_messages(self, session_uuid):
+        return [_message(row['role'], row['parts'], row.get('structured')) for row in self._messages_query(self.client, session_uuid).execute().data]
+
+    async def load_messages_async(self, session_uuid):
+        client = await self._async()
+        if client is None:
+            return await super().load_messages_async(session_uuid)
+        res = await self._messages_query(client, session_uuid).execute()
+        return [_message(row['role'], row['parts'], row.get('structured')) for row in res.data]
+
+    def append_messages(self, rows):
+        try:
+            res = self.client.table('chat_message').insert(rows).execute()
+        except Exception as e:
+            if _is_unique_violation(e):
+                raise _conflict(rows) from e
+            raise
+        if not res.data: raise Exception("Failed to append session history.")
+
+    async def append_messages_async(self, rows):
+        client = await self._async()
+        if client is None:
+            return await super().append_messages_async(rows)
+        try:
+            res = await client.table('chat_message').insert(rows).execute()
+        except Exception as e:
+            if _is_unique_violation(e):
+                raise _conflict(rows) from e
+            raise
+        if not res.data: raise Exception("Failed to append session history.")
+
+    def _summary_query(self, client, session_uuid, expected_version, summary):
+        return client.table('chat_session').update(summary).eq('session_uuid', session_uuid).eq('history_version', expected_version)
+
+    def update_session_summary(self, session_uuid, expected_version, summary):
+        return bool(self._summary_query(self.client, session_uuid, expected_version, summary).execute().data)
+
+    async def update_session_summary_async(self, session_uuid, expected_version, summary):
+        client = await self._async()
+        if client is None:
+            return await super().update_session_summary_async(session_uuid, expected_version, summary)
+        return bool((await self._summary_query(client, session_uuid, expected_version, summary).execute()).data)
+
+    def turn_usage(self, session_uuid):
+        return self.client.table('chat_message').select(', '.join(TURN_USAGE_COLUMNS)) \
+            .eq('session_uuid', session_uuid).eq('role', 'model').order('seq').execute().data
+
+    def user_usage(self, user_id):
+        rows = self.client.table('user_token_usage').select('*').eq('user_id', user_id).execute().data
+        return rows[0] if rows else None
+
+    def top_users_by_usage(self, limit):
+        return self.client.table('user_token_usage').select('*').order('output_tokens', desc=True).limit(limit).execute().data
+
+    def top_sessions_by_usage(self, user_id, limit):
+        return self.client.table('chat_session').select(', '.join(SESSION_COLUMNS)) \
+            .eq('user_id', user_id).order('prompt_tokens', desc=True).limit(limit).execute().data
+
+    def search_sessions(self, user_id, query, limit, offset=0):
+        params = {'p_user_id': user_id, 'p_query': query, 'p_limit': limit, 'p_offset': offset}
+        return self.client.rpc('search_chat_sessions', params).execute().data
+
+
+def _is_unique_violation(error):
+    # PostgREST reports the Postgres SQLSTATE as the error code.
+    return getattr(error, 'code', None) == '23505' or 'duplicate key value' in str(error)
+
+
+class _SQLStore(ChatStore):
+    """Shared SQL for the Postgres and SQLite backends; `_P` is the driver's placeholder."""
+
+    _P = '?'
+
+    def _session_select(self):
+        return f"SELECT {', '.join(SESSION_COLUMNS)} FROM chat_session"
+
+    def _summary_update(self, summary):
+        unknown = set(summary) - set(SUMMARY_COLUMNS)
+        if unknown:
+            raise ValueError(f"Not summary columns: {sorted(unknown)}")
+        columns = [column for column in SUMMARY_COLUMNS if column in summary]
+        assignments = ', '.join(f"{column} = {self._P}" for column in columns)
+        sql = f"UPDATE chat_session SET {assignments} WHERE session_uuid = {self._P} AND history_version = {self._P}"
+        return sql, [summary[column] for column in columns]
+
+
+class PostgresChatStore(_SQLStore):
+    """
+    The chat tables over direct connections from a bounded pool (psycopg2).
+
+    At most `max_connections` are open; a caller that finds them all busy waits up to
+    `pool_timeout` seconds. Hot queries are PREPAREd on each connection the first time it
+    runs them, so later executions skip parsing and planning. Prepared statements belong to
+    a server session, so `dsn` must reach Postgres directly or through a session-mode pooler.
+
+    Connecting as the table owner bypasses row level security; every query here filters by
+    user where the PostgREST calls relied on it.
+    """
+
+    _P = '%s'
+
+    STATEMENTS = {
+        'chat_store_get_session': (
+            f"SELECT {', '.join(SESSION_COLUMNS)} FROM chat_session WHERE session_uuid = $1 LIMIT 1"),
+        'chat_store_get_owned_session': (
+            f"SELECT {', '.join(SESSION_COLUMNS)} FROM chat_session WHERE session_uuid = $1 AND user_id = $2 LIMIT 1"),
+        'chat_store_load_messages': (
+            "SELECT role, parts, structured FROM chat_message WHERE session_uuid = $1 ORDER BY seq"),
+        'chat_store_append_message': (
+            f"INSERT INTO chat_message ({', '.join(MESSAGE_COLUMNS)}) VALUES ($1, $2, $3, $4, $5, $6, $7, $8)"),
+        'chat_store_update_summary': (
+            "UPDATE chat_session SET history_version = $3, message_count = $4, last_activity = $5,"
+            " preview_text = COALESCE($6, preview_text), prompt_tokens = COALESCE($7, prompt_tokens),"
+            " output_tokens = COALESCE($8, output_tokens), max_prompt_tokens = COALESCE($9, max_prompt_tokens)"
+            " WHERE session_uuid = $1 AND history_version = $2"),
+        'chat_store_list_sessions': (
+            f"SELECT {', '.join(SESSION_COLUMNS)} FROM chat_session WHERE user_id = $1"
+            " ORDER BY start_time DESC, session_uuid DESC LIMIT $2"),
+        'chat_store_list_sessions_before': (
+            f"SELECT {', '.join(SESSION_COLUMNS)} FROM chat_session WHERE user_id = $1"
+            " AND (start_time < $2 OR (start_time = $2 AND session_uuid < $3))"
+            " ORDER BY start_time DESC, session_uuid DESC LIMIT $4"),
+    }
+
+    def __init__(self, dsn, min_connections=1, max_connections=10, pool_timeout=5):
+        import psycopg2.errors
+        import psycopg2.extensions
+        import psycopg2.extras
+        import psycopg2.pool
+
+        class PreparingConnection(psycopg2.extensions.connection):
+            """A connection that remembers which STATEMENTS it has prepared."""
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.prepared = set()
+
+        self._json = psycopg2.extras.Json
+        self._execute_batch = psycopg2.extras.execute_batch
+        self._unique_violation = psycopg2.errors.UniqueViolation
+        self.pool_timeout = pool_timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._pool = psycopg2.pool.ThreadedConnectionPool(min_connections, max_connections, dsn,
+                                                          connection_factory=PreparingConnection)
+        logger.info(f"Postgres chat store connected ({min_connections}-{max_connections} connections).")
+
+    @contextlib.contextmanager
+    def _cursor(self):
+        """Yields a cursor on a pooled connection; the block is one transaction."""
+        if not self._slots.acquire(timeout=self.pool_timeout):
+            raise TimeoutError(f"No database connection became free within {self.pool_timeout}s.")
+        conn = None
+        try:
+            conn = self._pool.getconn()
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except BaseException:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                self._pool.putconn(conn, close=bool(conn.closed))
+            self._slots.release()
+
+    def _execute_prepared(self, cursor, name, params):
+        conn = cursor.connection
+        if name not in conn.prepared:
+            cursor.execute(f"PREPARE {name} AS {self.STATEMENTS[name]}")
+            conn.prepared.add(name)
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+    @staticmethod
+    def _rows(cursor):
+        columns = [column.name for column in cursor.description]
+        return [{column: value.isoformat() if isinstance(value, (datetime, date)) else value
+                 for column, value in zip(columns, row)} for row in cursor.fetchall()]
+
+    def ping(self):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT 1")
+
+    def list_sessions(self, user_id, limit, before=None):
+        with self._cursor() as cursor:
+            if before:
+                start_time, session_uuid = before
+                self._execute_prepared(cursor, 'chat_store_list_sessions_before', (user_id, start_time, session_uuid, limit))
+            else:
+                self._execute_prepared(cursor, 'chat_store_list_sessions', (user_id, limit))
+            return self._rows(cursor)
+
+    def create_session(self, user_id, appliance_type):
+        with self._cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO chat_session (session_uuid, user_id, start_time, history, appliance_type)"
+                f" VALUES (%s, %s, %s, %s, %s) RETURNING {', '.join(SESSION_COLUMNS)}, history",
+                (str(uuid.uuid4()), user_id, _now(), self._json([]), appliance_type))
+            return self._rows(cursor)[0]
+
+    def get_session(self, session_uuid, user_id=None):
+        with self._cursor() as cursor:
+            if user_id is None:
+                self._execute_prepared(cursor, 'chat_store_get_session', (session_uuid,))
+            else:
+                self._execute_prepared(cursor, 'chat_store_get_owned_session', (session_uuid, user_id))
+            rows = self._rows(cursor)
+        return rows[0] if rows else None
+
+    def delete_session(self, session_uuid, user_id):
+        with self._cursor() as cursor:
+            cursor.execute("DELETE FROM chat_session WHERE session_uuid = %s AND user_id = %s", (session_uuid, user_id))
+            return cursor.rowcount > 0
+
+    def load_messages(self, session_uuid):
+        with self._cursor() as cursor:
+            self._execute_prepared(cursor, 'chat_store_load_messages', (session_uuid,))
+            return [_message(role, parts, structured) for role, parts, structured in cursor.fetchall()]
+
+    def append_messages(self, rows):
+        params = [(row['session_uuid'], row['seq'], row['role'], self._json(row['parts']),
+                   row.get('prompt_tokens'), row.get('output_tokens'), row.get('model_name'),
+                   self._json(row['structured']) if row.get('structured') is not None else None) for row in rows]
+        try:
+            with self._cursor() as cursor:
+                # Prepare first, so execute_batch can send every EXECUTE in one round trip.
+                self._execute_prepared(cursor, 'chat_store_append_message', params[0])
+                if len(params) > 1:
+                    self._execute_batch(cursor, "EXECUTE chat_store_append_message (%s, %s, %s, %s, %s, %s, %s, %s)", params[1:])
+        except self._unique_violation as e:
+            raise _conflict(rows) from e
+
+    def update_session_summary(self, session_uuid, expected_version, summary):
+        unknown = set(summary) - set(SUMMARY_COLUMNS)
+        if unknown or not {'history_version', 'message_count', 'last_activity'} <= set(summary):
+            # Anything but the usual shape goes through a one-off statement.
+            sql, params = self._summary_update(summary)
+            with self._cursor() as cursor:
+                cursor.execute(sql, params + [session_uuid, expected_version])
+                return cursor.rowcount > 0
+        with self._cursor() as cursor:
+            self._execute_prepared(cursor, 'chat_store_update_summary', (
+                session_uuid, expected_version, summary['history_version'], summary['message_count'],
+                summary['last_activity'], summary.get('preview_text'), summary.get('prompt_tokens'),
+                summary.get('output_tokens'), summary.get('max_prompt_tokens')))
+            return cursor.rowcount > 0
+
+    def turn_usage(self, session_uuid):
+        with self._cursor() as cursor:
+            cursor.execute(f"SELECT {', '.join(TURN_USAGE_COLUMNS)} FROM chat_message"
+                           " WHERE session_uuid = %s AND role = 'model' ORDER BY seq", (session_uuid,))
+            return self._rows(cursor)
+
+    def user_usage(self, user_id):
+        with self._cursor() as cursor:
+            cursor.execute(f"SELECT {', '.join(USAGE_COLUMNS)} FROM user_token_usage WHERE user_id = %s", (user_id,))
+            rows = self._rows(cursor)
+        return rows[0] if rows else None
+
+    def top_users_by_usage(self, limit):
+        with self._cursor() as cursor:
+            cursor.execute(f"SELECT {', '.join(USAGE_COLUMNS)} FROM user_token_usage ORDER BY output_tokens DESC LIMIT %s", (limit,))
+            return self._rows(cursor)
+
+    def top_sessions_by_usage(self, user_id, limit):
+        with self._cursor() as cursor:
+            cursor.execute(f"{self._session_select()} WHERE user_id = %s ORDER BY prompt_tokens DESC LIMIT %s", (user_id, limit))
+            return self._rows(cursor)
+
+    def search_sessions(self, user_id, query, limit, offset=0):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT * FROM search_chat_sessions(%s, %s, %s, %s)", (user_id, query, limit, offset))
+            return self._rows(cursor)
+
+
+class SQLiteChatStore(_SQLStore):
+    """
+    The chat tables in a local SQLite file, created on first use with the same columns
+    as the migrations (JSON as text). One connection is shared under a lock. Searches use
+    a `SessionSearchIndex` built from the file on the first search and kept up to date by
+    this store's writes after that.
+
+    Attributes:
+        path (str): The SQLite database file; ":memory:" for a throwaway store.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chat_session (
+            id INTEGER PRIMARY KEY,
+            session_uuid TEXT NOT NULL UNIQUE,
+            user_id TEXT NOT NULL,
+            start_time TEXT NOT NULL,
+            history TEXT NOT NULL DEFAULT '[]',
+            appliance_type TEXT,
+            preview_text TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_activity TEXT,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            output_tokens INTEGER NOT NULL DEFAULT 0,
+            max_prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            history_version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS ix_chat_session_user_start ON chat_session (user_id, start_time DESC, session_uuid DESC);
+        CREATE TABLE IF NOT EXISTS chat_message (
+            id INTEGER PRIMARY KEY,
+            session_uuid TEXT NOT NULL REFERENCES chat_session (session_uuid) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            parts TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            prompt_tokens INTEGER,
+            output_tokens INTEGER,
+            model_name TEXT,
+            structured TEXT,
+            CONSTRAINT uq_chat_message_session_seq UNIQUE (session_uuid, seq)
+        );
+        CREATE VIEW IF NOT EXISTS user_token_usage AS
+            SELECT user_id, COUNT(*) AS session_count, COALESCE(SUM(message_count), 0) AS message_count,
+                   COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens, COALESCE(SUM(output_tokens), 0) AS output_tokens,
+                   COALESCE(MAX(max_prompt_tokens), 0) AS max_prompt_tokens, MAX(last_activity) AS last_activity
+            FROM chat_session GROUP BY user_id;
+    """
+
+    def __init__(self, path="chat_store.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._search_index = None
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    def _write(self, sql, params=()):
+        """Runs one statement in its own transaction and returns the number of rows changed."""
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).rowcount
+
+    def ping(self):
+        self._query("SELECT 1")
+
+    def list_sessions(self, user_id, limit, before=None):
+        if before:
+            start_time, session_uuid = before
+            return self._query(f"{self._session_select()} WHERE user_id = ? AND (start_time < ? OR (start_time = ? AND session_uuid < ?))"
+                               " ORDER BY start_time DESC, session_uuid DESC LIMIT ?", (user_id, start_time, start_time, session_uuid, limit))
+        return self._query(f"{self._session_select()} WHERE user_id = ? ORDER BY start_time DESC, session_uuid DESC LIMIT ?", (user_id, limit))
+
+    def create_session(self, user_id, appliance_type):
+        session_uuid = str(uuid.uuid4())
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO chat_session (session_uuid, user_id, start_time, appliance_type) VALUES (?, ?, ?, ?)",
+                               (session_uuid, user_id, _now(), appliance_type))
+            if self._search_index is not None:
+                self._search_index.add_session(session_uuid, user_id, appliance_type)
+        return {**self.get_session(session_uuid), 'history': []}
+
+    def get_session(self, session_uuid, user_id=None):
+        if user_id is None:
+            rows = self._query(f"{self._session_select()} WHERE session_uuid = ?", (session_uuid,))
+        else:
+            rows = self._query(f"{self._session_select()} WHERE session_uuid = ? AND user_id = ?", (session_uuid, user_id))
+        return rows[0] if rows else None
+
+    def delete_session(self, session_uuid, user_id):
+        with self._lock, self._conn:
+            deleted = self._conn.execute("DELETE FROM chat_session WHERE session_uuid = ? AND user_id = ?", (session_uuid, user_id)).rowcount > 0
+            if deleted and self._search_index is not None:
+                self._search_index.remove_session(session_uuid)
+        return deleted
+
+    def load_messages(self, session_uuid):
+        rows = self._query("SELECT role, parts, structured FROM chat_message WHERE session_uuid = ? ORDER BY seq", (session_uuid,))
+        return [_message(row['role'], json.loads(row['parts']), row['structured'] and json.loads(row['structured'])) for row in rows]
+
+    def append_messages(self, rows):
+        params = [(row['session_uuid'], row['seq'], row['role'], json.dumps(row['parts']),
+                   row.get('prompt_tokens'), row.get('output_tokens'), row.get('model_name'),
+                   json.dumps(row['structured']) if row.get('structured') is not None else None) for row in rows]
+        try:
+            with self._lock, self._conn:
+                self._conn.executemany(f"INSERT INTO chat_message ({', '.join(MESSAGE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", params)
+                if self._search_index is not None:
+                    self._search_index.add_messages(rows)
+        except sqlite3.IntegrityError as e:
+            if 'UNIQUE' not in str(e):
+                raise
+            raise _conflict(rows) from e
+
+    def update_session_summary(self, session_uuid, expected_version, summary):
+        sql, params = self._summary_update(summary)
+        return self._write(sql, params + [session_uuid, expected_version]) > 0
+
+    def turn_usage(self, session_uuid):
+        return self._query(f"SELECT {', '.join(TURN_USAGE_COLUMNS)} FROM chat_message WHERE session_uuid = ? AND role = 'model' ORDER BY seq",
+                           (session_uuid,))
+
+    def user_usage(self, user_id):
+        rows = self._query(f"SELECT {', '.join(USAGE_COLUMNS)} FROM user_token_usage WHERE user_id = ?", (user_id,))
+        return rows[0] if rows else None
+
+    def top_users_by_usage(self, limit):
+        return self._query(f"SELECT {', '.join(USAGE_COLUMNS)} FROM user_token_usage ORDER BY output_tokens DESC LIMIT ?", (limit,))
+
+    def top_sessions_by_usage(self, user_id, limit):
+        return self._query(f"{self._session_select()} WHERE user_id = ? ORDER BY prompt_tokens DESC LIMIT ?", (user_id, limit))
+
+    def search_sessions(self, user_id, query, limit, offset=0):
+        with self._lock:
+            if self._search_index is None:
+                self._search_index = self._build_search_index()
+        hits = self._search_index.search(user_id, query, limit, offset)
+        if not hits:
+            return []
+        sessions = self._query(f"{self._session_select()} WHERE session_uuid IN ({', '.join('?' * len(hits))})",
+                               [session_uuid for session_uuid, _ in hits])
+        by_uuid = {session['session_uuid']: session for session in sessions}
+        return [{**by_uuid[session_uuid], 'rank': rank} for session_uuid, rank in hits if session_uuid in by_uuid]
+
+    def _build_search_index(self):
+        # Called with the lock held, so no write lands between the scan and the index going live.
+        index = SessionSearchIndex()
+        for row in self._conn.execute("SELECT session_uuid, user_id, appliance_type FROM chat_session ORDER BY last_activity"):
+            index.add_session(row['session_uuid'], row['user_id'], row['appliance_type'])
+        index.add_messages({'session_uuid': row['session_uuid'], 'role': row['role'], 'parts': json.loads(row['parts']),
+                            'structured': row['structured'] and json.loads(row['structured'])}
+                           for row in self._conn.execute("SELECT m.session_uuid, m.role, m.parts, m.structured FROM chat_message AS m"
+                                                         " JOIN chat_session AS s USING (session_uuid)"
+                                                         " ORDER BY s.last_activity, m.session_uuid, m.seq"))
+        logger.info(f"Built the session search index ({len(index)} sessions).")
+        return index
+
+
+def create_chat_store(backend="supabase", **kwargs):
+    """
+    Creates a chat store for the named backend.
+
+    Args:
+        backend (str): "supabase", "postgres" or "sqlite".
+        **kwargs: Passed to the backend's constructor.
+
+    Returns:
+        ChatStore: The store instance.
+
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    if backend == "supabase":
+        return SupabaseChatStore(**kwargs)
+    if backend == "postgres":
+        return PostgresChatStore(**kwargs)
+    if backend == "sqlite":
+        return SQLiteChatStore(**kwargs)
+    raise ValueError(f"Unknown chat store backend: {backend}")
@@ -0,0 +1,94 @@
+"""
+Production server configuration: `gunicorn` (this file is picked up automatically).
+
+Serves the Flask app with threaded workers by default, or the ASGI app (asgi.py) with
+uvicorn workers when SERVER_MODE=asgi. The app is preloaded in the master so workers
+fork with the code already imported, but the Supabase and Gemini clients are created
+in each worker after the fork so no sockets or locks are shared between processes.
+
+On SIGTERM a worker marks itself as draining (/readyz turns red), stops accepting
+connections and waits up to GUNICORN_GRACEFUL_TIMEOUT seconds for in-flight model
+calls to finish before exiting.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+
+# The master must not open client connections before forking; see app.init_clients.
+os.environ['DEFER_CLIENT_INIT'] = '1'
+# Workers write metrics to files here so /metrics reports all of them, not just the one
+# that happens to serve the scrape. Must be set before prometheus_client is imported, and
+# must exist by then too: preloading imports the app (whose unlabeled metrics open their
+# files right away) before on_starting runs.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), f'appliance-metrics-{os.getpid()}'))
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+SERVER_MODE = os.environ.get('SERVER_MODE', 'wsgi')
+
+if SERVER_MODE == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'app:app'
+    worker_class = 'gthread'
+    # Threads per worker; each thread holds one request for the length of its model call.
+    threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+# Model calls (especially streamed ones) routinely take tens of seconds.
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 180))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 120))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    # Start from empty metrics; files left by a previous master would be summed in. The
+    # directory itself stays: workers write their own files there after the fork.
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    for name in os.listdir(metrics_dir):
+        path = os.path.join(metrics_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    import app as flask_app
+    flask_app.init_clients()
+    server.log.info(f"Worker {worker.pid}: client initialization started.")
+
+
+def post_worker_init(worker):
+    if SERVER_MODE == 'asgi':
+        # uvicorn installs its own signal handlers; asgi.lifespan drains on shutdown.
+        return
+    import app as flask_app
+    handle_term = signal.getsignal(signal.SIGTERM)
+
+    def drain_then_exit(signum, frame):
+        flask_app.draining.set()
+        handle_term(signum, frame)
+
+    signal.signal(signal.SIGTERM, drain_then_exit)
+
+
+def worker_exit(server, worker):
+    import app as flask_app
+    remaining = flask_app.drain(graceful_timeout)
+    if remaining:
+        logging.warning(f"Worker {worker.pid} exiting with {remaining} model call(s) still in flight.")
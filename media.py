@@ -0,0 +1,239 @@
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Optional imaging dependencies, imported on first use so they stay off the cold-start
+# path; without them media is passed through unchanged.
+Image = ImageOps = cv2 = None
+_imaging_loaded = False
+_imaging_lock = threading.Lock()
+
+
+def load_imaging():
+    """Imports Pillow and OpenCV if available; safe to call repeatedly and from any thread."""
+    global Image, ImageOps, cv2, _imaging_loaded
+    with _imaging_lock:
+        if _imaging_loaded:
+            return
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            logger.warning("MEDIA_LOG: Pillow is not installed; images will be sent without downsampling.")
+        try:
+            import cv2
+        except ImportError:
+            pass
+        _imaging_loaded = True
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class MediaTooLargeError(ValueError):
+    """Raised when an upload exceeds the size cap for its MIME family."""
+
+
+class SpooledMedia:
+    """
+    An uploaded media file spooled to disk, with its size and content hash.
+
+    Attributes:
+        path (str): Location of the spooled temp file.
+        mime_type (str): The upload's MIME type.
+        size (int): Size in bytes.
+        sha256 (str): Hex digest of the content, computed while spooling.
+        filename (str): The sanitized client filename.
+    """
+
+    def __init__(self, path, mime_type, size, sha256, filename=None):
+        self.path = path
+        self.mime_type = mime_type
+        self.size = size
+        self.sha256 = sha256
+        self.filename = filename
+
+    @property
+    def family(self):
+        return (self.mime_type or "").split("/", 1)[0]
+
+    def read_bytes(self):
+        """Reads the whole file; only used for media small enough to send inline."""
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        """Deletes the spooled file."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def spool_upload(stream, mime_type, size_limits, filename=None, spool_dir=None, chunk_size=CHUNK_SIZE):
+    """
+    Copies an upload stream to a temp file in chunks, hashing it and enforcing size caps.
+
+    Args:
+        stream (file-like): The upload stream (e.g. `FileStorage.stream`).
+        mime_type (str): The upload's MIME type.
+        size_limits (dict): Maximum bytes per MIME family, e.g. {"image": ..., "video": ...}.
+                            Families not listed are capped by the "default" entry, if any.
+        filename (str, optional): The sanitized client filename, kept for logging.
+        spool_dir (str, optional): Directory for temp files. Defaults to the system temp dir.
+        chunk_size (int, optional): Read size per chunk. Defaults to 1 MiB.
+
+    Returns:
+        SpooledMedia: The spooled file. The caller must `close()` it.
+
+    Raises:
+        MediaTooLargeError: If the upload exceeds the cap for its MIME family.
+    """
+    family = (mime_type or "").split("/", 1)[0]
+    limit = size_limits.get(family, size_limits.get("default"))
+    digest = hashlib.sha256()
+    size = 0
+    fd, path = tempfile.mkstemp(prefix="upload-", dir=spool_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if limit is not None and size > limit:
+                    raise MediaTooLargeError(f"{family or 'media'} uploads are limited to {limit} bytes.")
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.unlink(path)
+        raise
+    logger.info(f"MEDIA_LOG: Spooled {filename or 'upload'} ({mime_type}, {size} bytes, sha256 {digest.hexdigest()[:12]}...) to {path}")
+    return SpooledMedia(path, mime_type, size, digest.hexdigest(), filename=filename)
+
+
+def spool_bytes(data, mime_type, filename=None, spool_dir=None):
+    """Writes in-memory bytes (e.g. a re-encoded image) to a new SpooledMedia."""
+    return spool_upload(io.BytesIO(data), mime_type, {}, filename=filename, spool_dir=spool_dir)
+
+
+class MediaPreprocessor:
+    """
+    Shrinks media before it is sent to the model.
+
+    Images are orientation-corrected, resized so their longest edge is at most `max_edge`,
+    stripped of EXIF metadata and re-encoded as JPEG or WebP. Videos are reduced to
+    `video_keyframes` evenly spaced frames, each processed like an image. A processed
+    result is only used if it is smaller than the original, except that images carrying
+    EXIF or XMP metadata (which may hold the GPS location) are always re-encoded without it.
+
+    Attributes:
+        max_edge (int): Longest allowed image edge, in pixels.
+        image_format (str): "JPEG" or "WEBP".
+        quality (int): Encoder quality (1-95).
+        video_keyframes (int): Frames to sample from a video; 0 sends videos unchanged.
+        spool_dir (str, optional): Directory for processed temp files.
+    """
+
+    def __init__(self, max_edge=1536, image_format="JPEG", quality=85, video_keyframes=6, spool_dir=None):
+        self.max_edge = max_edge
+        self.image_format = image_format.upper()
+        self.quality = quality
+        self.video_keyframes = video_keyframes
+        self.spool_dir = spool_dir
+
+    @property
+    def signature(self):
+        """Identifies the settings, so cached results of a different configuration are not reused."""
+        return f"{self.max_edge}-{self.image_format}-{self.quality}-{self.video_keyframes}"
+
+    @property
+    def output_mime_type(self):
+        return "image/webp" if self.image_format == "WEBP" else "image/jpeg"
+
+    def process(self, media):
+        """
+        Preprocesses spooled media.
+
+        Args:
+            media (SpooledMedia): The uploaded file.
+
+        Returns:
+            list of SpooledMedia: The media to send, in order. This is `[media]` itself when
+                                  nothing could be or needed to be reduced; otherwise new
+                                  files that the caller must also `close()`.
+        """
+        load_imaging()
+        strip_metadata = False
+        try:
+            if media.family == "image" and Image is not None:
+                processed, strip_metadata = self._process_image(media)
+            elif media.family == "video" and cv2 is not None and Image is not None and self.video_keyframes > 0:
+                processed = self._process_video(media)
+            else:
+                return [media]
+        except Exception as e:
+            logger.warning(f"MEDIA_LOG: Preprocessing {media.mime_type} failed, sending the original: {e}")
+            return [media]
+
+        processed_size = sum(item.size for item in processed)
+        if strip_metadata and processed:
+            logger.info(f"MEDIA_LOG: Re-encoded {media.mime_type} to drop its metadata: {media.size} -> {processed_size} bytes.")
+            return processed
+        if not processed or processed_size >= media.size:
+            for item in processed:
+                item.close()
+            logger.info(f"MEDIA_LOG: Kept original {media.mime_type} ({media.size} bytes); preprocessing did not reduce it.")
+            return [media]
+        logger.info(
+            f"MEDIA_LOG: Preprocessed {media.mime_type}: {media.size} -> {processed_size} bytes "
+            f"({len(processed)} part(s), {100 * (1 - processed_size / media.size):.0f}% smaller)."
+        )
+        return processed
+
+    def _process_image(self, media):
+        """Returns ([the re-encoded image], whether the original carries EXIF or XMP metadata)."""
+        with Image.open(media.path) as image:
+            has_metadata = bool(image.getexif()) or any(key in image.info for key in ("exif", "xmp", "XML:com.adobe.xmp"))
+            return [self._encode(image, media.filename)], has_metadata
+
+    def _process_video(self, media):
+        capture = cv2.VideoCapture(media.path)
+        try:
+            frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            if frame_count <= 0:
+                return []
+            count = min(self.video_keyframes, frame_count)
+            # Evenly spaced frames, skipping the very first and last (often black or blurred).
+            positions = [int(frame_count * (i + 1) / (count + 1)) for i in range(count)]
+            frames = []
+            try:
+                for position in positions:
+                    capture.set(cv2.CAP_PROP_POS_FRAMES, position)
+                    ok, frame = capture.read()
+                    if not ok:
+                        continue
+                    image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                    frames.append(self._encode(image, f"{media.filename or 'video'}-frame{position}"))
+            except BaseException:
+                # Don't leak the frames already spooled.
+                for item in frames:
+                    item.close()
+                raise
+            return frames
+        finally:
+            capture.release()
+
+    def _encode(self, image, filename):
+        # Apply the EXIF orientation before the metadata is dropped by re-encoding.
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.thumbnail((self.max_edge, self.max_edge))
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.image_format, quality=self.quality, optimize=True)
+        return spool_bytes(buffer.getvalue(), self.output_mime_type, filename=filename, spool_dir=self.spool_dir)
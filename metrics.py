@@ -0,0 +1,136 @@
+"""
+Request phase timing and Prometheus metrics.
+
+Code on the hot path wraps each step in `phase(name)`. The duration goes to the
+`appliance_phase_seconds` histogram and to the current request's `RequestTimer`, which
+app.py turns into a `Server-Timing` header. Under a multi-process server set
+PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py does) so /metrics aggregates every worker.
+"""
+import contextlib
+import contextvars
+import logging
+import os
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+_TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+REQUEST_SECONDS = Histogram("appliance_request_seconds", "Time to produce a response (not including streamed bodies).",
+                            ["endpoint", "method", "status"], buckets=_LATENCY_BUCKETS)
+REQUEST_BYTES = Histogram("appliance_request_bytes", "Request body size.", ["endpoint"], buckets=_SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram("appliance_response_bytes", "Response body size (non-streamed responses).",
+                           ["endpoint"], buckets=_SIZE_BUCKETS)
+PHASE_SECONDS = Histogram("appliance_phase_seconds", "Time spent in each phase of a request.",
+                          ["endpoint", "phase"], buckets=_LATENCY_BUCKETS)
+ERRORS = Counter("appliance_errors_total", "Errors by phase (or 'request' for 5xx responses).", ["endpoint", "phase"])
+MODEL_TOKENS = Histogram("appliance_model_tokens", "Tokens per model call, from the response's usage metadata.",
+                         ["kind"], buckets=_TOKEN_BUCKETS)
+LLM_IN_FLIGHT = Gauge("appliance_llm_in_flight", "Model calls holding a concurrency slot.", multiprocess_mode="livesum")
+LLM_QUEUE_DEPTH = Gauge("appliance_llm_queue_depth", "Model calls waiting for a concurrency slot.", multiprocess_mode="livesum")
+MODEL_RETRIES = Counter("appliance_model_retries_total", "Model calls retried after a retryable error.", ["call"])
+CIRCUIT_OPEN = Gauge("appliance_circuit_open", "1 while a worker's circuit breaker is open.", ["breaker"],
+                     multiprocess_mode="livemax")
+ADMISSION_REJECTIONS = Counter("appliance_admission_rejections_total", "Chat requests refused with a 429.", ["reason"])
+HISTORY_WRITE_BACKLOG = Gauge("appliance_history_write_backlog", "Chat messages queued by the write-behind writer, not yet saved.",
+                              multiprocess_mode="livesum")
+HISTORY_WRITE_FAILURES = Counter("appliance_history_write_failures_total", "Failed write-behind saves (each is retried).")
+HISTORY_WRITE_CONFLICTS = Counter("appliance_history_write_conflicts_total",
+                                  "Write-behind saves refused because another worker wrote the session first "
+                                  "(the queued turns are dropped).")
+
+
+class RequestTimer:
+    """Phase durations recorded during one request, in the order they finished."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.phases = []  # (name, seconds)
+
+    def server_timing(self):
+        """Formats the phases as a `Server-Timing` header value (durations in milliseconds)."""
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.phases]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_current_timer = contextvars.ContextVar("request_timer", default=None)
+
+
+def start_request(endpoint):
+    """Starts timing a request; phases recorded in this context are attributed to `endpoint`."""
+    timer = RequestTimer(endpoint)
+    _current_timer.set(timer)
+    return timer
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times the enclosed block as phase `name`, counting an error if it raises."""
+    timer = _current_timer.get()
+    endpoint = timer.endpoint if timer is not None else "none"
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.labels(endpoint, name).inc()
+        raise
+    finally:
+        record_phase(name, time.perf_counter() - started, timer)
+
+
+def record_phase(name, seconds, timer=None):
+    """Records a phase measured by the caller (e.g. time to a stream's first chunk)."""
+    timer = timer if timer is not None else _current_timer.get()
+    endpoint = timer.endpoint if timer is not None else "none"
+    PHASE_SECONDS.labels(endpoint, name).observe(seconds)
+    if timer is not None:
+        timer.phases.append((name, seconds))
+
+
+def record_error(name, timer=None):
+    """Counts an error that did not propagate through `phase` (e.g. one reported mid-stream)."""
+    timer = timer if timer is not None else _current_timer.get()
+    ERRORS.labels(timer.endpoint if timer is not None else "none", name).inc()
+
+
+def record_token_usage(response):
+    """Records prompt/output token counts from a model response (or final stream chunk), if present."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for kind, attr in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        count = getattr(usage, attr, None)
+        if count:
+            MODEL_TOKENS.labels(kind).observe(count)
+
+
+def record_request(endpoint, method, status, seconds, request_bytes=None, response_bytes=None):
+    REQUEST_SECONDS.labels(endpoint, method, str(status)).observe(seconds)
+    if request_bytes is not None:
+        REQUEST_BYTES.labels(endpoint).observe(request_bytes)
+    if response_bytes is not None:
+        RESPONSE_BYTES.labels(endpoint).observe(response_bytes)
+    if status >= 500:
+        ERRORS.labels(endpoint, "request").inc()
+
+
+def render_latest():
+    """Returns (body, content_type) for a /metrics response."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Cleans up a dead worker's live-gauge files in multi-process mode."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,54 @@
+"""Append-only chat_message table.
+
+Revision ID: 50afc4c91bea
+Revises: cb2df6850ef2
+Create Date: 2026-10-17 09:12:04.118520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '50afc4c91bea'
+down_revision = 'cb2df6850ef2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('chat_message',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('session_uuid', sa.String(length=36), nullable=False),
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('role', sa.String(length=10), nullable=False),
+    sa.Column('parts', sa.JSON(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=False),
+    sa.ForeignKeyConstraint(['session_uuid'], ['chat_session.session_uuid'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('session_uuid', 'seq', name='uq_chat_message_session_seq')
+    )
+
+    # Backfill existing conversations from the old history column.
+    connection = op.get_bind()
+    chat_session = sa.table('chat_session',
+        sa.column('session_uuid', sa.String),
+        sa.column('history', sa.JSON),
+    )
+    chat_message = sa.table('chat_message',
+        sa.column('session_uuid', sa.String),
+        sa.column('seq', sa.Integer),
+        sa.column('role', sa.String),
+        sa.column('parts', sa.JSON),
+    )
+    for session_uuid, history in connection.execute(sa.select(chat_session.c.session_uuid, chat_session.c.history)):
+        rows = [
+            {'session_uuid': session_uuid, 'seq': seq, 'role': entry.get('role'), 'parts': entry.get('parts', [])}
+            for seq, entry in enumerate(history or [])
+        ]
+        if rows:
+            connection.execute(chat_message.insert(), rows)
+
+
+def downgrade():
+    op.drop_table('chat_message')
@@ -0,0 +1,44 @@
+"""Denormalized session summary columns and keyset index.
+
+Revision ID: 917e100c7288
+Revises: 50afc4c91bea
+Create Date: 2026-10-17 10:03:41.552913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '917e100c7288'
+down_revision = '50afc4c91bea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('chat_session', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('preview_text', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('message_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('last_activity', sa.DateTime(timezone=True), nullable=True))
+        batch_op.create_index('ix_chat_session_user_start', ['user_id', sa.text('start_time DESC'), sa.text('session_uuid DESC')], unique=False)
+
+    # Backfill the summaries from chat_message.
+    op.execute("""
+        UPDATE chat_session SET
+            message_count = (SELECT COUNT(*) FROM chat_message m WHERE m.session_uuid = chat_session.session_uuid),
+            last_activity = (SELECT MAX(m.created_at) FROM chat_message m WHERE m.session_uuid = chat_session.session_uuid),
+            preview_text = (
+                SELECT SUBSTR(m.parts -> 0 ->> 'text', 1, 500) FROM chat_message m
+                WHERE m.session_uuid = chat_session.session_uuid AND m.role = 'model'
+                ORDER BY m.seq LIMIT 1
+            )
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('chat_session', schema=None) as batch_op:
+        batch_op.drop_index('ix_chat_session_user_start')
+        batch_op.drop_column('last_activity')
+        batch_op.drop_column('message_count')
+        batch_op.drop_column('preview_text')
@@ -0,0 +1,57 @@
+"""Per-turn token usage, per-session totals and a per-user usage view.
+
+Revision ID: a3f1d9b27c64
+Revises: 917e100c7288
+Create Date: 2026-10-17 14:22:09.318402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f1d9b27c64'
+down_revision = '917e100c7288'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Usage is stored on the model message that closes each turn.
+    with op.batch_alter_table('chat_message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('prompt_tokens', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('output_tokens', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('model_name', sa.String(length=64), nullable=True))
+
+    with op.batch_alter_table('chat_session', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('prompt_tokens', sa.BigInteger(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('output_tokens', sa.BigInteger(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('max_prompt_tokens', sa.Integer(), server_default='0', nullable=False))
+
+    # security_invoker keeps row level security on chat_session in force for queries on the view.
+    op.execute("""
+        CREATE VIEW user_token_usage WITH (security_invoker = true) AS
+        SELECT
+            user_id,
+            COUNT(*) AS session_count,
+            COALESCE(SUM(message_count), 0) AS message_count,
+            COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(output_tokens), 0) AS output_tokens,
+            COALESCE(MAX(max_prompt_tokens), 0) AS max_prompt_tokens,
+            MAX(last_activity) AS last_activity
+        FROM chat_session
+        GROUP BY user_id
+    """)
+
+
+def downgrade():
+    op.execute("DROP VIEW IF EXISTS user_token_usage")
+    with op.batch_alter_table('chat_session', schema=None) as batch_op:
+        batch_op.drop_column('max_prompt_tokens')
+        batch_op.drop_column('output_tokens')
+        batch_op.drop_column('prompt_tokens')
+
+    with op.batch_alter_table('chat_message', schema=None) as batch_op:
+        batch_op.drop_column('model_name')
+        batch_op.drop_column('output_tokens')
+        batch_op.drop_column('prompt_tokens')
@@ -0,0 +1,28 @@
+"""History version on chat_session for compare-and-swap summary updates.
+
+Revision ID: c41e7a09d5b2
+Revises: a3f1d9b27c64
+Create Date: 2026-10-17 16:48:27.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e7a09d5b2'
+down_revision = 'a3f1d9b27c64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Bumped by every summary update, which only applies if the version it was read at is
+    # still current; see app._update_session_summary.
+    with op.batch_alter_table('chat_session', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('history_version', sa.BigInteger(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('chat_session', schema=None) as batch_op:
+        batch_op.drop_column('history_version')
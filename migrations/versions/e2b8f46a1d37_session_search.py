@@ -0,0 +1,117 @@
+"""Full-text search over chat sessions.
+
+Revision ID: e2b8f46a1d37
+Revises: c41e7a09d5b2
+Create Date: 2026-10-17 19:05:41.552380
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b8f46a1d37'
+down_revision = 'c41e7a09d5b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # One tsvector per session, weighted like search_index.py: appliance type and part
+    # numbers (A), the user's messages (B), the model's answers (C).
+    with op.batch_alter_table('chat_session', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('search_vector', postgresql.TSVECTOR(), server_default='', nullable=False))
+
+    op.execute("CREATE AGGREGATE tsvector_agg(tsvector) (SFUNC = tsvector_concat, STYPE = tsvector, INITCOND = '')")
+    op.execute(r"""
+        CREATE FUNCTION chat_message_search_vector(role text, parts json) RETURNS tsvector
+        LANGUAGE sql IMMUTABLE AS $$
+            SELECT setweight(to_tsvector('simple', coalesce(string_agg(part_number[1], ' '), '')), 'A')
+                   || setweight(to_tsvector('english', coalesce(string_agg(DISTINCT part->>'text', ' '), '')),
+                                CASE WHEN role = 'user' THEN 'B' ELSE 'C' END)
+            FROM json_array_elements(CASE WHEN json_typeof(parts) = 'array' THEN parts ELSE '[]'::json END) AS part
+            LEFT JOIN LATERAL regexp_matches(part->>'text', 'class="part-number">([^<]+)<', 'g') AS part_number ON true
+        $$
+    """)
+
+    # The appliance type is set once, when the session is created.
+    op.execute("""
+        CREATE FUNCTION chat_session_index_search() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.search_vector := setweight(to_tsvector('english', coalesce(NEW.appliance_type, '')), 'A');
+            RETURN NEW;
+        END $$
+    """)
+    op.execute("""
+        CREATE TRIGGER chat_session_index_search BEFORE INSERT ON chat_session
+        FOR EACH ROW EXECUTE FUNCTION chat_session_index_search()
+    """)
+
+    # Messages are append-only, so each insert statement extends its sessions' vectors once.
+    op.execute("""
+        CREATE FUNCTION chat_message_index_search() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE chat_session AS s
+               SET search_vector = s.search_vector || added.search_vector
+              FROM (SELECT session_uuid, tsvector_agg(chat_message_search_vector(role, parts) ORDER BY seq) AS search_vector
+                      FROM inserted GROUP BY session_uuid) AS added
+             WHERE s.session_uuid = added.session_uuid;
+            RETURN NULL;
+        END $$
+    """)
+    op.execute("""
+        CREATE TRIGGER chat_message_index_search AFTER INSERT ON chat_message
+        REFERENCING NEW TABLE AS inserted FOR EACH STATEMENT EXECUTE FUNCTION chat_message_index_search()
+    """)
+
+    op.execute("""
+        UPDATE chat_session AS s
+           SET search_vector = setweight(to_tsvector('english', coalesce(s.appliance_type, '')), 'A')
+               || coalesce((SELECT tsvector_agg(chat_message_search_vector(m.role, m.parts) ORDER BY m.seq)
+                              FROM chat_message AS m WHERE m.session_uuid = s.session_uuid), '')
+    """)
+    op.create_index('ix_chat_session_search', 'chat_session', ['search_vector'], unique=False, postgresql_using='gin')
+
+    # Called by ChatStore.search_sessions, directly or through PostgREST (/rpc). It runs as
+    # the caller, so row level security on chat_session still applies.
+    op.execute("""
+        CREATE FUNCTION search_chat_sessions(p_user_id chat_session.user_id%TYPE, p_query text,
+                                             p_limit integer, p_offset integer DEFAULT 0)
+        RETURNS TABLE (
+            session_uuid chat_session.session_uuid%TYPE,
+            user_id chat_session.user_id%TYPE,
+            start_time chat_session.start_time%TYPE,
+            appliance_type chat_session.appliance_type%TYPE,
+            preview_text chat_session.preview_text%TYPE,
+            message_count chat_session.message_count%TYPE,
+            last_activity chat_session.last_activity%TYPE,
+            history_version chat_session.history_version%TYPE,
+            prompt_tokens chat_session.prompt_tokens%TYPE,
+            output_tokens chat_session.output_tokens%TYPE,
+            max_prompt_tokens chat_session.max_prompt_tokens%TYPE,
+            rank real
+        )
+        LANGUAGE sql STABLE AS $$
+            SELECT s.session_uuid, s.user_id, s.start_time, s.appliance_type, s.preview_text, s.message_count,
+                   s.last_activity, s.history_version, s.prompt_tokens, s.output_tokens, s.max_prompt_tokens,
+                   ts_rank_cd(s.search_vector, q.query, 1) AS rank
+            FROM chat_session AS s, websearch_to_tsquery('english', p_query) AS q(query)
+            WHERE s.user_id = p_user_id AND s.search_vector @@ q.query
+            ORDER BY rank DESC, s.last_activity DESC NULLS LAST, s.session_uuid
+            LIMIT p_limit OFFSET p_offset
+        $$
+    """)
+
+
+def downgrade():
+    op.execute("DROP FUNCTION IF EXISTS search_chat_sessions")
+    op.execute("DROP TRIGGER IF EXISTS chat_message_index_search ON chat_message")
+    op.execute("DROP FUNCTION IF EXISTS chat_message_index_search")
+    op.execute("DROP TRIGGER IF EXISTS chat_session_index_search ON chat_session")
+    op.execute("DROP FUNCTION IF EXISTS chat_session_index_search")
+    op.execute("DROP FUNCTION IF EXISTS chat_message_search_vector")
+    op.execute("DROP AGGREGATE IF EXISTS tsvector_agg(tsvector)")
+    op.drop_index('ix_chat_session_search', table_name='chat_session', postgresql_using='gin')
+    with op.batch_alter_table('chat_session', schema=None) as batch_op:
+        batch_op.drop_column('search_vector')
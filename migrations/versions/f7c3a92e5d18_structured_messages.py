@@ -0,0 +1,87 @@
+"""Structured fields (sections, flowchart, part numbers) on model messages.
+
+Revision ID: f7c3a92e5d18
+Revises: e2b8f46a1d37
+Create Date: 2026-10-17 21:37:14.806225
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7c3a92e5d18'
+down_revision = 'e2b8f46a1d37'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def upgrade():
+    # Set by the app on every model message it saves; see solutions.extract_structured.
+    with op.batch_alter_table('chat_message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('structured', sa.JSON(), nullable=True))
+
+    # Parse the answers saved so far with the same code the app uses from now on.
+    from solutions import extract_structured
+
+    connection = op.get_bind()
+    chat_message = sa.table('chat_message',
+        sa.column('id', sa.Integer),
+        sa.column('role', sa.String),
+        sa.column('parts', sa.JSON),
+        sa.column('structured', sa.JSON),
+    )
+    last_id = 0
+    while True:
+        batch = connection.execute(
+            sa.select(chat_message.c.id, chat_message.c.parts)
+            .where(chat_message.c.role == 'model', chat_message.c.id > last_id)
+            .order_by(chat_message.c.id).limit(BACKFILL_BATCH_SIZE)
+        ).fetchall()
+        if not batch:
+            break
+        for message_id, parts in batch:
+            text = ''.join(part.get('text') or '' for part in parts or [] if isinstance(part, dict))
+            connection.execute(chat_message.update().where(chat_message.c.id == message_id)
+                               .values(structured=extract_structured(text)))
+        last_id = batch[-1][0]
+
+    # Index the stored part numbers instead of scanning the text for tags; messages without
+    # structured fields (user messages) still go through the two-argument function.
+    op.execute("""
+        CREATE FUNCTION chat_message_search_vector(role text, parts json, structured json) RETURNS tsvector
+        LANGUAGE sql IMMUTABLE AS $$
+            SELECT CASE WHEN structured IS NULL THEN chat_message_search_vector(role, parts) ELSE
+                setweight(to_tsvector('simple', coalesce((SELECT string_agg(part_number, ' ')
+                                                           FROM json_array_elements_text(structured->'part_numbers') AS part_number), '')), 'A')
+                || setweight(to_tsvector('english', coalesce((SELECT string_agg(part->>'text', ' ')
+                                                               FROM json_array_elements(CASE WHEN json_typeof(parts) = 'array' THEN parts ELSE '[]'::json END) AS part), '')),
+                             CASE WHEN role = 'user' THEN 'B' ELSE 'C' END)
+            END
+        $$
+    """)
+    _replace_message_trigger("chat_message_search_vector(role, parts, structured)")
+
+
+def downgrade():
+    _replace_message_trigger("chat_message_search_vector(role, parts)")
+    op.execute("DROP FUNCTION IF EXISTS chat_message_search_vector(text, json, json)")
+    with op.batch_alter_table('chat_message', schema=None) as batch_op:
+        batch_op.drop_column('structured')
+
+
+def _replace_message_trigger(vector):
+    # Same statement-level trigger as in the session_search migration, with the given vector call.
+    op.execute(f"""
+        CREATE OR REPLACE FUNCTION chat_message_index_search() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE chat_session AS s
+               SET search_vector = s.search_vector || added.search_vector
+              FROM (SELECT session_uuid, tsvector_agg({vector} ORDER BY seq) AS search_vector
+                      FROM inserted GROUP BY session_uuid) AS added
+             WHERE s.session_uuid = added.session_uuid;
+            RETURN NULL;
+        END $$
+    """)
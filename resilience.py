@@ -0,0 +1,226 @@
+"""
+Retries, deadlines and a circuit breaker for calls to the model API.
+
+`RetryPolicy.call` / `call_async` run one logical call: each attempt gets a timeout
+that never outlives the call's overall deadline, retryable failures (rate limits,
+5xx, timeouts, dropped connections) are retried with full-jitter exponential backoff,
+and every attempt's outcome feeds a `CircuitBreaker`. Once the recent failure rate
+crosses its threshold the breaker opens and calls fail fast with `CircuitOpenError`
+until a cool-down has passed and a trial call succeeds.
+"""
+import asyncio
+import collections
+import logging
+import math
+import random
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes (google.api_core exceptions carry them as `.code`) worth retrying.
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the upstream while the breaker is open."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"The model API is unavailable; retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    """True for errors that say nothing about the request itself (rate limits, outages, timeouts)."""
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS_CODES
+
+
+class CircuitBreaker:
+    """
+    Opens when at least `min_calls` calls were made in the last `window` seconds and at
+    least `failure_rate` of them failed. After `cooldown` seconds one trial call is let
+    through (half-open); its outcome closes the breaker or opens it again.
+    """
+
+    def __init__(self, failure_rate=0.5, min_calls=10, window=30, cooldown=30, name="gemini"):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.name = name
+        self._outcomes = collections.deque()  # (timestamp, failed)
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "open" if time.monotonic() - self._opened_at < self.cooldown else "half_open"
+
+    def retry_after(self):
+        """Seconds until the breaker lets a trial call through; 0 when it is not open."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0, math.ceil(self.cooldown - (time.monotonic() - self._opened_at)))
+
+    def before_call(self):
+        """
+        Returns:
+            bool: True if this call is the half-open trial; it must end in `record` or `release`.
+
+        Raises:
+            CircuitOpenError: If the breaker is open, or half-open with a trial call already running.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            remaining = self.cooldown - (time.monotonic() - self._opened_at)
+            if remaining > 0 or self._trial_in_flight:
+                raise CircuitOpenError(max(1, math.ceil(remaining)))
+            self._trial_in_flight = True
+            return True
+
+    def release(self):
+        """
+        Frees the trial slot of a trial call that ended without an outcome (cancelled, or
+        its client went away), so the next call can be the trial.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record(self, failed):
+        now = time.monotonic()
+        with self._lock:
+            if self._opened_at is not None:
+                if not self._trial_in_flight:
+                    return
+                self._trial_in_flight = False
+                if failed:
+                    self._opened_at = now
+                    logger.warning(f"CIRCUIT_LOG: {self.name} trial call failed; breaker stays open for {self.cooldown}s.")
+                else:
+                    self._opened_at = None
+                    self._outcomes.clear()
+                    metrics.CIRCUIT_OPEN.labels(self.name).set(0)
+                    logger.info(f"CIRCUIT_LOG: {self.name} trial call succeeded; breaker closed.")
+                return
+
+            self._outcomes.append((now, failed))
+            while self._outcomes and now - self._outcomes[0][0] > self.window:
+                self._outcomes.popleft()
+            failures = sum(1 for _, outcome in self._outcomes if outcome)
+            if len(self._outcomes) >= self.min_calls and failures >= self.failure_rate * len(self._outcomes):
+                self._opened_at = now
+                metrics.CIRCUIT_OPEN.labels(self.name).set(1)
+                logger.error(f"CIRCUIT_LOG: {self.name} breaker opened: {failures}/{len(self._outcomes)} calls failed "
+                             f"in the last {self.window}s; failing fast for {self.cooldown}s.")
+
+
+class RetryPolicy:
+    """
+    Args:
+        max_attempts (int): Attempts per call, including the first.
+        base_delay (float): Backoff before the first retry; doubles each retry, with full jitter.
+        max_delay (float): Cap on a single backoff.
+        attempt_timeout (float): Timeout passed to each attempt.
+        deadline (float): Overall budget for the call, retries and backoff included.
+        breaker (CircuitBreaker, optional): Checked before, and told the outcome of, every attempt.
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8, attempt_timeout=60, deadline=90, breaker=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.breaker = breaker
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def _next_delay(self, name, attempt, error, deadline_at, trial):
+        """Returns the backoff before the next attempt, or None if the error should be raised."""
+        if self.breaker is not None:
+            if is_retryable(error):
+                self.breaker.record(failed=True)
+            elif trial:
+                # A rejected request (e.g. a 400) says nothing about the upstream's health, so it
+                # neither closes nor re-opens the breaker; it only gives up the trial slot.
+                self.breaker.release()
+        if not is_retryable(error) or attempt >= self.max_attempts:
+            return None
+        delay = self._backoff(attempt)
+        if time.monotonic() + delay >= deadline_at:
+            return None
+        metrics.MODEL_RETRIES.labels(name).inc()
+        logger.warning(f"API_INTERFACE_LOG: {name} attempt {attempt} failed ({error}); retrying in {delay:.2f}s.")
+        return delay
+
+    def _timeout(self, deadline_at, whole_call):
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Model call deadline exceeded.")
+        return remaining if whole_call else min(self.attempt_timeout, remaining)
+
+    def call(self, name, fn, whole_call=False):
+        """
+        Calls `fn(timeout)` until it succeeds, fails with a non-retryable error, or runs
+        out of attempts or time. `whole_call` gives each attempt the rest of the deadline
+        rather than `attempt_timeout` (for streams, whose timeout covers the whole stream).
+        """
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = self._timeout(deadline_at, whole_call)
+            trial = self.breaker is not None and self.breaker.before_call()
+            try:
+                result = fn(timeout)
+            except Exception as e:
+                delay = self._next_delay(name, attempt, e, deadline_at, trial)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # KeyboardInterrupt, GeneratorExit and the like never reach record().
+                if trial:
+                    self.breaker.release()
+                raise
+            if self.breaker is not None:
+                self.breaker.record(failed=False)
+            return result
+
+    async def call_async(self, name, fn, whole_call=False):
+        """Async `call`; `fn(timeout)` returns an awaitable."""
+        deadline_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            timeout = self._timeout(deadline_at, whole_call)
+            trial = self.breaker is not None and self.breaker.before_call()
+            try:
+                result = await asyncio.wait_for(fn(timeout), timeout)
+            except Exception as e:
+                delay = self._next_delay(name, attempt, e, deadline_at, trial)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # A cancelled attempt (client disconnect, shutdown) never reaches record().
+                if trial:
+                    self.breaker.release()
+                raise
+            if self.breaker is not None:
+                self.breaker.record(failed=False)
+            return result
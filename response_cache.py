@@ -0,0 +1,182 @@
+import abc
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt):
+    """Lowercases a prompt and folds punctuation and runs of whitespace into single spaces."""
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", (prompt or "").lower())).strip()
+
+
+def make_cache_key(appliance_type, prompt):
+    """
+    Builds the cache key for a first-turn prompt.
+
+    Args:
+        appliance_type (str): The session's appliance type.
+        prompt (str): The user's raw first message.
+
+    Returns:
+        str: A hex digest of the normalized appliance type and prompt.
+    """
+    normalized = f"{normalize_prompt(appliance_type)}\x00{normalize_prompt(prompt)}"
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(abc.ABC):
+    """
+    Base class for first-turn response caches; tracks hit/miss counters.
+
+    Subclasses implement `_get`, `_set` and `_size`. Both backends evict least-recently-used
+    entries beyond `max_entries` and treat entries older than `ttl` seconds as missing.
+    """
+
+    def __init__(self, max_entries=1000, ttl=24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached response text for `key`, or None."""
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Stores response text under `key`."""
+        with self._lock:
+            self._set(key, value, time.time())
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": self._size()}
+
+    @abc.abstractmethod
+    def _get(self, key, now):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _set(self, key, value, now):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _size(self):
+        raise NotImplementedError
+
+
+class InMemoryResponseCache(ResponseCache):
+    """A per-process LRU+TTL response cache."""
+
+    def __init__(self, max_entries=1000, ttl=24 * 3600):
+        super().__init__(max_entries=max_entries, ttl=ttl)
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, stored_at = entry
+        if now - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, now):
+        self._entries[key] = (value, now)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _size(self):
+        return len(self._entries)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    A response cache in a local SQLite file, shared by every worker on the host.
+
+    Attributes:
+        path (str): The SQLite database file.
+    """
+
+    def __init__(self, path="response_cache.db", max_entries=1000, ttl=24 * 3600):
+        super().__init__(max_entries=max_entries, ttl=ttl)
+        self.path = path
+        self._conn = None
+
+    def _connection(self):
+        # Opened on first use (with the lock held), not in __init__: a preloaded app builds the
+        # cache in the gunicorn master, and SQLite connections must not be shared across fork().
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_last_access ON response_cache (last_access)")
+            self._conn = conn
+        return self._conn
+
+    def _get(self, key, now):
+        row = self._connection().execute("SELECT value, stored_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, stored_at = row
+        if now - stored_at > self.ttl:
+            self._connection().execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            return None
+        self._connection().execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key))
+        return value
+
+    def _set(self, key, value, now):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO response_cache (key, value, stored_at, last_access) VALUES (?, ?, ?, ?)",
+            (key, value, now, now),
+        )
+        self._connection().execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            " SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def _size(self):
+        return self._connection().execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+
+def create_response_cache(backend="memory", **kwargs):
+    """
+    Creates a response cache for the named backend.
+
+    Args:
+        backend (str): "memory" or "sqlite".
+        **kwargs: Passed to the backend's constructor.
+
+    Returns:
+        ResponseCache: The cache instance.
+
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    if backend == "memory":
+        return InMemoryResponseCache(**kwargs)
+    if backend == "sqlite":
+        return SQLiteResponseCache(**kwargs)
+    raise ValueError(f"Unknown response cache backend: {backend}")
@@ -0,0 +1,192 @@
+"""
+In-process full-text index over chat sessions.
+
+The Postgres backends search chat_session.search_vector (see the session_search
+migration); stores without a database-side index, like the SQLite one, keep a
+`SessionSearchIndex` in memory instead and update it as sessions and messages are
+written. Both index the same fields, weighted the same way: appliance type and part
+numbers highest, then the user's messages, then the model's answers.
+"""
+import math
+import re
+import threading
+
+# Part numbers are tagged by the model; see the system prompt in API_Interface.py.
+PART_NUMBER_PATTERN = re.compile(r'class="part-number">([^<]+)<')
+
+APPLIANCE_WEIGHT = 1.0
+PART_NUMBER_WEIGHT = 1.0
+USER_TEXT_WEIGHT = 0.4
+MODEL_TEXT_WEIGHT = 0.2
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset("""
+    a an and are as at be but by for from had has have how i if in into is it its me my no not
+    of on or our so that the their them then there these they this to was we were what when
+    which who why will with you your
+""".split())
+
+# BM25 parameters.
+_K1 = 1.2
+_B = 0.75
+
+
+def tokenize(text):
+    """Lower-cases `text` and splits it into index terms, dropping stopwords and plural endings."""
+    return [_stem(token) for token in _TOKEN_PATTERN.findall(text.lower()) if token not in _STOPWORDS]
+
+
+def _stem(token):
+    if len(token) > 4 and token.endswith('ies'):
+        return token[:-3] + 'y'
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss') and not token[-2].isdigit():
+        return token[:-1]
+    return token
+
+
+def message_terms(role, parts, structured=None):
+    """
+    Returns {term: weight} for one chat message, the way the index counts it.
+
+    The part numbers come from the message's stored structured fields (see
+    solutions.extract_structured) when it has them; older messages are scanned for tags.
+    """
+    terms = {}
+    text_weight = USER_TEXT_WEIGHT if role == 'user' else MODEL_TEXT_WEIGHT
+    texts = [part.get('text') for part in parts or [] if isinstance(part, dict) and part.get('text')]
+    if structured is not None:
+        part_numbers = structured.get('part_numbers') or []
+    else:
+        part_numbers = [part_number for text in texts for part_number in PART_NUMBER_PATTERN.findall(text)]
+    for part_number in part_numbers:
+        for term in tokenize(part_number):
+            terms[term] = terms.get(term, 0.0) + PART_NUMBER_WEIGHT
+    for text in texts:
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0.0) + text_weight
+    return terms
+
+
+class _Document:
+    __slots__ = ('user_id', 'terms', 'length', 'updated')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.terms = {}  # term -> weighted frequency
+        self.length = 0.0
+        self.updated = 0
+
+
+class _UserIndex:
+    """The postings for one user's sessions; scores only compare a user's own sessions."""
+
+    def __init__(self):
+        self.postings = {}  # term -> {session_uuid: weighted frequency}
+        self.sessions = set()
+        self.total_length = 0.0
+
+    def add(self, session_uuid, doc, terms):
+        self.sessions.add(session_uuid)
+        for term, weight in terms.items():
+            postings = self.postings.setdefault(term, {})
+            postings[session_uuid] = postings.get(session_uuid, 0.0) + weight
+            doc.terms[term] = doc.terms.get(term, 0.0) + weight
+        added = sum(terms.values())
+        doc.length += added
+        self.total_length += added
+
+    def remove(self, session_uuid, doc):
+        for term in doc.terms:
+            postings = self.postings[term]
+            del postings[session_uuid]
+            if not postings:
+                del self.postings[term]
+        self.sessions.discard(session_uuid)
+        self.total_length -= doc.length
+
+
+class SessionSearchIndex:
+    """
+    Inverted index from terms to sessions, ranked with BM25 over weighted term counts.
+
+    A query matches sessions that contain every one of its terms, anywhere in the
+    conversation or its appliance type. Thread-safe.
+    """
+
+    def __init__(self):
+        self._documents = {}  # session_uuid -> _Document
+        self._users = {}  # user_id -> _UserIndex
+        self._clock = 0  # orders sessions by their last write, for ties
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add_session(self, session_uuid, user_id, appliance_type):
+        terms = {term: APPLIANCE_WEIGHT for term in tokenize(appliance_type or '')}
+        with self._lock:
+            doc = self._documents.get(session_uuid)
+            if doc is None:
+                doc = self._documents[session_uuid] = _Document(str(user_id))
+            self._add(session_uuid, doc, terms)
+
+    def add_messages(self, rows):
+        """Indexes chat_message rows (with session_uuid, role, parts and optionally structured) of known sessions."""
+        with self._lock:
+            for row in rows:
+                doc = self._documents.get(row['session_uuid'])
+                if doc is not None:
+                    self._add(row['session_uuid'], doc, message_terms(row['role'], row['parts'], row.get('structured')))
+
+    def remove_session(self, session_uuid):
+        with self._lock:
+            doc = self._documents.pop(session_uuid, None)
+            if doc is None:
+                return
+            user = self._users[doc.user_id]
+            user.remove(session_uuid, doc)
+            if not user.sessions:
+                del self._users[doc.user_id]
+
+    def search(self, user_id, query, limit, offset=0):
+        """
+        Ranks the user's sessions against `query`.
+
+        Returns:
+            list: (session_uuid, score) pairs for one page, best first; ties go to the
+            session written most recently.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self._lock:
+            user = self._users.get(str(user_id))
+            if user is None:
+                return []
+            postings = [user.postings.get(term) for term in terms]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            sessions = len(user.sessions)
+            average_length = user.total_length / sessions or 1.0
+            scored = []
+            for session_uuid in candidates:
+                doc = self._documents[session_uuid]
+                score = 0.0
+                for posting in postings:
+                    frequency = posting[session_uuid]
+                    idf = math.log(1 + (sessions - len(posting) + 0.5) / (len(posting) + 0.5))
+                    norm = 1 - _B + _B * doc.length / average_length
+                    score += idf * frequency * (_K1 + 1) / (frequency + _K1 * norm)
+                scored.append((score, doc.updated, session_uuid))
+        scored.sort(reverse=True)
+        return [(session_uuid, round(score, 6)) for score, _, session_uuid in scored[offset:offset + limit]]
+
+    def _add(self, session_uuid, doc, terms):
+        self._clock += 1
+        doc.updated = self._clock
+        user = self._users.get(doc.user_id)
+        if user is None:
+            user = self._users[doc.user_id] = _UserIndex()
+        user.add(session_uuid, doc, terms)
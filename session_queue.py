@@ -0,0 +1,126 @@
+"""
+Per-session turn ordering.
+
+Turns for the same chat session run one at a time, in arrival order, while turns for
+different sessions never wait on each other. This only orders turns within one process;
+across workers the history version check in app._append_session_history rejects the
+loser of a race instead.
+"""
+import asyncio
+import collections
+import contextlib
+import threading
+
+import metrics
+
+
+class SessionBusyError(Exception):
+    """Raised when a turn waited longer than allowed for the session's earlier turns."""
+
+
+class SessionQueue:
+    """FIFO queue of turns per session key, for threads."""
+
+    def __init__(self):
+        self._queues = {}  # key -> deque of threading.Event; the head holds the turn
+        self._lock = threading.Lock()
+
+    def acquire(self, key, timeout):
+        """
+        Waits for the session's earlier turns, then holds the turn.
+
+        Returns:
+            object: A ticket to pass to `release`.
+
+        Raises:
+            SessionBusyError: If the turn could not start within `timeout` seconds.
+        """
+        with metrics.phase("session_queue"):
+            return self._acquire(key, timeout)
+
+    def _acquire(self, key, timeout):
+        ticket = threading.Event()
+        with self._lock:
+            queue = self._queues.setdefault(key, collections.deque())
+            queue.append(ticket)
+            if len(queue) == 1:
+                ticket.set()
+        if ticket.wait(timeout):
+            return ticket
+        with self._lock:
+            if ticket.is_set():
+                # The turn came up just as the wait timed out.
+                return ticket
+            self._remove(key, ticket)
+        raise SessionBusyError(f"Timed out after {timeout}s waiting for earlier turns in session {key}.")
+
+    def release(self, key, ticket):
+        """Ends the turn and starts the next queued one; a no-op if already released."""
+        with self._lock:
+            queue = self._queues.get(key)
+            if not queue or queue[0] is not ticket:
+                return
+            queue.popleft()
+            if queue:
+                queue[0].set()
+            else:
+                del self._queues[key]
+
+    @contextlib.contextmanager
+    def turn(self, key, timeout):
+        ticket = self.acquire(key, timeout)
+        try:
+            yield
+        finally:
+            self.release(key, ticket)
+
+    def _remove(self, key, ticket):
+        queue = self._queues[key]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[key]
+
+
+class AsyncSessionQueue:
+    """`SessionQueue` for coroutines on a single event loop."""
+
+    def __init__(self):
+        self._queues = {}  # key -> deque of futures; the head holds the turn
+
+    async def acquire(self, key, timeout):
+        with metrics.phase("session_queue"):
+            return await self._acquire(key, timeout)
+
+    async def _acquire(self, key, timeout):
+        ticket = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(key, collections.deque())
+        queue.append(ticket)
+        if len(queue) == 1:
+            ticket.set_result(None)
+            return ticket
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.done():
+                if isinstance(e, asyncio.TimeoutError):
+                    return ticket
+                # Cancelled just as the turn came up; pass it on.
+                self.release(key, ticket)
+            else:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[key]
+            if isinstance(e, asyncio.TimeoutError):
+                raise SessionBusyError(f"Timed out after {timeout}s waiting for earlier turns in session {key}.") from None
+            raise
+        return ticket
+
+    def release(self, key, ticket):
+        queue = self._queues.get(key)
+        if not queue or queue[0] is not ticket:
+            return
+        queue.popleft()
+        if queue:
+            queue[0].set_result(None)
+        else:
+            del self._queues[key]
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class Flight:
+    """One in-progress (or finished) call; waiters block until `finish` is called."""
+
+    def __init__(self):
+        self.result = None
+        self.expires_at = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout):
+        """
+        Waits for the leader to finish.
+
+        Returns:
+            tuple: (finished, result). `result` is None if the leader failed.
+        """
+        finished = self._done.wait(timeout)
+        return finished, self.result
+
+    async def wait_async(self, timeout):
+        """`wait` without blocking the event loop."""
+        return await asyncio.to_thread(self.wait, timeout)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key onto one leader, and remembers each
+    successful result for a per-call `ttl` so repeats are replayed rather than re-run.
+
+    Usage: `claim(key)` returns ('done', result), ('wait', flight) or ('lead', flight).
+    A leader must always call `finish(key, flight, result, ttl)`; a None result (failure)
+    is not remembered and wakes the waiters so one of them can lead instead.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._flights = OrderedDict()  # key -> Flight
+        self._lock = threading.Lock()
+
+    def claim(self, key, accept=None):
+        """
+        Args:
+            key (str): Identifies the call.
+            accept (callable, optional): Given a remembered result, returns False if it no
+                                         longer applies; the caller then leads a new call.
+        """
+        now = time.monotonic()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                if not flight.done:
+                    return "wait", flight
+                if flight.expires_at > now and (accept is None or accept(flight.result)):
+                    self._flights.move_to_end(key)
+                    return "done", flight.result
+            flight = Flight()
+            self._flights[key] = flight
+            self._evict()
+            return "lead", flight
+
+    def finish(self, key, flight, result, ttl=0):
+        """Publishes the leader's result; safe to call more than once (later calls are ignored)."""
+        with self._lock:
+            if flight.done:
+                return
+            flight.result = result
+            flight.expires_at = time.monotonic() + ttl
+            if (result is None or ttl <= 0) and self._flights.get(key) is flight:
+                del self._flights[key]
+            flight._done.set()
+
+    def _evict(self):
+        # Finished entries are evicted oldest first; in-progress flights are never dropped.
+        for key in list(self._flights):
+            if len(self._flights) <= self.max_entries:
+                break
+            if self._flights[key].done:
+                del self._flights[key]
@@ -0,0 +1,329 @@
+"""
+Retrieval of previously solved repair sessions.
+
+Many diagnoses repeat across users: the same model number, the same error code. When a
+session's answer contains the final solution (see solutions.is_solution), its Summary,
+Troubleshooting Walk-through and Part Recommendation sections are indexed under the
+session's appliance type, brand, model number, error codes and part numbers. When a later
+session starts its chat, the closest solved sessions for the same appliance type are
+passed to the model as compact reference notes (see `format_references`), so it can get to
+the answer with fewer clarifying questions.
+
+Matches are scored with BM25 over weighted terms. The postings are kept as a compressed
+sparse row matrix (term -> sessions) in NumPy arrays, rebuilt after writes, so a query
+scores every entry with a handful of array operations. NumPy is imported on the first
+search rather than with this module, to keep it off the app's cold-start path.
+"""
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+from search_index import tokenize
+from solutions import part_numbers
+
+logger = logging.getLogger(__name__)
+
+# Key terms are prefixed so they never collide with words of the same spelling.
+BRAND_WEIGHT = 2.0
+MODEL_WEIGHT = 4.0
+SERIES_WEIGHT = 2.0
+ERROR_CODE_WEIGHT = 4.0
+PART_NUMBER_WEIGHT = 1.0
+TEXT_WEIGHT = 0.5
+
+BRANDS = (
+    'amana', 'asko', 'beko', 'bosch', 'dacor', 'electrolux', 'fisher paykel', 'frigidaire', 'ge', 'haier',
+    'hotpoint', 'jennair', 'kenmore', 'kitchenaid', 'lg', 'maytag', 'miele', 'roper', 'samsung', 'sharp',
+    'speed queen', 'sub-zero', 'thermador', 'viking', 'whirlpool',
+)
+_BRAND_PATTERN = re.compile(r'\b(' + '|'.join(re.escape(brand).replace(r'\ ', r'[\s&-]*') for brand in BRANDS) + r')\b', re.IGNORECASE)
+# Model numbers mix letters and digits and run at least six characters (e.g. wtw5000dw1).
+_MODEL_PATTERN = re.compile(r'\b(?=[a-z0-9-]*\d)(?=[a-z0-9-]*[a-z])[a-z0-9][a-z0-9-]{5,19}\b', re.IGNORECASE)
+# Error codes follow the word error, code or fault: "error code f21", "oe code", "code: 5e".
+_ERROR_CODE_PATTERN = re.compile(
+    r'\b(?:error|fault)(?:[ \t]+code)?[ \t]*[:#]?[ \t]*["\']?([a-z]{0,3}-?\d{1,3}[a-z]?|[a-z]{1,3})\b'
+    r'|\b([a-z]{0,3}-?\d{1,3}[a-z]?|[a-z]{2})[ \t]+(?:error|fault)?[ \t]*code\b',
+    re.IGNORECASE)
+_NOT_ERROR_CODES = frozenset(('a', 'an', 'the', 'no', 'any', 'my', 'is', 'in', 'on', 'of', 'or', 'and', 'to', 'it', 'its'))
+
+# BM25 parameters.
+_K1 = 1.2
+_B = 0.75
+
+
+def solution_keys(texts):
+    """
+    Pulls the lookup keys out of a conversation's text.
+
+    Args:
+        texts (list of str): The messages to scan, usually the user's.
+
+    Returns:
+        dict: 'brands', 'model_numbers' and 'error_codes', each a list of lower-case
+        strings in order of appearance, without repeats.
+    """
+    brands, models, codes = {}, {}, {}
+    for text in texts:
+        for brand in _BRAND_PATTERN.findall(text):
+            brands.setdefault(re.sub(r'[\s&-]+', ' ', brand.lower()), None)
+        for match in _ERROR_CODE_PATTERN.finditer(text):
+            code = (match.group(1) or match.group(2)).lower().replace('-', '')
+            if code not in _NOT_ERROR_CODES:
+                codes.setdefault(code, None)
+        for model in _MODEL_PATTERN.findall(text):
+            models.setdefault(model.lower().replace('-', ''), None)
+    for code in codes:
+        models.pop(code, None)
+    return {'brands': list(brands), 'model_numbers': list(models), 'error_codes': list(codes)}
+
+
+def _weighted_terms(keys, text, part_number_list=()):
+    terms = {}
+
+    def add(term, weight):
+        terms[term] = terms.get(term, 0.0) + weight
+
+    for brand in keys.get('brands', ()):
+        add(f'brand:{brand}', BRAND_WEIGHT)
+    for model in keys.get('model_numbers', ()):
+        add(f'model:{model}', MODEL_WEIGHT)
+        # Models of one series share a prefix (wtw5000dw0, wtw5000dw1); match those too.
+        add(f'series:{model[:6]}', SERIES_WEIGHT)
+    for code in keys.get('error_codes', ()):
+        add(f'code:{code}', ERROR_CODE_WEIGHT)
+    for part_number in part_number_list:
+        add(f'part:{part_number.lower()}', PART_NUMBER_WEIGHT)
+    for term in tokenize(text):
+        add(term, TEXT_WEIGHT)
+    return terms
+
+
+def _normalize_appliance(appliance_type):
+    return ' '.join(tokenize(appliance_type or ''))
+
+
+class SolutionIndex:
+    """
+    In-memory index of solved sessions. Subclasses may persist the entries.
+
+    Args:
+        max_entries (int): Entries kept; the oldest are dropped beyond it.
+        min_score (float): Matches scoring below this are not returned.
+        section_max_chars (int): Each stored section is cut to this length.
+    """
+
+    def __init__(self, max_entries=5000, min_score=3.0, section_max_chars=600):
+        self.max_entries = max_entries
+        self.min_score = min_score
+        self.section_max_chars = section_max_chars
+        self._entries = {}  # session_uuid -> entry dict, oldest first
+        self._lock = threading.Lock()
+        self._matrix = None  # built on the next search after a change
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, session_uuid):
+        self._refresh()
+        return session_uuid in self._entries
+
+    def add(self, session_uuid, appliance_type, user_texts, sections):
+        """
+        Indexes (or re-indexes) a solved session.
+
+        Args:
+            session_uuid (str): The session; a later solution in it replaces the earlier one.
+            appliance_type (str): The session's appliance type.
+            user_texts (list of str): The user's messages, for the brand, model and error codes.
+            sections (dict): The solution's sections (see solutions.extract_sections).
+        """
+        entry = {
+            'session_uuid': session_uuid,
+            'appliance_type': appliance_type or '',
+            'keys': solution_keys(user_texts),
+            'sections': {key: sections[key][:self.section_max_chars]
+                         for key in ('summary', 'troubleshooting', 'part_recommendation') if sections.get(key)},
+            'problem': ' '.join(user_texts)[:self.section_max_chars],
+            'part_numbers': part_numbers(sections.get('part_recommendation', '') + sections.get('troubleshooting', '')),
+            'added_at': time.time(),
+        }
+        self._put(entry)
+        self._persist(entry)
+
+    def search(self, appliance_type, texts, limit=2):
+        """
+        Finds solved sessions of the same appliance type that look like this conversation.
+
+        Args:
+            appliance_type (str): The new session's appliance type.
+            texts (list of str): The user's messages so far, including the current prompt.
+            limit (int): Maximum number of matches.
+
+        Returns:
+            list of dict: Entries (with a 'score') best first, all scoring at least `min_score`.
+        """
+        self._refresh()
+        keys = solution_keys(texts)
+        query = _weighted_terms(keys, ' '.join(texts))
+        appliance = _normalize_appliance(appliance_type)
+        with self._lock:
+            if not self._entries or not query:
+                return []
+            if self._matrix is None:
+                self._matrix = self._build_matrix()
+            matrix = self._matrix
+        import numpy as np
+        vocabulary, indptr, docs, weights, lengths, appliances, entries = matrix
+        term_ids = np.array([vocabulary[term] for term in query if term in vocabulary], dtype=np.int64)
+        if not term_ids.size:
+            return []
+        starts, ends = indptr[term_ids], indptr[term_ids + 1]
+        counts = ends - starts
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        hit_docs, frequency = docs[positions], weights[positions]
+        document_frequency = counts.astype(np.float64)
+        idf = np.log(1 + (len(entries) - document_frequency + 0.5) / (document_frequency + 0.5))
+        query_weight = np.array([query[term] for term in query if term in vocabulary])
+        norm = 1 - _B + _B * lengths[hit_docs] / lengths.mean()
+        contributions = np.repeat(idf * query_weight, counts) * frequency * (_K1 + 1) / (frequency + _K1 * norm)
+        scores = np.bincount(hit_docs, weights=contributions, minlength=len(entries))
+        scores[appliances != appliance] = 0.0
+        best = np.argsort(-scores, kind='stable')[:limit]
+        return [{**entries[i], 'score': round(float(scores[i]), 3)} for i in best if scores[i] >= self.min_score]
+
+    def _put(self, entry):
+        with self._lock:
+            self._entries.pop(entry['session_uuid'], None)
+            self._entries[entry['session_uuid']] = entry
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            self._matrix = None
+
+    def _build_matrix(self):
+        """Lays the postings out as CSR arrays: for term t, rows indptr[t]:indptr[t + 1]."""
+        import numpy as np
+        entries = list(self._entries.values())
+        postings = {}
+        lengths = np.zeros(len(entries))
+        for doc, entry in enumerate(entries):
+            terms = _weighted_terms(entry['keys'], ' '.join([entry['problem']] + list(entry['sections'].values())),
+                                    entry['part_numbers'])
+            for term, weight in terms.items():
+                postings.setdefault(term, []).append((doc, weight))
+            lengths[doc] = sum(terms.values())
+        vocabulary = {term: i for i, term in enumerate(postings)}
+        indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(rows) for rows in postings.values()])
+        flat = [row for rows in postings.values() for row in rows]
+        docs = np.array([doc for doc, _ in flat], dtype=np.int64)
+        weights = np.array([weight for _, weight in flat], dtype=np.float64)
+        appliances = np.array([_normalize_appliance(entry['appliance_type']) for entry in entries], dtype=object)
+        lengths[lengths == 0] = 1.0
+        return vocabulary, indptr, docs, weights, lengths, appliances, entries
+
+    def _persist(self, entry):
+        pass
+
+    def _refresh(self):
+        pass
+
+
+class SQLiteSolutionIndex(SolutionIndex):
+    """
+    A solution index whose entries are also kept in a local SQLite file, so they survive
+    restarts and every worker on the host sees the others' entries (picked up before each
+    search).
+
+    The file is opened, and the saved entries loaded, on first use rather than in __init__:
+    a preloaded app builds the index in the gunicorn master, and SQLite connections must not
+    be shared across fork().
+
+    Attributes:
+        path (str): The SQLite database file.
+    """
+
+    def __init__(self, path="solution_index.db", **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._conn = None
+        self._db_lock = threading.Lock()
+        self._last_id = 0
+
+    def _connection(self):
+        # Called with _db_lock held.
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS solved_session ("
+                " id INTEGER PRIMARY KEY, session_uuid TEXT NOT NULL UNIQUE, entry TEXT NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _persist(self, entry):
+        with self._db_lock:
+            # REPLACE gives a re-indexed session a new id, so other workers pick it up again.
+            self._connection().execute("INSERT OR REPLACE INTO solved_session (session_uuid, entry) VALUES (?, ?)",
+                               (entry['session_uuid'], json.dumps(entry)))
+            self._connection().execute("DELETE FROM solved_session WHERE id IN ("
+                               " SELECT id FROM solved_session ORDER BY id DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def _refresh(self):
+        with self._db_lock:
+            first_load = self._conn is None
+            rows = self._connection().execute("SELECT id, entry FROM solved_session WHERE id > ? ORDER BY id LIMIT ?",
+                                              (self._last_id, self.max_entries)).fetchall()
+            if rows:
+                self._last_id = rows[-1][0]
+        for _, entry in rows:
+            self._put(json.loads(entry))
+        if first_load:
+            logger.info(f"Solution index loaded {len(rows)} solved session(s) from {self.path}.")
+
+
+def format_references(matches, max_chars=2000):
+    """
+    Renders matches as the reference notes given to the model.
+
+    Returns:
+        str: The notes, or None if there are no matches.
+    """
+    if not matches:
+        return None
+    lines = ["reference notes from similar repairs that were already solved. use them only where they fit "
+             "this user's appliance and symptoms, and still confirm the details with the user:"]
+    for i, match in enumerate(matches, 1):
+        keys = match['keys']
+        label = ', '.join(filter(None, [match['appliance_type'], ' '.join(keys['brands'][:1] + keys['model_numbers'][:1]),
+                                        ' '.join(f'code {code}' for code in keys['error_codes'][:2])]))
+        note = [f"{i}. {label}".rstrip()]
+        for key, title in (('summary', 'summary'), ('troubleshooting', 'fix'), ('part_recommendation', 'parts')):
+            if match['sections'].get(key):
+                note.append(f"   {title}: {' '.join(match['sections'][key].split())}")
+        lines.append('\n'.join(note))
+    return '\n'.join(lines)[:max_chars]
+
+
+def create_solution_index(backend="memory", **kwargs):
+    """
+    Creates a solution index for the named backend.
+
+    Args:
+        backend (str): "memory" or "sqlite".
+        **kwargs: Passed to the backend's constructor.
+
+    Returns:
+        SolutionIndex: The index instance.
+
+    Raises:
+        ValueError: If the backend name is unknown.
+    """
+    if backend == "memory":
+        return SolutionIndex(**kwargs)
+    if backend == "sqlite":
+        return SQLiteSolutionIndex(**kwargs)
+    raise ValueError(f"Unknown solution index backend: {backend}")
@@ -0,0 +1,168 @@
+"""
+Parsing of the model's structured repair answers.
+
+The system prompt (API_Interface.py) asks for a final answer with fixed markdown sections:
+Summary, Troubleshooting Walk-through, Helpful Questions, Troubleshooting Flowchart and
+Part Recommendation. `extract_sections` splits a reply into those sections so the rest of
+the app can use them without re-reading the whole text.
+
+`extract_structured` is run once per model message, when the turn is saved: its result
+(sections, the checked Mermaid flowchart and the part numbers) is stored with the message
+in chat_message.structured and returned by the API, so neither the frontend nor search
+indexing has to parse saved answers again.
+"""
+import re
+
+from search_index import PART_NUMBER_PATTERN
+
+# Canonical section keys, by the heading the system prompt asks for.
+SECTION_HEADINGS = {
+    'summary': 'Summary',
+    'troubleshooting': 'Troubleshooting Walk-through',
+    'helpful_questions': 'Helpful Questions',
+    'flowchart': 'Troubleshooting Flowchart',
+    'part_recommendation': 'Part Recommendation',
+}
+
+# A heading is the section name in bold or as a markdown heading, optionally in a list item;
+# the model answers in lower case and varies the punctuation.
+_HEADING_PATTERN = re.compile(
+    r'^[ \t]*(?:[-*+][ \t]+)?(?:#{1,6}[ \t]*)?(?:\*\*|__)?[ \t]*'
+    r'(summary|troubleshooting[ \t-]*walk[ \t-]*through|helpful[ \t]+questions|troubleshooting[ \t]+flowchart|part[ \t]+recommendations?)'
+    r'[ \t]*:?[ \t]*(?:\*\*|__)?[ \t]*:?',
+    re.IGNORECASE | re.MULTILINE)
+_HEADING_MARKUP = re.compile(r'[*_#:]')
+
+# The first ```mermaid block, as the frontend used to find it.
+_MERMAID_BLOCK = re.compile(r'```mermaid[ \t]*\n?(.*?)```', re.IGNORECASE | re.DOTALL)
+_FLOWCHART_HEADER = re.compile(r'(?:graph|flowchart)(?:[ \t]+(?:TB|TD|BT|RL|LR))?[ \t]*;?')
+# A node reference: an id, optionally with a shape. Quoted labels may hold anything but a
+# double quote; unquoted ones no brackets or quotes, which Mermaid would read as syntax.
+_NODE = (r'[A-Za-z0-9_]+(?:[ \t]*(?:'
+         r'\(\["[^"]*"\]\)|\[\["[^"]*"\]\]|\(\("[^"]*"\)\)|\{\{"[^"]*"\}\}|\["[^"]*"\]|\{"[^"]*"\}|\("[^"]*"\)|>"[^"]*"\]'
+         r'|\(\[[^\[\](){}"]*\]\)|\[\[[^\[\](){}"]*\]\]|\(\([^\[\](){}"]*\)\)|\[[^\[\](){}"]*\]|\{[^\[\](){}"]*\}|\([^\[\](){}"]*\)))?')
+_NODES = rf'{_NODE}(?:[ \t]*&[ \t]*{_NODE})*'
+_LINK = r'[ \t]*(?:<?(?:-{2,}>|-{3,}|-\.+->?|={2,}>|={3,}|--[ox]|--[ \t][^|;]*?[ \t]-->)(?:[ \t]*\|[^|"]*\|)?)[ \t]*'
+_STATEMENT = re.compile(rf'{_NODES}(?:{_LINK}{_NODES})*')
+# Statements end at a semicolon outside a quoted label, or at the end of the line.
+_STATEMENT_END = re.compile(r';(?=(?:[^"]*"[^"]*")*[^"]*$)')
+_DIRECTIVE = re.compile(r'(?:classDef|class|style|linkStyle|click|direction|subgraph)\b.*|end')
+
+
+def _section_key(heading):
+    heading = heading.lower()
+    if heading.startswith('summary'):
+        return 'summary'
+    if heading.startswith('helpful'):
+        return 'helpful_questions'
+    if heading.startswith('part'):
+        return 'part_recommendation'
+    if 'flowchart' in heading:
+        return 'flowchart'
+    return 'troubleshooting'
+
+
+def extract_sections(text):
+    """
+    Splits a model reply into its solution sections.
+
+    Args:
+        text (str): The reply's markdown.
+
+    Returns:
+        dict: Section key (see SECTION_HEADINGS) -> the section's text, stripped, in the
+        order they appear. Text before the first heading is dropped; if a heading repeats,
+        the first occurrence wins. Empty if the reply has no section headings.
+    """
+    # A bare word at the start of a line is only a heading with markup or a colon.
+    matches = [match for match in _HEADING_PATTERN.finditer(text or '') if _HEADING_MARKUP.search(match.group(0))]
+    sections = {}
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        key = _section_key(match.group(1))
+        body = text[match.end():end].strip()
+        if key not in sections and body:
+            sections[key] = body
+    return sections
+
+
+def is_solution(sections):
+    """True if the sections make up a final answer rather than a clarifying question."""
+    return 'summary' in sections and ('troubleshooting' in sections or 'part_recommendation' in sections)
+
+
+def part_numbers(text):
+    """Returns the part numbers tagged in `text`, in order and without repeats."""
+    seen = {}
+    for part_number in PART_NUMBER_PATTERN.findall(text or ''):
+        seen.setdefault(part_number.strip(), None)
+    return [part_number for part_number in seen if part_number]
+
+
+def extract_flowchart(text):
+    """
+    Finds the reply's Mermaid flowchart and checks its syntax.
+
+    Returns:
+        dict: {'source': the diagram code, 'valid': bool, 'error': why it is invalid, or
+        None}, or None if the reply has no ```mermaid block.
+    """
+    match = _MERMAID_BLOCK.search(text or '')
+    if match is None:
+        return None
+    source = match.group(1).strip()
+    error = validate_flowchart(source)
+    return {'source': source, 'valid': error is None, 'error': error}
+
+
+def validate_flowchart(source):
+    """
+    Checks Mermaid flowchart code against the rules the system prompt gives the model.
+
+    This is not a full Mermaid parser: it accepts the header, node and link statements
+    (with quoted or plain labels), subgraphs and styling directives, and rejects what
+    breaks rendering in practice, such as double quotes or brackets inside a label.
+
+    Returns:
+        str: The first problem found, with its line number, or None if the code is valid.
+    """
+    lines = [line.strip() for line in source.splitlines()]
+    statements = [(number, statement.strip()) for number, line in enumerate(lines, 1) if not line.startswith('%%')
+                  for statement in _STATEMENT_END.split(line) if statement.strip()]
+    if not statements:
+        return "the flowchart is empty"
+    number, header = statements[0]
+    # The header may share its line with the first statement ("graph TD; A --> B").
+    if not _FLOWCHART_HEADER.fullmatch(header):
+        return f"line {number}: expected 'graph TD' or another flowchart header, got {header[:40]!r}"
+    depth = 0
+    for number, statement in statements[1:]:
+        if statement == 'end':
+            depth -= 1
+            if depth < 0:
+                return f"line {number}: 'end' without a subgraph"
+        elif statement.startswith('subgraph'):
+            depth += 1
+        elif not (_DIRECTIVE.fullmatch(statement) or _STATEMENT.fullmatch(statement)):
+            return f"line {number}: cannot parse {statement[:60]!r}"
+    if depth:
+        return "a subgraph is missing its 'end'"
+    return None
+
+
+def extract_structured(text):
+    """
+    Parses a model reply into the fields stored with it (chat_message.structured).
+
+    Returns:
+        dict: 'sections' (see extract_sections; the flowchart section is left out, as it
+        is in 'flowchart'), 'flowchart' (see extract_flowchart), 'part_numbers' and
+        'is_solution'.
+    """
+    sections = extract_sections(text)
+    return {
+        'sections': {key: body for key, body in sections.items() if key != 'flowchart'},
+        'flowchart': extract_flowchart(text),
+        'part_numbers': part_numbers(text),
+        'is_solution': is_solution(sections),
+    }
@@ -0,0 +1,98 @@
+"""
+Cold-start report: `python startup_report.py [--top N] [--with-clients] [--max-import-ms MS]`.
+
+Imports the app in a fresh interpreter with `-X importtime` (and DEFER_CLIENT_INIT set,
+so no clients are created) and prints the total import time and the slowest top-level
+imports. With --with-clients it also creates and warms the clients in a second fresh
+interpreter and prints the per-phase timings that /readyz reports.
+
+Exits with status 1 when the app import exceeds --max-import-ms, so CI can catch
+cold-start regressions.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_CLIENTS_SCRIPT = """
+import json, sys, app
+app.init_clients()
+ready = app.clients_ready.wait(float(sys.argv[1]))
+app.draining.set()
+print(json.dumps({"ready": ready, **app.startup_timings}))
+"""
+
+
+def measure_imports(module="app"):
+    """
+    Imports `module` in a fresh interpreter and parses its `-X importtime` output.
+
+    Returns:
+        tuple: (total_ms, list of (cumulative_ms, self_ms, name) for the modules `module`
+               imports directly).
+    """
+    env = dict(os.environ, DEFER_CLIENT_INIT="1")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=PROJECT_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    direct = []
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        # Imports are indented two spaces per level under the module that triggered them,
+        # and a module's own line comes after all of its children.
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        name = name.strip()
+        if depth == 1:
+            direct.append((int(cumulative_us) / 1000, int(self_us) / 1000, name))
+        elif depth == 0:
+            if name == module:
+                total_us = int(cumulative_us)
+                break
+            direct = []
+    return total_us / 1000, direct
+
+
+def measure_clients(timeout=60):
+    """Creates and warms the clients in a fresh interpreter; returns the startup timings dict."""
+    result = subprocess.run([sys.executable, "-c", _CLIENTS_SCRIPT, str(timeout)],
+                            cwd=PROJECT_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Client initialization failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the app's cold-start import and initialization time.")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest direct imports to list.")
+    parser.add_argument("--with-clients", action="store_true", help="Also time client creation and warm-up.")
+    parser.add_argument("--max-import-ms", type=float, default=None, help="Fail if the app import takes longer.")
+    args = parser.parse_args(argv)
+
+    total_ms, imports = measure_imports()
+    print(f"app import: {total_ms:.1f} ms")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for cumulative_ms, self_ms, name in sorted(imports, reverse=True)[:args.top]:
+        print(f"{cumulative_ms:>14.1f} {self_ms:>9.1f}  {name}")
+
+    if args.with_clients:
+        timings = measure_clients()
+        print("client startup:")
+        for phase, value in timings.items():
+            print(f"  {phase}: {value}")
+
+    if args.max_import_ms is not None and total_ms > args.max_import_ms:
+        print(f"FAIL: app import took {total_ms:.1f} ms (limit {args.max_import_ms:.1f} ms)", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import pytest
+
+from chat_store import HistoryConflictError, SQLiteChatStore, _keyset
+
+
+def _message_row(session_uuid, seq, role="user", text="hello"):
+    return {'session_uuid': session_uuid, 'seq': seq, 'role': role, 'parts': [{'text': text}]}
+
+
+def test_appending_at_a_taken_seq_raises_history_conflict():
+    store = SQLiteChatStore(":memory:")
+    session = store.create_session("user-1", "Dishwasher")
+    store.append_messages([_message_row(session['session_uuid'], 0), _message_row(session['session_uuid'], 1, "model")])
+
+    with pytest.raises(HistoryConflictError):
+        store.append_messages([_message_row(session['session_uuid'], 1, "user", "from another worker")])
+    # The losing batch is rolled back as a whole.
+    assert [message['parts'] for message in store.load_messages(session['session_uuid'])] == [[{'text': 'hello'}]] * 2
+
+
+def test_summary_update_with_a_stale_version_is_rejected():
+    store = SQLiteChatStore(":memory:")
+    session_uuid = store.create_session("user-1", "Dishwasher")['session_uuid']
+
+    assert store.update_session_summary(session_uuid, 0, {'history_version': 2, 'message_count': 2})
+    assert not store.update_session_summary(session_uuid, 0, {'history_version': 2, 'message_count': 5})
+    session = store.get_session(session_uuid)
+    assert (session['history_version'], session['message_count']) == (2, 2)
+
+
+def test_list_sessions_pages_through_ties_without_gaps_or_repeats():
+    store = SQLiteChatStore(":memory:")
+    created = {store.create_session("user-1", "Dishwasher")['session_uuid'] for _ in range(7)}
+    store.create_session("user-2", "Dryer")
+    # Sessions started in the same instant are ordered by session_uuid, so none is skipped at a page edge.
+    store._write("UPDATE chat_session SET start_time = '2026-01-01T00:00:00+00:00' WHERE user_id = 'user-1'")
+
+    seen, before = [], None
+    while True:
+        page = store.list_sessions("user-1", 3, before=before)
+        if not page:
+            break
+        seen += [session['session_uuid'] for session in page]
+        before = (page[-1]['start_time'], page[-1]['session_uuid'])
+
+    assert len(seen) == len(set(seen)) == 7
+    assert set(seen) == created
+    assert seen == sorted(seen, reverse=True)
+
+
+@pytest.mark.parametrize("before", [
+    ("yesterday", "0b7c5a8e-6a53-4f50-9b0e-2c3f4d5e6f70"),
+    ("2026-01-01T00:00:00+00:00", "not-a-uuid"),
+    ("2026-01-01T00:00:00+00:00,session_uuid.gt.0", "0b7c5a8e-6a53-4f50-9b0e-2c3f4d5e6f70"),
+])
+def test_keyset_rejects_a_bad_cursor(before):
+    with pytest.raises(ValueError):
+        _keyset(before)
+
+
+def test_keyset_accepts_a_cursor_from_a_listed_session():
+    store = SQLiteChatStore(":memory:")
+    session = store.create_session("user-1", "Dishwasher")
+    assert _keyset((session['start_time'], session['session_uuid'])) == (session['start_time'], session['session_uuid'])
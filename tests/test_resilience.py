@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+def _half_open_breaker():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=1, window=30, cooldown=0, name="test")
+    breaker.record(failed=True)
+    assert breaker.state == "half_open"
+    return breaker
+
+
+def test_cancelled_half_open_trial_releases_the_trial_slot():
+    breaker = _half_open_breaker()
+    policy = RetryPolicy(max_attempts=1, deadline=5, breaker=breaker)
+
+    async def cancelled_trial():
+        async def hang(timeout):
+            await asyncio.sleep(60)
+
+        task = asyncio.ensure_future(policy.call_async("chat", hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancelled_trial())
+
+    async def ok(timeout):
+        return "ok"
+
+    # Before the fix every later call raised CircuitOpenError for the life of the worker.
+    assert asyncio.run(policy.call_async("chat", ok)) == "ok"
+    assert breaker.state == "closed"
+
+
+def test_interrupted_sync_half_open_trial_releases_the_trial_slot():
+    breaker = _half_open_breaker()
+    policy = RetryPolicy(max_attempts=1, deadline=5, breaker=breaker)
+
+    def interrupted(timeout):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        policy.call("chat", interrupted)
+    assert policy.call("chat", lambda timeout: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_second_call_during_half_open_trial_fails_fast():
+    breaker = _half_open_breaker()
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+class _BadRequest(Exception):
+    code = 400
+
+
+def test_non_retryable_error_during_half_open_trial_leaves_the_breaker_open():
+    breaker = _half_open_breaker()
+    policy = RetryPolicy(max_attempts=3, deadline=5, breaker=breaker)
+
+    def bad_request(timeout):
+        raise _BadRequest("invalid argument")
+
+    with pytest.raises(_BadRequest):
+        policy.call("chat", bad_request)
+    # Before the fix the 400 was recorded as a success and closed the breaker.
+    assert breaker.state == "half_open"
+    # The trial slot was given back, so the next call is the trial.
+    assert policy.call("chat", lambda timeout: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_non_retryable_errors_do_not_count_towards_the_failure_rate():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=30, cooldown=30, name="test")
+    policy = RetryPolicy(max_attempts=1, deadline=5, breaker=breaker)
+
+    def bad_request(timeout):
+        raise _BadRequest("invalid argument")
+
+    def unavailable(timeout):
+        raise ConnectionError("reset")
+
+    for _ in range(3):
+        with pytest.raises(_BadRequest):
+            policy.call("chat", bad_request)
+    with pytest.raises(ConnectionError):
+        policy.call("chat", unavailable)
+    assert breaker.state == "closed"
+    with pytest.raises(ConnectionError):
+        policy.call("chat", unavailable)
+    assert breaker.state == "open"
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from session_queue import AsyncSessionQueue, SessionBusyError, SessionQueue
+
+
+def _wait_until_queued(queue, key, count):
+    deadline = time.monotonic() + 5
+    while len(queue._queues.get(key, ())) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_turns_in_one_session_run_in_arrival_order():
+    queue = SessionQueue()
+    order = []
+
+    def turn(n):
+        with queue.turn("session", timeout=5):
+            order.append(n)
+
+    first = queue.acquire("session", timeout=5)
+    threads = []
+    for n in range(5):
+        thread = threading.Thread(target=turn, args=(n,))
+        thread.start()
+        threads.append(thread)
+        # Start the next turn only once this one is queued, so arrival order is known.
+        _wait_until_queued(queue, "session", n + 2)
+    assert order == []
+    queue.release("session", first)
+    for thread in threads:
+        thread.join(5)
+
+    assert order == [0, 1, 2, 3, 4]
+    assert queue._queues == {}
+
+
+def test_other_sessions_do_not_wait():
+    queue = SessionQueue()
+    held = queue.acquire("session-a", timeout=5)
+    with queue.turn("session-b", timeout=0.1):
+        pass
+    queue.release("session-a", held)
+
+
+def test_timed_out_turn_leaves_the_queue():
+    queue = SessionQueue()
+    held = queue.acquire("session", timeout=5)
+    with pytest.raises(SessionBusyError):
+        queue.acquire("session", timeout=0.05)
+    queue.release("session", held)
+    # The abandoned ticket does not hold up the next turn.
+    with queue.turn("session", timeout=0.1):
+        pass
+
+
+def test_async_turns_run_in_arrival_order_and_skip_cancelled_ones():
+    async def main():
+        queue = AsyncSessionQueue()
+        order = []
+
+        async def turn(n):
+            ticket = await queue.acquire("session", timeout=5)
+            try:
+                order.append(n)
+            finally:
+                queue.release("session", ticket)
+
+        first = await queue.acquire("session", timeout=5)
+        tasks = []
+        for n in range(4):
+            tasks.append(asyncio.ensure_future(turn(n)))
+            await asyncio.sleep(0)
+        tasks[1].cancel()
+        await asyncio.sleep(0)
+        queue.release("session", first)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return order, queue._queues
+
+    order, queues = asyncio.run(main())
+    assert order == [0, 2, 3]
+    assert queues == {}
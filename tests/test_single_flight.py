@@ -0,0 +1,118 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def _call(flights, key, work, ttl=60):
+    """Runs `work` through `flights` the way app._claim_turn does; a failed leader's waiters retry."""
+    while True:
+        state, value = flights.claim(key)
+        if state == "done":
+            return value
+        if state == "wait":
+            finished, result = value.wait(5)
+            assert finished
+            if result is not None:
+                return result
+            continue
+        result = None
+        try:
+            result = work()
+            return result
+        finally:
+            flights.finish(key, value, result, ttl)
+
+
+class _CountingSingleFlight(SingleFlight):
+    """Lets a test wait until a number of callers have claimed a key."""
+
+    def __init__(self):
+        super().__init__()
+        self.claims = threading.Semaphore(0)
+
+    def claim(self, key, accept=None):
+        claimed = super().claim(key, accept)
+        self.claims.release()
+        return claimed
+
+    def wait_for_claims(self, count):
+        for _ in range(count):
+            assert self.claims.acquire(timeout=5)
+
+
+def test_concurrent_callers_share_one_execution():
+    flights = _CountingSingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return {"answer": len(calls)}
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(_call, flights, "turn", work) for _ in range(8)]
+        # Let every caller claim before the leader finishes.
+        flights.wait_for_claims(8)
+        release.set()
+        results = [future.result(5) for future in futures]
+
+    assert calls == [1]
+    assert results == [{"answer": 1}] * 8
+    # A repeat within the ttl is replayed rather than run again.
+    assert flights.claim("turn") == ("done", {"answer": 1})
+
+
+def test_failed_leader_wakes_waiters_and_is_not_remembered():
+    flights = SingleFlight()
+    state, leader = flights.claim("turn")
+    assert state == "lead"
+    state, flight = flights.claim("turn")
+    assert (state, flight) == ("wait", leader)
+
+    waiter = threading.Thread(target=lambda: flight.wait(5))
+    waiter.start()
+    flights.finish("turn", leader, None, ttl=60)
+    waiter.join(5)
+
+    assert flight.wait(0) == (True, None)
+    # The failure is not replayed: the next caller leads a new attempt.
+    assert flights.claim("turn")[0] == "lead"
+
+
+def test_leader_error_reaches_the_leader_and_a_waiter_retries():
+    flights = _CountingSingleFlight()
+    attempts = []
+    leader_started = threading.Event()
+    fail = threading.Event()
+
+    def work():
+        attempts.append(1)
+        if len(attempts) == 1:
+            leader_started.set()
+            fail.wait(5)
+            raise RuntimeError("model unavailable")
+        return "recovered"
+
+    with ThreadPoolExecutor(2) as pool:
+        leader = pool.submit(_call, flights, "turn", work)
+        leader_started.wait(5)
+        waiter = pool.submit(_call, flights, "turn", work)
+        flights.wait_for_claims(2)
+        fail.set()
+        with pytest.raises(RuntimeError, match="model unavailable"):
+            leader.result(5)
+        assert waiter.result(5) == "recovered"
+    assert len(attempts) == 2
+
+
+def test_accept_rejecting_a_remembered_result_starts_a_new_call():
+    flights = SingleFlight()
+    _, flight = flights.claim("turn")
+    flights.finish("turn", flight, {"history": [1, 2]}, ttl=60)
+
+    assert flights.claim("turn", accept=lambda result: len(result["history"]) == 2) == ("done", {"history": [1, 2]})
+    assert flights.claim("turn", accept=lambda result: len(result["history"]) == 4)[0] == "lead"
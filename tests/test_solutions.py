@@ -0,0 +1,52 @@
+from solutions import extract_structured
+
+REPLY = """Thanks, that narrows it down.
+
+**Summary:**
+The drain pump on your dishwasher is clogged or has failed.
+
+**Troubleshooting Walk-through:**
+1. Remove the filter and clear any debris.
+2. Check the pump impeller for damage.
+
+**Troubleshooting Flowchart:**
+```mermaid
+graph TD
+    A["Water left in tub"] --> B{"Filter clear?"}
+    B -->|No| C[Clean filter]
+    B -->|Yes| D[Replace drain pump]
+```
+
+**Part Recommendation:**
+Drain pump <span class="part-number">W10348269</span> and filter <span class="part-number">W10872845</span>.
+If the pump is fine, <span class="part-number">W10348269</span> is not needed.
+"""
+
+
+def test_reply_with_a_flowchart_and_part_numbers():
+    structured = extract_structured(REPLY)
+
+    assert list(structured['sections']) == ['summary', 'troubleshooting', 'part_recommendation']
+    assert structured['sections']['summary'] == "The drain pump on your dishwasher is clogged or has failed."
+    assert structured['flowchart'] == {
+        'source': 'graph TD\n    A["Water left in tub"] --> B{"Filter clear?"}\n'
+                  '    B -->|No| C[Clean filter]\n    B -->|Yes| D[Replace drain pump]',
+        'valid': True,
+        'error': None,
+    }
+    assert structured['part_numbers'] == ['W10348269', 'W10872845']
+    assert structured['is_solution']
+
+
+def test_flowchart_that_would_not_render_is_flagged():
+    reply = REPLY.replace('C[Clean filter]', 'C[Clean the "fine" filter]')
+    flowchart = extract_structured(reply)['flowchart']
+
+    assert not flowchart['valid']
+    assert flowchart['error'].startswith("line 3:")
+
+
+def test_clarifying_question_is_not_a_solution():
+    structured = extract_structured("Which model is it? The number is on the door frame.")
+
+    assert structured == {'sections': {}, 'flowchart': None, 'part_numbers': [], 'is_solution': False}
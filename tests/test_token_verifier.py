@@ -0,0 +1,74 @@
+import time
+
+import jwt
+import pytest
+
+import token_verifier
+from token_verifier import TokenVerificationError, TokenVerifier
+
+SECRET = "test-secret-test-secret-test-secret"
+
+
+def _token(exp_in=3600, secret=SECRET, sub="user-1"):
+    claims = {'sub': sub, 'email': f"{sub}@example.com", 'aud': "authenticated", 'exp': int(time.time()) + exp_in}
+    return jwt.encode(claims, secret, algorithm="HS256")
+
+
+class _Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def test_cached_token_is_verified_again_after_max_ttl(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(token_verifier.time, "time", clock)
+    verifier = TokenVerifier(jwt_secret=SECRET, max_ttl=60)
+    token = _token()
+
+    assert verifier.verify(token).id == "user-1"
+    clock.now += 59
+    assert verifier.verify(token).id == "user-1"
+    assert (verifier.hits, verifier.misses) == (1, 1)
+    clock.now += 2
+    assert verifier.verify(token).id == "user-1"
+    assert (verifier.hits, verifier.misses) == (1, 2)
+
+
+def test_cache_entry_does_not_outlive_the_token(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(token_verifier.time, "time", clock)
+    verifier = TokenVerifier(jwt_secret=SECRET, max_ttl=300)
+    token = _token(exp_in=30)
+
+    verifier.verify(token)
+    clock.now += 31
+    verifier.verify(token)
+    assert (verifier.hits, verifier.misses) == (0, 2)
+
+
+def test_expired_token_is_rejected():
+    verifier = TokenVerifier(jwt_secret=SECRET, leeway=10)
+    with pytest.raises(TokenVerificationError):
+        verifier.verify(_token(exp_in=-60))
+
+
+def test_token_with_a_bad_signature_is_rejected_and_not_cached():
+    verifier = TokenVerifier(jwt_secret=SECRET)
+    forged = _token(secret="another-secret-another-secret-12345")
+
+    for _ in range(2):
+        with pytest.raises(TokenVerificationError):
+            verifier.verify(forged)
+    assert (verifier.hits, verifier.misses) == (0, 2)
+
+
+def test_tampered_claims_are_rejected():
+    verifier = TokenVerifier(jwt_secret=SECRET)
+    header, _, signature = _token(sub="user-1").split(".")
+    _, claims, _ = _token(sub="user-2", secret="another-secret-another-secret-12345").split(".")
+
+    with pytest.raises(TokenVerificationError):
+        verifier.verify(f"{header}.{claims}.{signature}")
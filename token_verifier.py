@@ -0,0 +1,181 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+logger = logging.getLogger(__name__)
+
+
+class TokenVerificationError(ValueError):
+    """Raised when a bearer token cannot be verified."""
+
+
+class VerifiedUser:
+    """
+    The subset of the Supabase user that the views rely on, built from JWT claims.
+
+    Attributes:
+        id (str): The Supabase auth user id (the `sub` claim).
+        email (str): The user's email address, if present in the token.
+        role (str): The Postgres role the token grants (usually "authenticated").
+        user_metadata (dict): The `user_metadata` claim (e.g. the username given at sign-up).
+        expires_at (int): The token's `exp` claim as a Unix timestamp.
+    """
+
+    __slots__ = ("id", "email", "role", "user_metadata", "expires_at")
+
+    def __init__(self, id, email=None, role=None, user_metadata=None, expires_at=None):
+        self.id = id
+        self.email = email
+        self.role = role
+        self.user_metadata = user_metadata or {}
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_claims(cls, claims):
+        return cls(
+            id=claims.get("sub"),
+            email=claims.get("email"),
+            role=claims.get("role"),
+            user_metadata=claims.get("user_metadata"),
+            expires_at=claims.get("exp"),
+        )
+
+    def __repr__(self):
+        return f"VerifiedUser(id={self.id!r}, email={self.email!r})"
+
+
+class TokenVerifier:
+    """
+    Verifies Supabase access tokens locally and caches the result until the token expires.
+
+    Tokens are checked against the project's JWT secret (HS256) or its JWKS endpoint
+    (asymmetric keys). When neither is configured, the verifier falls back to a single
+    `supabase.auth.get_user` call per token and caches that result instead, so a
+    request never pays for more than one auth round-trip.
+
+    Attributes:
+        jwt_secret (str, optional): The project's JWT secret for HS256 tokens.
+        jwks_url (str, optional): The project's JWKS URL for asymmetrically signed tokens.
+        audience (str): The expected `aud` claim.
+        max_entries (int): Maximum number of tokens kept in the LRU cache.
+        max_ttl (int): Upper bound, in seconds, on how long a verified token is cached.
+    """
+
+    def __init__(self, jwt_secret=None, jwks_url=None, audience="authenticated",
+                 max_entries=1024, max_ttl=300, leeway=10, remote_verifier=None):
+        """
+        Args:
+            jwt_secret (str, optional): The JWT secret used to verify HS256 signatures.
+            jwks_url (str, optional): URL of the JWKS document for RS256/ES256 tokens.
+            audience (str, optional): Expected audience. Defaults to "authenticated".
+            max_entries (int, optional): LRU capacity. Defaults to 1024.
+            max_ttl (int, optional): Cap on cache lifetime in seconds, so revoked sessions
+                                     stop working within this window. Defaults to 300.
+            leeway (int, optional): Clock skew tolerance in seconds for `exp`/`iat`. Defaults to 10.
+            remote_verifier (callable, optional): Fallback taking a token and returning a user
+                                                  object; used when no key material is configured.
+        """
+        self.jwt_secret = jwt_secret
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.leeway = leeway
+        self.remote_verifier = remote_verifier
+        self._jwks_client = jwt.PyJWKClient(jwks_url, cache_keys=True) if jwks_url else None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, token):
+        """
+        Returns the user for a bearer token, verifying it only on a cache miss.
+
+        Args:
+            token (str): The raw JWT from the Authorization header.
+
+        Returns:
+            VerifiedUser or object: The resolved user (a VerifiedUser for local verification,
+                                    or whatever `remote_verifier` returns).
+
+        Raises:
+            TokenVerificationError: If the token is malformed, expired or has a bad signature.
+        """
+        key = self._cache_key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                user, expires = entry
+                if expires > now:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return user
+                del self._cache[key]
+            self.misses += 1
+
+        user, token_exp = self._verify_uncached(token)
+        cache_until = min(token_exp, now + self.max_ttl) if token_exp else now + self.max_ttl
+        with self._lock:
+            self._cache[key] = (user, cache_until)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return user
+
+    def invalidate(self, token):
+        """Drops a token from the cache (e.g. on logout)."""
+        with self._lock:
+            self._cache.pop(self._cache_key(token), None)
+
+    def _verify_uncached(self, token):
+        if self.jwt_secret or self._jwks_client:
+            claims = self._decode(token)
+            if not claims.get("sub"):
+                raise TokenVerificationError("Token has no subject claim.")
+            return VerifiedUser.from_claims(claims), claims.get("exp")
+
+        if self.remote_verifier is None:
+            raise TokenVerificationError("No JWT secret, JWKS URL or remote verifier configured.")
+        user = self.remote_verifier(token)
+        if not user:
+            raise TokenVerificationError("Invalid or expired token.")
+        # The remote call already validated the token; the unverified exp only bounds the cache.
+        try:
+            token_exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+        except jwt.PyJWTError:
+            token_exp = None
+        return user, token_exp
+
+    def _decode(self, token):
+        try:
+            header = jwt.get_unverified_header(token)
+            algorithm = header.get("alg")
+            if algorithm == "HS256":
+                if not self.jwt_secret:
+                    raise TokenVerificationError("HS256 token received but no JWT secret is configured.")
+                key = self.jwt_secret
+            elif self._jwks_client is not None and algorithm in ("RS256", "ES256"):
+                key = self._jwks_client.get_signing_key_from_jwt(token).key
+            else:
+                raise TokenVerificationError(f"Unsupported token algorithm: {algorithm}")
+            return jwt.decode(
+                token,
+                key,
+                algorithms=[algorithm],
+                audience=self.audience,
+                leeway=self.leeway,
+                options={"require": ["exp", "sub"]},
+            )
+        except jwt.PyJWTError as e:
+            raise TokenVerificationError(str(e)) from e
+
+    @staticmethod
+    def _cache_key(token):
+        # Hash so raw bearer tokens are never held as dictionary keys.
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
@@ -0,0 +1,281 @@
+"""
+Write-behind persistence for chat history.
+
+With HISTORY_WRITE_BEHIND on, a finished turn's messages are queued here and the answer
+goes out without waiting for the database. A background thread flushes the queue every
+`flush_interval` seconds: the queued messages of all sessions go out in one insert, each
+session's summary is updated once however many of its turns were queued, and writes that
+fail stay queued and are retried with backoff. Until a turn is saved, `message_count` and
+`messages` let this worker read its own writes.
+
+A queued turn that collides with one another worker saved first (HistoryConflictError) is
+not retried: its reply was generated without the other worker's turns, so it is dropped
+with the session's later queued turns, logged, counted, and reported to `on_conflict`.
+"""
+import logging
+import threading
+import time
+
+import metrics
+from chat_store import HistoryConflictError
+
+
+class _PendingSession:
+    __slots__ = ('rows', 'unsummarized', 'attempts', 'retry_at')
+
+    def __init__(self):
+        self.rows = []          # chat_message rows not yet inserted, in seq order
+        self.unsummarized = []  # inserted rows not yet folded into the session's summary
+        self.attempts = 0
+        self.retry_at = 0.0
+
+
+class HistoryWriteBehind:
+    """
+    Queues chat history writes and saves them from a background thread.
+
+    Args:
+        store (ChatStore): Where the messages are saved.
+        update_summary (callable): `update_summary(session_uuid, rows)` folds inserted rows
+            into the session's summary columns; returns False if it did not apply.
+        flush_interval (float): Seconds between flushes.
+        max_batch_rows (int): Rows inserted per flush, at most (one session is never split).
+        max_pending_rows (int): Backlog at which `enqueue` refuses more rows, so callers write
+            them themselves instead of growing the queue without bound.
+        max_retry_delay (float): Upper bound of the backoff after failed writes.
+        on_conflict (callable, optional): `on_conflict(session_uuid)` is called after a session's
+            queued turns were dropped because of a history conflict, e.g. to evict the session
+            from a cache that still holds them.
+    """
+
+    def __init__(self, store, update_summary, flush_interval=0.5, max_batch_rows=500,
+                 max_pending_rows=10000, max_retry_delay=30, on_conflict=None):
+        self.store = store
+        self.update_summary = update_summary
+        self.on_conflict = on_conflict
+        self.flush_interval = flush_interval
+        self.max_batch_rows = max_batch_rows
+        self.max_pending_rows = max_pending_rows
+        self.max_retry_delay = max_retry_delay
+        self._sessions = {}  # session_uuid -> _PendingSession
+        self._backlog = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='history-write-behind', daemon=True)
+        self._thread.start()
+
+    @property
+    def backlog(self):
+        """Messages queued but not yet inserted."""
+        return self._backlog
+
+    def enqueue(self, session_uuid, rows):
+        """
+        Queues a turn's chat_message rows (see app._history_rows) for saving.
+
+        Returns:
+            bool: False if nothing was queued because the backlog is full or the writer is
+            closed; the caller should then save the rows itself.
+        """
+        with self._cond:
+            if self._closed or self._backlog + len(rows) > self.max_pending_rows:
+                return False
+            pending = self._sessions.get(session_uuid)
+            if pending is None:
+                pending = self._sessions[session_uuid] = _PendingSession()
+            pending.rows.extend(rows)
+            self._set_backlog(self._backlog + len(rows))
+        return True
+
+    def message_count(self, session_uuid, saved_count):
+        """Returns the session's message count including its queued turns."""
+        with self._cond:
+            pending = self._sessions.get(session_uuid)
+            if pending is None:
+                return saved_count
+            rows = pending.rows or pending.unsummarized
+            return max(saved_count, rows[-1]['seq'] + 1) if rows else saved_count
+
+    def messages(self, session_uuid, saved):
+        """Returns `saved` (as loaded from the store) followed by the session's queued messages."""
+        with self._cond:
+            pending = self._sessions.get(session_uuid)
+            # Rows inserted since `saved` was read may still be queued; skip what it already has.
+            queued = [row for row in pending.rows if row['seq'] >= len(saved)] if pending else []
+        return saved + [{key: row[key] for key in ('role', 'parts', 'structured') if key in row} for row in queued]
+
+    def discard(self, session_uuid):
+        """Drops everything queued for a session, e.g. because it is being deleted."""
+        with self._cond:
+            pending = self._sessions.pop(session_uuid, None)
+            if pending is not None:
+                self._set_backlog(self._backlog - len(pending.rows))
+
+    def flush(self, force=False):
+        """
+        Saves one batch of queued writes.
+
+        Args:
+            force (bool): Also retry sessions that are still backing off after a failure.
+
+        Returns:
+            int: The number of rows inserted.
+        """
+        with self._flush_lock:
+            batch, summaries = self._take_batch(force)
+            inserted = self._insert(batch) if batch else []
+            for session_uuid in set(inserted) | set(summaries):
+                self._summarize(session_uuid)
+            return sum(len(batch[session_uuid]) for session_uuid in inserted)
+
+    def close(self, timeout):
+        """
+        Stops accepting writes and waits up to `timeout` seconds for the queue to be saved.
+
+        Returns:
+            int: Messages still unsaved when the wait ended.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._backlog:
+            logging.error(f"HISTORY_LOG: {self._backlog} chat message(s) in {len(self._sessions)} session(s) were not saved before shutdown.")
+        return self._backlog
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.flush_interval)
+                closing = self._closed
+            try:
+                self.flush(force=closing)
+            except Exception as e:
+                logging.error(f"HISTORY_LOG: History flush failed: {e}", exc_info=True)
+            if closing:
+                with self._cond:
+                    if not self._sessions:
+                        return
+                    # Keep retrying until close() stops waiting; the thread dies with the process.
+                    self._cond.wait(self.flush_interval)
+
+    def _take_batch(self, force):
+        """Returns ({session_uuid: rows to insert}, [sessions with only a summary to update])."""
+        now = time.monotonic()
+        batch, summaries, size = {}, [], 0
+        with self._cond:
+            for session_uuid, pending in self._sessions.items():
+                if not force and pending.retry_at > now:
+                    continue
+                if not pending.rows:
+                    summaries.append(session_uuid)
+                elif not batch or size + len(pending.rows) <= self.max_batch_rows:
+                    batch[session_uuid] = list(pending.rows)
+                    size += len(pending.rows)
+        return batch, summaries
+
+    def _insert(self, batch):
+        """Inserts the batch, one session at a time if the combined insert fails; returns the sessions saved."""
+        if len(batch) > 1:
+            try:
+                with metrics.phase('history_flush'):
+                    self.store.append_messages([row for rows in batch.values() for row in rows])
+            except Exception:
+                pass
+            else:
+                for session_uuid, rows in batch.items():
+                    self._inserted(session_uuid, rows)
+                return list(batch)
+        return [session_uuid for session_uuid, rows in batch.items() if self._insert_session(session_uuid, rows)]
+
+    def _insert_session(self, session_uuid, rows):
+        try:
+            with metrics.phase('history_flush'):
+                self.store.append_messages(rows)
+        except HistoryConflictError as e:
+            self._conflicted(session_uuid, e)
+            return False
+        except Exception as e:
+            self._failed(session_uuid, e)
+            return False
+        self._inserted(session_uuid, rows)
+        return True
+
+    def _conflicted(self, session_uuid, error):
+        # Renumbering the queued rows to follow the other worker's would store replies that
+        # never saw those turns, so the queued turns are given up instead.
+        metrics.HISTORY_WRITE_CONFLICTS.inc()
+        with self._cond:
+            pending = self._sessions.get(session_uuid)
+            dropped = len(pending.rows) if pending else 0
+            if pending is not None:
+                pending.rows.clear()
+                self._set_backlog(self._backlog - dropped)
+                if not pending.unsummarized:
+                    del self._sessions[session_uuid]
+        logging.error(f"HISTORY_LOG: Session {session_uuid} was written by another worker first; "
+                      f"dropped {dropped} queued message(s): {error}")
+        if self.on_conflict is not None:
+            try:
+                self.on_conflict(session_uuid)
+            except Exception as e:
+                logging.error(f"HISTORY_LOG: Conflict callback for session {session_uuid} failed: {e}", exc_info=True)
+
+    def _inserted(self, session_uuid, rows):
+        with self._cond:
+            pending = self._sessions.get(session_uuid)
+            if pending is None:
+                return
+            del pending.rows[:len(rows)]
+            pending.unsummarized.extend(rows)
+            pending.attempts = 0
+            pending.retry_at = 0.0
+            self._set_backlog(self._backlog - len(rows))
+
+    def _summarize(self, session_uuid):
+        with self._cond:
+            pending = self._sessions.get(session_uuid)
+            rows = list(pending.unsummarized) if pending else []
+        if not rows:
+            return
+        try:
+            with metrics.phase('history_flush'):
+                applied = self.update_summary(session_uuid, rows)
+        except Exception as e:
+            self._failed(session_uuid, e)
+            return
+        if not applied:
+            self._failed(session_uuid, 'conflicting summary updates')
+            return
+        with self._cond:
+            pending = self._sessions.get(session_uuid)
+            if pending is None:
+                return
+            del pending.unsummarized[:len(rows)]
+            if not pending.rows and not pending.unsummarized:
+                del self._sessions[session_uuid]
+
+    def _failed(self, session_uuid, error):
+        metrics.HISTORY_WRITE_FAILURES.inc()
+        with self._cond:
+            pending = self._sessions.get(session_uuid)
+            if pending is None:
+                return
+            pending.attempts += 1
+            delay = min(self.max_retry_delay, self.flush_interval * 2 ** pending.attempts)
+            pending.retry_at = time.monotonic() + delay
+            attempts = pending.attempts
+        logging.warning(f"HISTORY_LOG: Saving session {session_uuid} failed (attempt {attempts}), retrying in {delay:.1f}s: {error}")
+        # A session deleted by another worker will never accept its messages.
+        try:
+            if self.store.get_session(session_uuid) is None:
+                logging.warning(f"HISTORY_LOG: Session {session_uuid} no longer exists; dropping its queued messages.")
+                self.discard(session_uuid)
+        except Exception:
+            pass
+
+    def _set_backlog(self, value):
+        self._backlog = value
+        metrics.HISTORY_WRITE_BACKLOG.set(value)
@@ -0,0 +1,125 @@
+"""
+Serves a WSGI app from an ASGI server, on a pool of threads.
+
+asgi.py mounts the Flask app with `PooledWsgiToAsgi` for every route it does not serve
+natively. Each request's body is read into a spooled temp file on the event loop, then the
+WSGI app runs on one of the pool's threads and hands its response back to the loop chunk by
+chunk, so streamed responses still stream. Only the WSGI (PEP 3333) and ASGI HTTP
+interfaces are used.
+"""
+import asyncio
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Request bodies up to this size stay in memory; larger ones (uploads) go to a temp file.
+BODY_SPOOL_BYTES = 64 * 1024
+
+
+def build_environ(scope, body):
+    """Builds the WSGI environ for an ASGI HTTP `scope` whose body has been read into `body`."""
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin1')
+    path_info = scope['path'].encode('utf8').decode('latin1')
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The whole body has been read, so it can be read to the end even without a Content-Length.
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin1').lower(), value.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+class PooledWsgiToAsgi:
+    """
+    An ASGI app running `wsgi_application` on a pool of `threads` threads, so delegated
+    requests run in parallel rather than one at a time.
+    """
+
+    def __init__(self, wsgi_application, threads):
+        self.wsgi_application = wsgi_application
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError(f"A WSGI app can only serve HTTP requests, not {scope['type']!r}.")
+        body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_BYTES)
+        try:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self._run, scope, body, loop, send)
+        finally:
+            body.close()
+
+    def _run(self, scope, body, loop, send):
+        """Runs the WSGI app on a pool thread, sending its response through the event loop."""
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start = None
+        started = False
+
+        def write(data):
+            nonlocal started
+            if response_start is None:
+                raise AssertionError("write() called before start_response().")
+            if not started:
+                send_message(response_start)
+                started = True
+            if data:
+                send_message({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+        def start_response(status, headers, exc_info=None):
+            nonlocal response_start
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_start = {
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers],
+            }
+            return write
+
+        result = self.wsgi_application(build_environ(scope, body), start_response)
+        try:
+            for chunk in result:
+                write(chunk)
+            write(b'')  # Sends the status and headers of an empty response.
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        send_message({'type': 'http.response.body', 'body': b''})